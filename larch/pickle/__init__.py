@@ -1,10 +1,15 @@
 from .pickle import (
-    Pickler, Unpickler, dumps, dump, load, loads, PickleError,
-    PicklingError, UnpicklingError, SecurityError)
+    Pickler, Unpickler, dumps, dump, load, loads, load_path, dumps_parallel,
+    loads_parallel, loads_lazy, LazyMap, LazySeq, PickleError, PicklingError,
+    UnpicklingError, SecurityError, BufferTooSmallError)
 from .register import secure_unpickle, secure_modules
+from .indexed import IndexedWriter, IndexedReader
 
 __all__ = ("Pickler", "Unpickler", "dumps", "dump", "load", "loads",
-           "secure_unpickle", "PickleError", "PicklingError",
-           "UnpicklingError", "SecurityError", "secure_modules")
+           "load_path", "dumps_parallel", "loads_parallel", "loads_lazy",
+           "LazyMap", "LazySeq", "IndexedWriter", "IndexedReader",
+           "secure_unpickle",
+           "PickleError", "PicklingError", "UnpicklingError", "SecurityError",
+           "BufferTooSmallError", "secure_modules")
 
-__version__ = "1.4.7"
+__version__ = "1.5.0"
@@ -0,0 +1,111 @@
+"""Pickles and asyncio streams
+
+The data is fed to an Unpickler as it arrives, a pickle is loaded as soon
+as it is complete. The event loop is never blocked by waiting for the rest
+of a large pickle. dump_to() pickles in a worker thread and writes the
+chunks with back pressure, the event loop is woken up for every chunk.
+"""
+import asyncio
+import threading
+from .pickle import Pickler, Unpickler, _ChunkSink
+
+DEFAULT_CHUNK_SIZE = 0x10000
+_NOTHING = object()
+
+
+class StreamUnpickler:
+    """Loads the pickles of an asyncio.StreamReader (or any object with an
+    async read(n) method). Iterating over it yields the objects until the
+    end of the stream."""
+
+    def __init__(self, reader, secure=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                 session=False):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.unpickler = Unpickler(secure=secure, session=session)
+        self.objects = iter(())
+
+    async def load(self):
+        """Returns the next object, raises EOFError at the end of the
+        stream."""
+        while True:
+            obj = next(self.objects, _NOTHING)
+            if obj is not _NOTHING:
+                return obj
+
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                if self.unpickler.pending:
+                    raise EOFError("the stream ended within a pickle")
+                raise EOFError
+
+            self.unpickler.feed(data)
+            self.objects = self.unpickler.objects()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.load()
+        except EOFError as e:
+            if e.args:
+                raise
+            raise StopAsyncIteration from None
+
+
+class _LoopQueue:
+    """Passes the chunks of a worker thread to the event loop. put() blocks
+    the worker while `size` chunks are not taken, after close() it drops
+    the chunks. The final None always arrives."""
+
+    def __init__(self, loop, size=2):
+        self.loop = loop
+        self.items = asyncio.Queue()
+        self.free = threading.Semaphore(size)
+        self.closed = False
+
+    def put(self, item):
+        if item is not None:
+            self.free.acquire()
+            if self.closed:
+                return
+        self.loop.call_soon_threadsafe(self.items.put_nowait, item)
+
+    async def get(self):
+        item = await self.items.get()
+        self.free.release()
+        return item
+
+    def close(self):
+        self.closed = True
+        self.free.release()
+
+
+async def dump_to(pickler, obj, writer, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Writes the pickle of obj in chunks to the asyncio.StreamWriter writer,
+    writer.drain() is awaited after every chunk. pickler may be None. If
+    the coroutine is cancelled, it waits until the pickler stopped."""
+    if pickler is None:
+        pickler = Pickler()
+
+    chunks = _LoopQueue(asyncio.get_running_loop())
+    sink = _ChunkSink(max(chunk_size, 1), chunks)
+    pickler._start_dump(obj, sink, True)
+    chunk = b""
+    try:
+        chunk = await chunks.get()
+        while chunk is not None:
+            writer.write(chunk)
+            await writer.drain()
+            chunk = await chunks.get()
+    except BaseException:
+        # stop the worker and wait for its end
+        sink.cancelled = True
+        chunks.close()
+        while chunk is not None:
+            chunk = await chunks.get()
+        raise
+
+    if sink.error is not None:
+        raise sink.error
@@ -0,0 +1,231 @@
+"""Channels between processes over shared memory
+
+The producers pickle the messages directly into a ring buffer of a
+multiprocessing.shared_memory segment, the consumer loads them from there.
+There is no pipe and no copy of a message, except for the load of a
+message that wraps around the end of the ring.
+
++--------+------+------+-------------------------------------+
+| header | head | tail | ring of capacity bytes              |
++--------+------+------+-------------------------------------+
+
+header: 8 bytes MAGIC and the capacity as 64 bit unsigned integer
+head:   64 bit count of the bytes written by the producers
+tail:   64 bit count of the bytes read by the consumer
+
+head and tail are on their own cache lines, a message in the ring is its
+size as 64 bit unsigned integer followed by the pickle and padded to 8
+bytes. A full ring blocks the producers until the consumer catches up.
+"""
+import time
+import queue
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from .pickle import Pickler, Unpickler, BufferTooSmallError, _SharedCounter
+
+MAGIC = b"LPCHAN01"
+HEAD = 64
+TAIL = 128
+HEADER_SIZE = 192
+SIZE = struct.Struct("=Q")
+DEFAULT_CAPACITY = 0x100000
+
+# a waiting side polls SPIN times and then sleeps up to MAX_SLEEP seconds
+SPIN = 200
+MAX_SLEEP = 0.001
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+class _Waiter:
+    """Polls with growing sleeps until the timeout expires."""
+    __slots__ = ("deadline", "count", "delay")
+
+    def __init__(self, block, timeout):
+        if not block:
+            self.deadline = 0
+        elif timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + max(timeout, 0)
+        self.count = 0
+        self.delay = 0.00001
+
+    def wait(self):
+        """returns False if the time is up"""
+        if self.deadline is not None and (
+                self.deadline == 0 or time.monotonic() >= self.deadline):
+            return False
+
+        self.count += 1
+        if self.count < SPIN:
+            time.sleep(0)
+        else:
+            time.sleep(self.delay)
+            self.delay = min(self.delay * 2, MAX_SLEEP)
+        return True
+
+
+class Channel:
+    """A message queue between processes with a ring buffer of `capacity`
+    bytes in shared memory. Without `multi_producer` only one process may
+    put messages, only one process may get messages. The channel is passed
+    to other processes as argument of multiprocessing.Process (or a pool
+    initializer). The lock of the producers is created by the
+    multiprocessing `context`. The creator calls unlink() if the channel
+    is not needed anymore."""
+
+    shm = None
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, multi_producer=False,
+                 protocol=-1, secure=False, context=None):
+        capacity = _padded(max(capacity, 64))
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + capacity)
+        self.shm.buf[:len(MAGIC)] = MAGIC
+        SIZE.pack_into(self.shm.buf, len(MAGIC), capacity)
+        if multi_producer:
+            self.lock = (context or multiprocessing).Lock()
+        else:
+            self.lock = None
+        self.protocol = protocol
+        self.secure = secure
+        self._attach()
+
+    def _attach(self):
+        buf = self.shm.buf
+        if bytes(buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a channel")
+        self.capacity = SIZE.unpack_from(buf, len(MAGIC))[0]
+        self.head = _SharedCounter(buf, HEAD)
+        self.tail = _SharedCounter(buf, TAIL)
+        self.ring = buf[HEADER_SIZE:HEADER_SIZE + self.capacity]
+        self.pickler = Pickler(protocol=self.protocol)
+        self.unpickler = Unpickler(secure=self.secure)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "lock": self.lock,
+                "protocol": self.protocol, "secure": self.secure}
+
+    def __setstate__(self, state):
+        self.shm = shared_memory.SharedMemory(state["name"])
+        self.lock = state["lock"]
+        self.protocol = state["protocol"]
+        self.secure = state["secure"]
+        self._attach()
+
+    def put(self, obj, block=True, timeout=None):
+        """Pickles obj into the ring. If the ring is full, it waits for
+        the consumer at most timeout seconds and raises queue.Full."""
+        waiter = _Waiter(block, timeout)
+        if self.lock is None:
+            return self._put(obj, waiter)
+
+        if not self.lock.acquire(block, timeout):
+            raise queue.Full
+        try:
+            return self._put(obj, waiter)
+        finally:
+            self.lock.release()
+
+    def _put(self, obj, waiter):
+        capacity = self.capacity
+        ring = self.ring
+        head = self.head.load()
+        start = head % capacity
+        data = (start + 8) % capacity
+        needed = 0
+        while True:
+            free = capacity - (head - self.tail.load())
+            if free >= needed + 8:
+                first = min(free - 8, capacity - data)
+                rest = free - 8 - first
+                try:
+                    size = self.pickler.dumps_into(
+                        obj, ring[data:data + first], 0,
+                        ring[:rest] if rest else None)
+                    break
+                except BufferTooSmallError as e:
+                    needed = e.required
+                    if needed + 8 > capacity:
+                        raise ValueError(
+                            "the message needs {} bytes, the channel "
+                            "has {}".format(needed + 8, capacity)) from None
+
+            if not waiter.wait():
+                raise queue.Full
+
+        SIZE.pack_into(ring, start, size)
+        self.head.store(head + _padded(size + 8))
+
+    def get(self, block=True, timeout=None):
+        """Returns the next message. If there is none, it waits at most
+        timeout seconds and raises queue.Empty."""
+        tail = self.tail.load()
+        waiter = None
+        while self.head.load() == tail:
+            if waiter is None:
+                waiter = _Waiter(block, timeout)
+            if not waiter.wait():
+                raise queue.Empty
+
+        capacity = self.capacity
+        ring = self.ring
+        start = tail % capacity
+        size = SIZE.unpack_from(ring, start)[0]
+        data = (start + 8) % capacity
+        end = data + size
+        try:
+            if end <= capacity:
+                return self.unpickler.loads(ring[data:end])
+            # the message wraps around
+            return self.unpickler.loads(
+                bytes(ring[data:]) + bytes(ring[:end - capacity]))
+        finally:
+            self.tail.store(tail + _padded(size + 8))
+
+    def put_nowait(self, obj):
+        return self.put(obj, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return self.head.load() == self.tail.load()
+
+    def close(self):
+        """Closes the channel in this process."""
+        if self.shm is None:
+            return
+
+        self.head.release()
+        self.tail.release()
+        self.ring.release()
+        self.head = self.tail = self.ring = None
+        self.pickler = self.unpickler = None
+        self.shm.close()
+        self.shm = None
+
+    def unlink(self):
+        """Closes the channel and removes the shared memory."""
+        shm = self.shm
+        self.close()
+        if shm is not None:
+            shm.unlink()
+
+    def __del__(self):
+        # the shared memory cannot be closed while the views exist
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
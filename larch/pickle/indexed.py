@@ -0,0 +1,235 @@
+"""Sequence files with random access
+
+Every element of the sequence is pickled independently, the offsets
+of the elements are appended as index:
+
++--------+-----------+-----------+-----+-------+---------+
+| header | element 0 | element 1 | ... | index | trailer |
++--------+-----------+-----------+-----+-------+---------+
+
+header:  8 bytes MAGIC and the committed size of the file as 64 bit
+         little-endian unsigned integer
+index:   start and end offset of every element as 64 bit little-endian
+         unsigned integers
+trailer: count and index offset as 64 bit little-endian unsigned integers
+         followed by 8 bytes TRAILER_MAGIC
+
+The file ends with the trailer at the committed size. Appending writes the
+new elements, a new index and trailer after the old trailer and commits the
+new size in the header at last. Until then the old index stays valid, the
+bytes after the committed size are ignored.
+"""
+import io
+import os
+import sys
+import mmap
+import array
+import struct
+from .pickle import Pickler, Unpickler, UnpicklingError
+
+MAGIC = b"LPINDEX2"
+HEADER = struct.Struct("<8sQ")
+TRAILER_MAGIC = b"LPINDEXE"
+TRAILER = struct.Struct("<QQ8s")
+
+
+def _index_array(data=b""):
+    index = array.array("Q")
+    index.frombytes(data)
+    if sys.byteorder != "little":
+        index.byteswap()
+    return index
+
+
+def _index_bytes(index):
+    if sys.byteorder != "little":
+        index = array.array("Q", index)
+        index.byteswap()
+    return index.tobytes()
+
+
+def _committed_size(header, size):
+    if size < HEADER.size:
+        raise UnpicklingError("not an indexed file")
+    magic, committed = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise UnpicklingError("not an indexed file")
+    if not HEADER.size + TRAILER.size <= committed <= size:
+        raise UnpicklingError("the index of the file is damaged")
+    return committed
+
+
+def _read_trailer(trailer, size):
+    """returns the index offset and the element count"""
+    count, index_offset, magic = TRAILER.unpack(trailer)
+    if (magic != TRAILER_MAGIC
+            or index_offset + count * 16 + TRAILER.size != size):
+        raise UnpicklingError("the index of the file is damaged")
+    return index_offset, count
+
+
+def _sync(file):
+    file.flush()
+    try:
+        os.fsync(file.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+
+
+class IndexedWriter:
+    """Writes the elements of a sequence to an indexed file. `file` is
+    a path or a seekable file object opened in binary mode. With
+    `append` an existing indexed file is extended. The index is written
+    by close(), the file keeps its old content until then."""
+
+    def __init__(self, file, append=False, protocol=-1):
+        self.own_file = not hasattr(file, "write")
+        if self.own_file:
+            mode = "r+b" if append and os.path.exists(file) else "wb"
+            file = open(file, mode)
+
+        self.file = file
+        self.pickler = Pickler(protocol=protocol)
+        self.index = _index_array()
+        try:
+            file.seek(0, io.SEEK_END)
+            if append and file.tell():
+                self.offset = self._read_index()
+            else:
+                file.seek(0)
+                file.truncate()
+                file.write(HEADER.pack(MAGIC, 0))
+                self.offset = HEADER.size
+        except BaseException:
+            if self.own_file:
+                file.close()
+            raise
+
+    def _read_index(self):
+        file = self.file
+        file_size = file.tell()
+        file.seek(0)
+        size = _committed_size(file.read(HEADER.size), file_size)
+        file.seek(size - TRAILER.size)
+        index_offset, count = _read_trailer(file.read(TRAILER.size), size)
+        file.seek(index_offset)
+        self.index = _index_array(file.read(count * 16))
+        # a former append that was not committed is overwritten
+        file.seek(size)
+        file.truncate()
+        return size
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def append(self, obj):
+        data = self.pickler.dumps(obj)
+        self.file.write(data)
+        self.index.append(self.offset)
+        self.offset += len(data)
+        self.index.append(self.offset)
+
+    def extend(self, objects):
+        for obj in objects:
+            self.append(obj)
+
+    def close(self):
+        if self.file is None:
+            return
+
+        self.file.write(_index_bytes(self.index))
+        self.file.write(
+            TRAILER.pack(len(self), self.offset, TRAILER_MAGIC))
+        _sync(self.file)
+        # commit
+        self.file.seek(0)
+        self.file.write(HEADER.pack(
+            MAGIC, self.offset + len(self.index) * 8 + TRAILER.size))
+        _sync(self.file)
+        self.file.seek(0, io.SEEK_END)
+        if self.own_file:
+            self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IndexedReader:
+    """Reads the elements of an indexed file, which is mapped into memory.
+    reader[i] and reader[a:b] load only the requested elements."""
+
+    def __init__(self, file, secure=False):
+        if hasattr(file, "fileno"):
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(file, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.secure = secure
+        self.data = memoryview(self.map)
+        size = _committed_size(self.data[:HEADER.size], len(self.data))
+        index_offset, count = _read_trailer(
+            self.data[size - TRAILER.size:size], size)
+        index = self.data[index_offset:index_offset + count * 16]
+        if sys.byteorder == "little":
+            self.index = index.cast("Q")
+        else:
+            self.index = _index_array(index)
+        self.unpickler = Unpickler(secure=secure)
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return list(self.iter(start, stop))
+            return [self[j] for j in range(start, stop, step)]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("index out of range")
+
+        return self.unpickler.loads(
+            self.data[self.index[2 * i]:self.index[2 * i + 1]])
+
+    def __iter__(self):
+        return self.iter(0, len(self))
+
+    def iter(self, start, stop):
+        """yields the elements from start to stop"""
+        index = self.index
+        while start < stop:
+            # the elements up to end are contiguous
+            end = start + 1
+            while end < stop and index[2 * end] == index[2 * end - 1]:
+                end += 1
+            yield from Unpickler.iter_load(
+                self.data[index[2 * start]:index[2 * end - 1]],
+                secure=self.secure)
+            start = end
+
+    def close(self):
+        if self.map is None:
+            return
+
+        self.index = self.data = self.unpickler = None
+        try:
+            self.map.close()
+        except BufferError:
+            # loaded objects still refer to the memory map,
+            # it is closed when they are gone
+            pass
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -11,23 +11,137 @@ template<typename T> void to_buffer(unsigned char* buffer, T value) {
 
 
 struct StringWriter {
-  string output;
+  /* the output is written into a bytes object, which is returned without
+     copying if it is large. A returned bytes object is never written again,
+     the next output gets a new one. set_memory() lets the writer fill
+     foreign memory instead. */
+  PyObject* buffer;  // the bytes object being written, only known here
+  PyObject* output;  // the handed over bytes object with the output
+  char* memory;  // the data of buffer or output or the foreign memory
+  size_t capacity;
+  size_t used;
+  size_t limit;  // the packer calls do_write if output would exceed limit
+
+  StringWriter()
+    : buffer(NULL), output(NULL), memory(NULL), capacity(0), used(0),
+      limit((size_t)-1) {}
+
+  ~StringWriter() {
+    Py_XDECREF(buffer);
+    Py_XDECREF(output);
+  }
+
+  void adopt() {
+    memory = buffer ? PyBytes_AS_STRING(buffer) : NULL;
+    capacity = buffer ? PyBytes_GET_SIZE(buffer) : 0;
+  }
 
   void reset() {
-    output.clear();
-    if (output.capacity() < 8192)
-      output.reserve(8192);
+    used = 0;
+    if (output) {
+      Py_CLEAR(output);
+      adopt();
+    }
+  }
+
+  void set_memory(char* data, size_t size) {
+    Py_CLEAR(buffer);
+    Py_CLEAR(output);
+    memory = data;
+    capacity = limit = size;
+    used = 0;
+  }
+
+  bool grow(size_t size) {
+    size_t new_capacity = std::max(std::max(capacity * 2, used + size),
+                                   (size_t)MIN_OUTPUT_SIZE);
+    if (buffer) {
+      // buffer is NULL if it fails
+      _PyBytes_Resize(&buffer, new_capacity);
+    }
+    else {
+      // the first output or the old one was handed over
+      buffer = PyBytes_FromStringAndSize(NULL, new_capacity);
+      if (buffer && used)
+        memcpy(PyBytes_AS_STRING(buffer), memory, used);
+      Py_CLEAR(output);
+    }
+
+    adopt();
+    if (!buffer) {
+      used = 0;
+      return false;
+    }
+    return true;
+  }
+
+  inline void append(const void* data, size_t size) {
+    if (used + size > capacity && !grow(size))
+      throw PythonError();
+    memcpy(memory + used, data, size);
+    used += size;
   }
 
   int write(void* data, size_t size) {
-    /* the string memory management is much better than
-       a manual call of self.output.reserve(...)!*/
-    output.append((char*)data, size);
+    try {
+      append(data, size);
+    }
+    catch(PythonError&) {
+      return -1;
+    }
     return 1;
   }
 
+  inline bool fits(size_t size) {
+    return used + size <= limit;
+  }
+
+  char* data() {
+    return memory;
+  }
+
+  size_t size() {
+    return used;
+  }
+
+  bool hand_over() {
+    /* the buffer shrinks to the used size and becomes the output, it stays
+       readable until reset() */
+    if (output)
+      return true;
+    if (!buffer)
+      return false;
+
+    if (used < capacity && _PyBytes_Resize(&buffer, used) < 0) {
+      adopt();
+      used = 0;
+      return false;
+    }
+    output = buffer;
+    buffer = NULL;
+    memory = PyBytes_AS_STRING(output);
+    capacity = used;
+    return true;
+  }
+
   PyObject* result() {
-    return PyBytes_FromStringAndSize(output.data(), output.size());
+    // large outputs are handed over, small ones are copied
+    if (output || (used >= MIN_HANDOVER_SIZE && buffer)) {
+      if (!hand_over())
+        return NULL;
+      Py_INCREF(output);
+      return output;
+    }
+    return PyBytes_FromStringAndSize(memory, used);
+  }
+
+  PyObject* view() {
+    // a read only view of the output, it stays valid after reset()
+    if (!used || (!buffer && !output))
+      return PyMemoryView_FromMemory(used ? memory : (char*)"", used, PyBUF_READ);
+    if (!hand_over())
+      return NULL;
+    return PyMemoryView_FromObject(output);
   }
 };
 
@@ -51,6 +165,12 @@ struct TypeMap : public unordered_map<PyObject*, pack_t> {
 struct BaseRefHandler {
   virtual bool save_ref(Packer* p, PyObject *o, bool force_obj) = 0;
   virtual uint32_t reset() = 0;
+  virtual uint32_t end_message() {
+    return reset();
+  }
+  virtual uint32_t ref_count() {
+    return 0;
+  }
   virtual ~BaseRefHandler() { }
 };
 
@@ -72,24 +192,72 @@ struct RefHandler : public BaseRefHandler {
   uint32_t ref_counter;
   PyObject* string_refs;       // for strings the python dict is more efficent
 
-  RefHandler() : ref_counter(0) {
+  /* in a session strings and classes stay referenceable
+     for the next messages */
+  PyObject* session_objects;   // keeps the classes of a session alive
+  uint32_t message_start;      // the ref counter at the start of a message
+  vector<PyObject*> transient; // strings not kept in a session
+
+  RefHandler(bool session=false)
+      : ref_counter(0), session_objects(NULL), message_start(0) {
     string_refs = PyDict_New();
     if (!string_refs)
       throw PythonError();
+
+    if (session) {
+      session_objects = PyList_New(0);
+      if (!session_objects)
+        throw PythonError();
+    }
   }
 
   ~RefHandler() {
     Py_XDECREF(string_refs);
+    Py_XDECREF(session_objects);
   }
 
   virtual bool save_ref(Packer* p, PyObject *o, bool force_obj);
   virtual uint32_t reset() {
-    uint32_t val = ref_counter;
-    ref_counter = 0;
+    uint32_t val = ref_counter - message_start;
+    ref_counter = message_start = 0;
     refs.clear();
     PyDict_Clear(string_refs);
+    transient.clear();
+    if (session_objects)
+      PyList_SetSlice(session_objects, 0, PY_SSIZE_T_MAX, NULL);
     return val;
   }
+
+  virtual uint32_t end_message() {
+    if (!session_objects)
+      return reset();
+
+    // keep exactly what the unpacker keeps: session strings and classes
+    uint32_t val = ref_counter - message_start;
+    for(vector<PyObject*>::iterator i = transient.begin(); i != transient.end(); i++) {
+      if (PyDict_DelItem(string_refs, *i) == -1)
+        throw PythonError();
+    }
+    transient.clear();
+
+    for(refmap_t::iterator i = refs.begin(); i != refs.end();) {
+      if (PyType_Check(i->first)) {
+        if (i->second > message_start
+            && PyList_Append(session_objects, i->first) == -1)
+          throw PythonError();
+        ++i;
+      }
+      else
+        i = refs.erase(i);
+    }
+
+    message_start = ref_counter;
+    return val;
+  }
+
+  virtual uint32_t ref_count() {
+    return ref_counter;
+  }
 };
 
 
@@ -125,41 +293,74 @@ static TypeMap pickle_registry;
 struct Packer {
   PyObject *pickler;
   write_t do_write;
+  StringWriter *window;  // buffered output, do_write is called if full
   int protocol;
   BaseRefHandler *refhandler;
   size_t min_string_size_for_ref;
+  size_t position;       // count of written bytes, used for alignment
+  /* key tuple -> None if seen once, or the key tuple written
+     for every dict with these keys */
+  PyObject* shapes;
+  PyObject* last_shape;  // the last key tuple written (borrowed from shapes)
 
-  void set_refs(bool with_refs) {
+  void set_refs(bool with_refs, bool session=false) {
     delete refhandler;
     if (with_refs)
-      refhandler = new RefHandler();
+      refhandler = new RefHandler(session);
     else
       refhandler = new DumyRefHandler();
   }
 
   Packer(PyObject* pickler, int protocol, bool with_refs)
-    : pickler(pickler), protocol(protocol), refhandler(NULL),
-      min_string_size_for_ref(MIN_STRING_SIZE_FOR_REF) {
+    : pickler(pickler), window(NULL), protocol(protocol), refhandler(NULL),
+      min_string_size_for_ref(MIN_STRING_SIZE_FOR_REF),
+      position(0), shapes(NULL), last_shape(NULL) {
     set_refs(with_refs);
   }
 
   ~Packer()  {
     delete refhandler;
+    Py_XDECREF(shapes);
+  }
+
+  void use_shapes() {
+    if (!shapes && !(shapes = PyDict_New()))
+      throw PythonError();
+  }
+
+  void clear_shapes() {
+    // only between pickles, the refs know the shapes
+    if (shapes && PyDict_GET_SIZE(shapes)) {
+      last_shape = NULL;
+      PyDict_Clear(shapes);
+    }
   }
 
   uint32_t reset() {
+    if (shapes && PyDict_GET_SIZE(shapes) >= MAX_SHAPES)
+      clear_shapes();
     return refhandler->reset();
   }
 
-  void write(const void* value, size_t size) {
-    if (do_write(pickler, (void*)value, size) == -1)
+  uint32_t end_message() {
+    return refhandler->end_message();
+  }
+
+  uint32_t ref_count() {
+    return refhandler->ref_count();
+  }
+
+  inline void write(const void* value, size_t size) {
+    position += size;
+    if (window && window->fits(size))
+      window->append(value, size);
+    else if (do_write(pickler, (void*)value, size) == -1)
       throw PythonError();
   }
 
   template <typename T> void write_int(T value) {
     encode(value);
-    if (do_write(pickler, &value, sizeof(value)) == -1)
-      throw PythonError();
+    write(&value, sizeof(value));
   }
 
   template <typename T> bool pack8(T value) {
@@ -445,7 +646,7 @@ struct Packer {
 
 
 inline bool RefHandler::save_ref(Packer* p, PyObject *o, bool force_obj) {
-  if (o->ob_refcnt == 1) {
+  if (Py_REFCNT(o) == 1) {
     ++ref_counter;
     // there will be no reference => don't save any
     return false;
@@ -457,6 +658,8 @@ inline bool RefHandler::save_ref(Packer* p, PyObject *o, bool force_obj) {
       PyObject* i = PyInt_FromLong(++ref_counter);
       PyDict_SetItem(string_refs, o, i);
       Py_XDECREF(i);
+      if (session_objects && !is_session_string(o))
+        transient.push_back(o);
       return false;
     }
 
@@ -497,11 +700,109 @@ inline void save_float(Packer* p, PyObject* o) {
   p->pack_double(PyFloat_AS_DOUBLE(o));
 }
 
+template<typename S, typename T>
+void write_typed(Packer* p, const vector<S>& values) {
+  // writes values as little-endian T
+  vector<T> data(values.size());
+  for(size_t i = 0; i < values.size(); i++) {
+    data[i] = (T)values[i];
+    little_endian_inplace(data[i]);
+  }
+  p->write(data.data(), data.size()*sizeof(T));
+}
+
+inline void pack_typed(Packer* p, uint8_t kind, uint8_t element, size_t count) {
+  uint8_t header[2] = { kind, element };
+  p->pack_ext(TYPED_ARRAY, count*typed_itemsize(element));
+  p->write(header, sizeof(header));
+}
+
+inline bool save_typed_array(Packer* p, PyObject** items, Py_ssize_t size,
+                             uint8_t kind) {
+  /* saves a sequence of only floats or only ints as TYPED_ARRAY,
+     returns false for other sequences */
+  Py_ssize_t i;
+  PyTypeObject* type = Py_TYPE(items[0]);
+
+  if (type == &PyFloat_Type) {
+    vector<double> values(size);
+    bool narrow = true;  // float32 keeps every value
+    for(i = 0; i < size; i++) {
+      if (Py_TYPE(items[i]) != type)
+        return false;
+      double d = values[i] = PyFloat_AS_DOUBLE(items[i]);
+      if (narrow && !(fabs(d) <= FLT_MAX && (double)(float)d == d))
+        narrow = false;
+    }
+
+    if (narrow) {
+      pack_typed(p, kind, 'f', size);
+      write_typed<double, float>(p, values);
+    }
+    else {
+      pack_typed(p, kind, 'd', size);
+      write_typed<double, double>(p, values);
+    }
+    return true;
+  }
+
+  if (type == &PyLong_Type) {
+    vector<int64_t> values(size);
+    int64_t low = 0, high = 0;
+    int overflow;
+    for(i = 0; i < size; i++) {
+      if (Py_TYPE(items[i]) != type)
+        return false;
+      int64_t v = values[i] = PyLong_AsLongLongAndOverflow(items[i], &overflow);
+      if (overflow)
+        return false;
+      if (v < low) low = v;
+      if (v > high) high = v;
+    }
+
+    if (low >= INT8_MIN && high <= INT8_MAX) {
+      pack_typed(p, kind, 'b', size);
+      write_typed<int64_t, int8_t>(p, values);
+    }
+    else if (low >= 0 && high <= UINT8_MAX) {
+      pack_typed(p, kind, 'B', size);
+      write_typed<int64_t, uint8_t>(p, values);
+    }
+    else if (low >= INT16_MIN && high <= INT16_MAX) {
+      pack_typed(p, kind, 'h', size);
+      write_typed<int64_t, int16_t>(p, values);
+    }
+    else if (low >= 0 && high <= UINT16_MAX) {
+      pack_typed(p, kind, 'H', size);
+      write_typed<int64_t, uint16_t>(p, values);
+    }
+    else if (low >= INT32_MIN && high <= INT32_MAX) {
+      pack_typed(p, kind, 'i', size);
+      write_typed<int64_t, int32_t>(p, values);
+    }
+    else if (low >= 0 && high <= UINT32_MAX) {
+      pack_typed(p, kind, 'I', size);
+      write_typed<int64_t, uint32_t>(p, values);
+    }
+    else {
+      pack_typed(p, kind, 'q', size);
+      write_typed<int64_t, int64_t>(p, values);
+    }
+    return true;
+  }
+
+  return false;
+}
+
 inline void save_tuple(Packer* p, PyObject* o) {
   if (p->save_ref(o)) return;
 
   Py_ssize_t size, i;
   size = PyTuple_GET_SIZE(o);
+  if (p->protocol >= 5 && size >= MIN_TYPED_ARRAY_SIZE
+      && save_typed_array(p, ((PyTupleObject*)o)->ob_item, size, TYPED_TUPLE))
+    return;
+
   p->pack_array(size);
   for(i = 0; i < size; i++) {
     p->dump(PyTuple_GET_ITEM(o, i));
@@ -513,6 +814,10 @@ inline void save_list(Packer* p, PyObject* o) {
 
   Py_ssize_t size, i;
   size = PyList_GET_SIZE(o);
+  if (p->protocol >= 5 && size >= MIN_TYPED_ARRAY_SIZE
+      && save_typed_array(p, ((PyListObject*)o)->ob_item, size, TYPED_LIST))
+    return;
+
   p->pack_ext(LIST, size);
   for(i = 0; i < size; i++) {
     p->dump(PyList_GET_ITEM(o, i));
@@ -529,9 +834,78 @@ inline void _pack_dict(Packer* p, PyObject* o) {
   }
 }
 
+inline PyObject* get_shape(Packer* p, PyObject* o, Py_ssize_t size) {
+  /* returns the shared key tuple for a dict whose string keys were seen
+     before (borrowed), or NULL */
+  Py_ssize_t i = 0, j = 0;
+  PyObject *key, *value, *keys, *shape = p->last_shape;
+
+  // mostly the dicts have the keys of the last dict
+  if (shape && PyTuple_GET_SIZE(shape) == size) {
+    while (PyDict_Next(o, &i, &key, &value)
+           && key == PyTuple_GET_ITEM(shape, j)) j++;
+    if (j == size)
+      return shape;
+    i = j = 0;
+  }
+
+  keys = PyTuple_New(size);
+  if (!keys)
+    throw PythonError();
+
+  while (PyDict_Next(o, &i, &key, &value)) {
+    if (!PyUnicode_CheckExact(key)) {
+      Py_DECREF(keys);
+      return NULL;
+    }
+    Py_INCREF(key);
+    PyTuple_SET_ITEM(keys, j++, key);
+  }
+
+  shape = PyDict_GetItemWithError(p->shapes, keys);
+  if (!shape) {
+    if (PyErr_Occurred()
+        || (PyDict_GET_SIZE(p->shapes) < MAX_SHAPES
+            && PyDict_SetItem(p->shapes, keys, Py_None) < 0)) {
+      Py_DECREF(keys);
+      throw PythonError();
+    }
+  }
+  else if (shape == Py_None) {
+    /* the second dict with these keys, the tuple is key and value
+       (an object with refcount 1 would get no ref) */
+    if (PyDict_DelItem(p->shapes, keys) < 0
+        || PyDict_SetItem(p->shapes, keys, keys) < 0) {
+      Py_DECREF(keys);
+      throw PythonError();
+    }
+    shape = keys;
+  }
+
+  Py_DECREF(keys);
+  if (shape == Py_None)
+    return NULL;
+
+  p->last_shape = shape;
+  return shape;
+}
+
 inline void  save_dict(Packer* p, PyObject* o) {
   if (p->save_ref(o)) return;
   Py_ssize_t size = PyDict_Size(o);
+  PyObject *shape, *key, *value;
+  Py_ssize_t i = 0;
+
+  if (p->shapes && MIN_SHAPE_SIZE <= size && size <= MAX_SHAPE_SIZE
+      && (shape = get_shape(p, o, size))) {
+    p->pack_ext(SHAPE, size);
+    p->dump(shape);
+    while (PyDict_Next(o, &i, &key, &value)) {
+      p->dump(value);
+    }
+    return;
+  }
+
   p->pack_map(size);
   _pack_dict(p, o);
 }
@@ -539,7 +913,7 @@ inline void  save_dict(Packer* p, PyObject* o) {
 
 inline void save_bytes(Packer* p, PyObject* o) {
   Py_ssize_t size = PyBytes_GET_SIZE(o);
-  if (size > p->min_string_size_for_ref && p->save_ref(o)) return;
+  if ((size_t)size > p->min_string_size_for_ref && p->save_ref(o)) return;
   p->pack_ext(BYTES, size);
   p->write(PyBytes_AS_STRING(o), size);
 }
@@ -551,7 +925,7 @@ inline void save_str3(Packer* p, PyObject* o) {
   Py_ssize_t size = PyUnicode_GET_LENGTH(o);
   PyObject *encoded = NULL;
 
-  if (size > p->min_string_size_for_ref && p->save_ref(o)) return;
+  if ((size_t)size > p->min_string_size_for_ref && p->save_ref(o)) return;
 
   const char* buffer = PyUnicode_AsUTF8AndSize(o, &size);
   if (!buffer) {
@@ -598,7 +972,7 @@ inline void save_str2(Packer* p, PyObject* o) {
 
 inline void save_unicode(Packer* p, PyObject* o) {
   Py_ssize_t size = PyUnicode_GET_LENGTH(o);
-  if (size > p->min_string_size_for_ref && p->save_ref(o)) return;
+  if ((size_t)size > p->min_string_size_for_ref && p->save_ref(o)) return;
 
   PyObject *encoded = PyUnicode_AsUTF8String(o);
   if (!encoded)
@@ -3,6 +3,11 @@
 
 #include <Python.h>
 #include <stdio.h>
+#include <float.h>
+#include <math.h>
+#include <stdint.h>
+#include <algorithm>
+#include <atomic>
 
 #include <boost/container/string.hpp>
 #include <boost/container/vector.hpp>
@@ -20,6 +25,13 @@ using namespace boost::container;
 #define decode big_to_native_inplace
 
 #define MIN_STRING_SIZE_FOR_REF 3
+#define MAX_SESSION_STRING_SIZE 64
+#define MIN_SHAPE_SIZE 2     // dicts with less keys have no shape
+#define MAX_SHAPE_SIZE 64
+#define MAX_SHAPES 4096      // the shape cache of a packer
+#define MIN_TYPED_ARRAY_SIZE 8
+#define MIN_OUTPUT_SIZE 8192       // the first buffer of a StringWriter
+#define MIN_HANDOVER_SIZE 0x10000  // smaller outputs are copied
 
 enum EXT_TYPES {
   VERSION = 0,
@@ -37,6 +49,15 @@ enum EXT_TYPES {
   OBJECT_NEW_CUSTOM,
   GLOBAL_OBJECT,
   FAST_NEW,
+  BYTEARRAY,
+  OOB_BUFFER,
+  NDARRAY,
+  RECORD,
+  SESSION,
+  CHUNKED,
+  COMPRESSED,
+  SHAPE,
+  TYPED_ARRAY,
   COUNT_EXT_TYPES
 };
 
@@ -51,6 +72,45 @@ enum EXT_TYPES {
   #define PyInt_AS_LONG PyLong_AsLong
 #endif
 
+// the container of a typed array, other kinds are array.array typecodes
+enum TYPED_KINDS {
+  TYPED_LIST = 1,
+  TYPED_TUPLE = 2
+};
+
+inline size_t typed_itemsize(uint8_t element) {
+  // the elements use the standard sizes of the struct module
+  switch(element) {
+    case 'b': case 'B': return 1;
+    case 'h': case 'H': return 2;
+    case 'i': case 'I': case 'f': return 4;
+    case 'q': case 'Q': case 'd': return 8;
+  }
+  return 0;
+}
+
+template<typename T> inline void little_endian_inplace(T& value) {
+  // converts between native and little-endian order, for floats too
+  if (order::native == order::big)
+    std::reverse((char*)&value, (char*)&value + sizeof(T));
+}
+
+// the strings a session keeps for the next messages, on both sides
+inline bool is_session_string(PyObject* o) {
+  return PyUnicode_CheckExact(o) && (
+    PyUnicode_CHECK_INTERNED(o)
+    || PyUnicode_GET_LENGTH(o) <= MAX_SESSION_STRING_SIZE);
+}
+
+// counters in shared memory, written after the data they publish
+inline uint64_t shared_load(const char* address) {
+  return ((const std::atomic<uint64_t>*)address)->load(std::memory_order_acquire);
+}
+
+inline void shared_store(char* address, uint64_t value) {
+  ((std::atomic<uint64_t>*)address)->store(value, std::memory_order_release);
+}
+
 typedef int (*write_t)(PyObject* p, void* data, size_t size);
 typedef int (*read_t)(PyObject* p, void* data, size_t size);
 
@@ -75,4 +135,10 @@ inline int CPyLong_AsByteArray(PyLongObject* v, unsigned char* bytes, size_t n,
 }
 #endif
 
+#if PY_VERSION_HEX < 0x030D0000
+#define new_presized_dict _PyDict_NewPresized
+#else
+#define new_presized_dict(size) PyDict_New()
+#endif
+
 #endif
@@ -42,30 +42,84 @@ msg-pack byte type
 CHANGES TO Protocol 4
 Type OBJECT_NEW_CUSTOM is abandoned
 Type FAST_NEW is introduced and a slighly smaller footprint und loads faster
+
+CHANGES TO Protocol 5
+Type BYTEARRAY is introduced, the size field is interpreted as length
+of the raw data following the extension byte
+Type OOB_BUFFER is introduced for out of band buffers, the size field is
+interpreted as flag: 1 readonly, 2 writable
+Type NDARRAY is introduced for numpy arrays, the size field is interpreted
+as order: 1 C, 2 Fortran. It is followed by the dtype string, the shape,
+the data size, a padding byte count with the padding bytes and the raw data
+Type RECORD is introduced for record streams, it is always encoded as
+ext 32 and the size field is the length of the complete pickle that follows
+Type SESSION is introduced for session messages, it precedes the VERSION
+and the size field is interpreted as flag: 1 continue, 2 reset the session
+Type CHUNKED is introduced for big containers saved in independent chunks,
+the size field is interpreted as kind: 1 list, 2 tuple, 3 dict. It is
+followed by the chunk count and every chunk as length and complete pickle
+Type COMPRESSED is introduced for compressed pickles, the size field is
+interpreted as method: 1 zlib, 2 bz2, 3 lzma. It is followed by frames of
+compressed data, each prefixed by a 32bit big-endian length. A frame
+of length 0 terminates the compressed data.
+Type SHAPE is introduced for dicts with string keys, whose keys are
+already used by another dict of the pickle. The size field is the
+item count, it is followed by the key tuple (mostly a REF) and the values
+Type TYPED_ARRAY is introduced for lists and tuples of only ints or only
+floats and array.array. The size field is the length of the data. It is
+followed by the kind (1 list, 2 tuple or the typecode of an array), the
+element type as struct format character with standard size and the
+little-endian data
 """
+import os
 import sys
+import mmap
 import types
 import cython
 import builtins
 import operator
 import logging
-from libc.string cimport memcpy
+import math
+import array
+import itertools
+import threading
+import queue
+from libc.string cimport memcpy, memset
 from libcpp cimport bool
+from libcpp.map cimport map as cpp_map
+from cython.operator cimport dereference as deref, predecrement as dec
 from cpython.bytes cimport (
     PyBytes_FromStringAndSize, PyBytes_GET_SIZE, _PyBytes_Resize)
 from cpython.long cimport PyLong_AsLong
+from cpython.bytearray cimport PyByteArray_AS_STRING
 from cpython.tuple cimport PyTuple_GET_SIZE, PyTuple_Check, PyTuple_GET_ITEM
-from cpython.dict cimport PyObject, PyDict_GetItem, PyDict_CheckExact, PyDict_Update
+from cpython.dict cimport (
+    PyObject, PyDict_GetItem, PyDict_CheckExact, PyDict_Update, PyDict_Copy)
 from cpython.unicode cimport (
     PyUnicode_CheckExact, PyUnicode_FromObject, PyUnicode_Decode)
-from cpython.ref cimport Py_DECREF, Py_INCREF, Py_CLEAR, PyTypeObject
+from cpython.ref cimport Py_DECREF, Py_INCREF, Py_CLEAR, Py_REFCNT, PyTypeObject
 from cpython.exc cimport PyErr_Clear, PyErr_SetString, PyErr_Restore
+from cpython.buffer cimport (
+    PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE,
+    PyBUF_WRITABLE, PyBUF_READ, PyBUF_WRITE)
+from cpython.memoryview cimport PyMemoryView_FromMemory
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.pystate cimport PyThreadState_GetDict
+from pickle import PickleBuffer
+from collections.abc import Mapping, Sequence
 from . import register as pickle_register
 
 
 cdef set secure_objects = pickle_register.secure_objects
 cdef set secure_modules = pickle_register.secure_modules
 
+
+cdef inline object secure_epoch():
+    """returns the epoch of the secure sets, cached verifications are
+    only invalidated by register.changed()"""
+    return pickle_register.epoch
+
+
 logger = logging.getLogger("larch.pickle")
 
 
@@ -81,7 +135,12 @@ cdef:
 
 
 cdef object REDUCE_PROTOCOL = 4
-cdef MAX_PROTOCOL_VERSION = 4
+cdef MAX_PROTOCOL_VERSION = 5
+cdef size_t DEFAULT_BUFFER_SIZE = 0x10000
+cdef size_t DEFAULT_OOB_THRESHOLD = 0
+cdef size_t DEFAULT_ARRAY_ALIGNMENT = 64
+cdef size_t DEFAULT_SESSION_SIZE = 0x10000
+cdef size_t DEFAULT_CHUNK_SIZE = 0x10000
 
 
 cdef extern from "structmember.h":
@@ -100,9 +159,14 @@ cdef extern from "Python.h":
     char* Bytes_AS_STRING "PyBytes_AS_STRING"(object string)
     PyObject* Object_GetAttrString "PyObject_GetAttrString"(object o, char *attr_name)
 
+    ctypedef struct VersionedType "PyTypeObject":
+        # changes whenever the type or one of its bases is modified
+        unsigned int tp_version_tag
+
 cdef extern from "pickle.hpp":
     ctypedef unsigned int   uint32_t
     ctypedef unsigned char  uint8_t
+    ctypedef unsigned long long uint64_t
 
     ctypedef int (*write_t)(object pickler, void* data, size_t size) except -1
     ctypedef int (*read_t)(object unpickler, void* data, size_t size) except -1
@@ -120,7 +184,16 @@ cdef extern from "pickle.hpp":
     cdef enum EXT_TYPES:
         VERSION, LONG, REF, LIST, OBJECT, OBJECT_NEW, GLOBAL, SINGLETON,
         OLD_STYLE, INIT_ARGS, END_OBJECT_ITEMS, BYTES, UNISTR,
-        OBJECT_NEW_CUSTOM, GLOBAL_OBJECT, FAST_NEW, COUNT_EXT_TYPES
+        OBJECT_NEW_CUSTOM, GLOBAL_OBJECT, FAST_NEW, BYTEARRAY, OOB_BUFFER,
+        NDARRAY, RECORD, SESSION, CHUNKED, COMPRESSED, SHAPE, TYPED_ARRAY,
+        COUNT_EXT_TYPES
+
+    cdef enum TYPED_KINDS:
+        TYPED_LIST, TYPED_TUPLE
+
+    size_t typed_itemsize(uint8_t element)
+    uint64_t shared_load(const char* address)
+    void shared_store(char* address, uint64_t value)
 
 """
 cdef show_debug(char* msg, object o, long v):
@@ -137,8 +210,16 @@ cdef extern from "pack.hpp":
 
     cdef cppclass StringWriter:
         void reset()
-        int write(void* data, size_t size)
+        char* memory
+        size_t capacity
+        size_t used
+        size_t limit
+        void set_memory(char* data, size_t size)
+        int write(void* data, size_t size) except -1
         object result()
+        object view()
+        char* data()
+        size_t size()
 
     cdef cppclass TypeMap:
         void register_type(object key, pack_t saver)
@@ -151,10 +232,15 @@ cdef extern from "pack.hpp":
     cdef cppclass Packer:
         PyObject*  pickler
         write_t do_write
+        StringWriter *window
         int protocol
         size_t min_string_size_for_ref;
+        size_t position
 
         Packer(object pickler, int protocol, bool with_refs)
+        void set_refs(bool with_refs, bool session) except +
+        void use_shapes() except +
+        void clear_shapes()
 
         bool save_ref(object o)
         bool save_ref(object o, bool force_obj)
@@ -162,6 +248,8 @@ cdef extern from "pack.hpp":
         int first_dump(object o) except -1
 
         uint32_t reset()
+        uint32_t end_message() except +
+        uint32_t ref_count()
         void pack_version(uint8_t version) except +
         void pack_nil()
         bool pack8(uint8_t value)
@@ -194,24 +282,31 @@ cdef extern from "unpack.hpp":
         Unpacker* p, uint8_t code, size_t size)
 
     cdef unpack_t unpickle_registry[]
+    cdef PyObject* unpickling_error
 
     cdef cppclass StringReader:
         char* data
         size_t pos, size
         void read(void* bufer, size_t size)
+        size_t available()
 
     cdef cppclass Unpacker:
         PyObject *unpickler
         read_t do_read
+        StringReader *window
         size_t min_string_size_for_ref
 
         Unpacker(object unpickler)
         uint32_t reset()
+        uint32_t end_message()
         PyObject* load()
 
         object load_object"load"()
         object first_load()
 
+        const char* consume(size_t size)
+        uint32_t get_counter()
+        void set_counter(uint32_t counter)
         PyObject* get_stamped_ref(uint32_t ref)
         uint32_t get_stamp()
         void stamp(uint32_t ref, object o)
@@ -220,6 +315,16 @@ cdef extern from "unpack.hpp":
         void read32(uint32_t* value)
         void read8(uint8_t* value)
 
+    cdef cppclass Skipper:
+        const char* data
+        size_t pos, size
+        uint32_t counter
+        size_t min_string_size_for_ref
+        void skip_value() except +
+        int container(size_t& n) except +
+        void begin()
+        bool resume() except +
+
     PyObject* load_uint4(Unpacker *p, uint8_t code, size_t size)
     PyObject* load_int4(Unpacker *p, uint8_t code, size_t size)
     PyObject* load_uint8(Unpacker *p, uint8_t code, size_t size)
@@ -254,6 +359,10 @@ cdef extern from "unpack.hpp":
     PyObject* load_str16(Unpacker *p, uint8_t code, size_t size)
     PyObject* load_str32(Unpacker *p, uint8_t code, size_t size)
     PyObject* load_bytes(Unpacker* p, uint8_t code, size_t size)
+    PyObject* load_bytearray(Unpacker* p, uint8_t code, size_t size)
+    PyObject* load_shape(Unpacker* p, uint8_t code, size_t size)
+    object typed_sequence(uint8_t kind, uint8_t element,
+                          const char* data, size_t count) except +
     PyObject* load_unicode(Unpacker* p, uint8_t code, size_t size)
 
 cdef:
@@ -297,54 +406,347 @@ cdef class OutputBuffer:
     cdef bytes result(self):
         return self.writer.result()
 
+    cdef object view(self):
+        return self.writer.view()
+
 
 cdef int write_buffer(object pickler, void* data, size_t size) except -1:
     return (<OutputBuffer>(<Pickler>pickler).file).writer.write(data, size)
 
 
+cdef int write_window(object pickler, void* data, size_t size) except -1:
+    """lets the output window grow beyond its limit"""
+    return (<Pickler>pickler).packer.window.write(data, size)
+
+
+cdef inline void set_record_header(uint8_t* header, size_t size):
+    header[0] = 0xc9  # ext 32
+    header[1] = (size >> 24) & 0xFF
+    header[2] = (size >> 16) & 0xFF
+    header[3] = (size >> 8) & 0xFF
+    header[4] = size & 0xFF
+    header[5] = RECORD
+
+
+# Memory of the caller
+@cython.auto_pickle(False)
+cdef class _MemoryOutput:
+    """Writes into writable buffers of the caller: the target from an offset
+    and if it is full the continuation. Output that fits nowhere is only
+    counted."""
+    cdef:
+        StringWriter *window
+        Py_buffer target
+        Py_buffer continuation
+        bool has_target
+        bool has_continuation
+        bool continued
+        bool overflow
+        size_t target_size  # written to the target before continuing
+        size_t overflow_size  # did not fit
+
+    def __cinit__(self):
+        self.window = new StringWriter()
+
+    def __dealloc__(self):
+        self.release()
+        del self.window
+
+    cdef int set(self, buffer, size_t offset, continuation) except -1:
+        self.release()
+        PyObject_GetBuffer(buffer, &self.target, PyBUF_WRITABLE)
+        self.has_target = True
+        if offset > <size_t>self.target.len:
+            self.release()
+            raise ValueError("offset is beyond the end of the buffer")
+
+        if continuation is not None:
+            PyObject_GetBuffer(continuation, &self.continuation, PyBUF_WRITABLE)
+            self.has_continuation = True
+
+        self.window.set_memory(
+            <char*>self.target.buf + offset, self.target.len - offset)
+        self.continued = self.overflow = False
+        self.target_size = self.overflow_size = 0
+        return 0
+
+    cdef size_t size(self):
+        """the count of bytes written (or needed)"""
+        return self.target_size + self.window.used + self.overflow_size
+
+    cdef void release(self):
+        self.window.set_memory(NULL, 0)
+        if self.has_target:
+            self.has_target = False
+            PyBuffer_Release(&self.target)
+        if self.has_continuation:
+            self.has_continuation = False
+            PyBuffer_Release(&self.continuation)
+
+    cdef int write(self, char* data, size_t size) except -1:
+        """called by the packer if the window cannot take size bytes"""
+        cdef:
+            StringWriter *window = self.window
+            size_t rest = window.capacity - window.used
+
+        if self.overflow:
+            self.overflow_size += size
+            return 1
+
+        memcpy(window.memory + window.used, data, rest)
+        window.used += rest
+        data += rest
+        size -= rest
+        if self.has_continuation and not self.continued:
+            self.continued = True
+            self.target_size = window.used
+            window.set_memory(
+                <char*>self.continuation.buf, self.continuation.len)
+            if size <= window.capacity:
+                memcpy(window.memory, data, size)
+                window.used = size
+                return 1
+
+        self.overflow = True
+        self.overflow_size = size
+        window.limit = 0
+        return 1
+
+
+cdef int write_memory(object pickler, void* data, size_t size) except -1:
+    return (<_MemoryOutput>(<Pickler>pickler).file).write(<char*>data, size)
+
+
 @cython.auto_pickle(False)
 cdef class _BufferContainer:
-    cdef StringReader sreader
+    """Reads from any contiguous buffer (bytes, bytearray, memoryview, mmap...)
+    without copying it. The buffer is kept alive until release() is called."""
+    cdef:
+        StringReader sreader
+        Py_buffer view
+        bool has_view
 
-    cdef _BufferContainer set(self, bytes buffer):
-        self.sreader.data = buffer
+    def __dealloc__(self):
+        self.release()
+
+    cdef _BufferContainer set(self, object buffer):
+        self.release()
+        PyObject_GetBuffer(buffer, &self.view, PyBUF_SIMPLE)
+        self.has_view = True
+        self.sreader.data = <char*>self.view.buf
         self.sreader.pos = 0
-        self.sreader.size = len(buffer)
+        self.sreader.size = self.view.len
         return self
 
+    cdef void release(self):
+        if self.has_view:
+            self.has_view = False
+            PyBuffer_Release(&self.view)
+        self.sreader.data = NULL
+        self.sreader.pos = self.sreader.size = 0
+
 
 cdef int read_buffer(object unpickler, void* buffer, size_t size) except -1:
     (<_BufferContainer>(<Unpickler>unpickler).file).sreader.read(buffer, size)
 
 
+cdef object _map_file(file):
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # an empty file cannot be mapped
+        if os.fstat(file.fileno()).st_size:
+            raise
+        return b""
+
+
+# Shared memory
+@cython.final
+@cython.auto_pickle(False)
+cdef class _SharedCounter:
+    """A 64 bit counter at an aligned offset of a writable buffer, which may
+    be shared between processes. Loads see all writes, that preceded the
+    store of the value (acquire/release)."""
+    cdef:
+        Py_buffer view
+        char* address
+
+    def __init__(self, buffer, size_t offset):
+        PyObject_GetBuffer(buffer, &self.view, PyBUF_WRITABLE)
+        if offset + 8 > <size_t>self.view.len or (
+                <size_t>self.view.buf + offset) % 8:
+            PyBuffer_Release(&self.view)
+            raise ValueError("the counter needs 8 aligned bytes")
+        self.address = <char*>self.view.buf + offset
+
+    def __dealloc__(self):
+        self.release()
+
+    def load(self):
+        if self.address is NULL:
+            raise ValueError("the counter is released")
+        return shared_load(self.address)
+
+    def store(self, uint64_t value):
+        if self.address is NULL:
+            raise ValueError("the counter is released")
+        shared_store(self.address, value)
+
+    def release(self):
+        if self.address is not NULL:
+            self.address = NULL
+            PyBuffer_Release(&self.view)
+
+
 # Python Filelike
 @cython.auto_pickle(False)
 cdef class _FileLike:
+    """Wraps a python file object. Reads are served from a read ahead
+    buffer and writes are collected in an output buffer, both of
+    buffer_size bytes."""
     cdef:
         object write
         object read
+        object readinto
+        object seek
+        StringReader window
+        StringWriter *output
+        size_t buffer_size
+        size_t offset  # count of bytes read from the file
+
+    def __init__(self, file_like, size_t buffer_size=DEFAULT_BUFFER_SIZE):
+        self.write = getattr(file_like, "write", None)
+        self.read = getattr(file_like, "read", None)
+        # readinto1 never blocks for more data than a single raw read returns
+        self.readinto = getattr(
+            file_like, "readinto1", getattr(file_like, "readinto", None))
+        self.buffer_size = max(buffer_size, 1)
+        self.window.data = NULL
+        self.window.pos = self.window.size = 0
+        self.output = new StringWriter()
+        self.output.limit = self.buffer_size
 
-    def __init__(self, file_like):
-        self.write = file_like.write
-        self.read = file_like.read
+        try:
+            if file_like.seekable():
+                self.seek = file_like.seek
+        except Exception:
+            pass
 
+    def __dealloc__(self):
+        PyMem_Free(self.window.data)
+        del self.output
+
+    cdef int write_through(self, char* data, size_t size) except -1:
+        # a bytes copy, the file may keep the chunk
+        written = self.write(data[:size])
+        if written is not None and written != size:
+            raise OSError("short write: {} of {} bytes".format(written, size))
+        return 1
 
-cdef int write_file(object pickler, void* data, size_t size) except -1:
-    (<_FileLike>(<Pickler>pickler).file).write((<char*>data)[:size])
-    return 1
+    cdef int write_buffered(self, char* data, size_t size) except -1:
+        """called by the packer if the output buffer cannot take size bytes"""
+        self.flush()
+        if size >= self.buffer_size:
+            # big chunks are written directly
+            return self.write_through(data, size)
 
+        self.output.write(data, size)
+        return 1
+
+    cdef int flush(self) except -1:
+        if self.output.size():
+            try:
+                self.write_through(self.output.data(), self.output.size())
+            finally:
+                self.output.reset()
+        return 0
+
+    cdef size_t fill(self, char* data, size_t size) except? 0:
+        """reads at most size bytes from the file into data"""
+        cdef:
+            bytes b
+            size_t rsize
+
+        if self.readinto is not None:
+            rsize = self.readinto(
+                PyMemoryView_FromMemory(data, size, PyBUF_WRITE)) or 0
+        else:
+            b = self.read(size)
+            rsize = PyBytes_GET_SIZE(b)
+            memcpy(data, Bytes_AS_STRING(b), rsize)
+        self.offset += rsize
+        return rsize
+
+    cdef int read_buffered(self, char* data, size_t size) except -1:
+        """called by the unpacker if the window cannot serve size bytes"""
+        cdef size_t rsize = self.window.available()
+
+        if rsize:
+            memcpy(data, self.window.data + self.window.pos, rsize)
+            data += rsize
+            size -= rsize
+        self.window.pos = self.window.size = 0
+
+        while size >= self.buffer_size:
+            # big chunks are read directly
+            rsize = self.fill(data, size)
+            if not rsize:
+                raise EOFError()
+            data += rsize
+            size -= rsize
+
+        self.alloc_window()
+        while size:
+            rsize = self.fill(self.window.data, self.buffer_size)
+            if not rsize:
+                raise EOFError()
+            self.window.size = rsize
+            self.window.pos = min(size, rsize)
+            memcpy(data, self.window.data, self.window.pos)
+            data += self.window.pos
+            size -= self.window.pos
+        return 1
+
+    cdef int alloc_window(self) except -1:
+        if self.window.data is NULL:
+            self.window.data = <char*>PyMem_Malloc(self.buffer_size)
+            if self.window.data is NULL:
+                raise MemoryError()
+        return 0
+
+    cdef int at_end(self) except -1:
+        """returns 1 if the file has no more data to read"""
+        if self.window.available():
+            return 0
+
+        self.alloc_window()
+        self.window.pos = 0
+        self.window.size = self.fill(self.window.data, self.buffer_size)
+        return self.window.size == 0
+
+    cdef size_t tell(self):
+        """returns the count of consumed bytes"""
+        return self.offset - self.window.available()
+
+    cdef int sync(self) except -1:
+        """moves the file position back to the end of the consumed data.
+        Unseekable files keep the unconsumed data for the next load."""
+        cdef size_t rsize = self.window.available()
+        if self.seek is not None and rsize:
+            self.seek(-<Py_ssize_t>rsize, 1)
+            self.offset -= rsize
+            self.window.pos = self.window.size = 0
+        return 0
 
-cdef int read_file(object unpickler, void* data, size_t size) except -1:
-    cdef:
-        _FileLike f = (<Unpickler>unpickler).file
-        bytes b = f.read(size)
-        size_t rsize = PyBytes_GET_SIZE(b)
 
-    if rsize != size:
-        raise EOFError()
+cdef int write_file(object pickler, void* data, size_t size) except -1:
+    return (<_FileLike>(<Pickler>pickler).file).write_buffered(
+        <char*>data, size)
+
 
-    memcpy(data, Bytes_AS_STRING(b), rsize)
-    return 1
+cdef int read_file(object unpickler, void* data, size_t size) except -1:
+    return (<_FileLike>(<Unpickler>unpickler).file).read_buffered(
+        <char*>data, size)
 
 # External (cython) filelike
 @cython.auto_pickle(False)
@@ -364,6 +766,239 @@ cdef int read_external(object unpickler, void* data, size_t size) except -1:
     return ef.read(ef.file, data, size)
 
 
+# Compression
+# ------------------------------
+
+COMPRESSION_METHODS = {"zlib": 1, "bz2": 2, "lzma": 3}
+
+
+cdef object _new_compressor(uint8_t method):
+    if method == 1:
+        import zlib
+        return zlib.compressobj()
+    if method == 2:
+        import bz2
+        return bz2.BZ2Compressor()
+    import lzma
+    return lzma.LZMACompressor()
+
+
+cdef object _new_decompressor(uint8_t method):
+    if method == 1:
+        import zlib
+        return zlib.decompressobj()
+    if method == 2:
+        import bz2
+        return bz2.BZ2Decompressor()
+    if method == 3:
+        import lzma
+        return lzma.LZMADecompressor()
+    raise UnpicklingError("unknown compression")
+
+
+@cython.auto_pickle(False)
+cdef class _Compressor:
+    """Collects the packer output in frames of frame_size bytes and
+    writes them compressed to the original output."""
+    cdef:
+        uint8_t method
+        object compressor
+        StringWriter *window
+        StringWriter *sink
+        write_t do_write
+        bool active
+
+    def __init__(self, uint8_t method, size_t frame_size):
+        self.method = method
+        self.window = new StringWriter()
+        self.window.limit = max(frame_size, 1)
+
+    def __dealloc__(self):
+        del self.window
+
+    cdef int start(self, Packer* p) except -1:
+        self.compressor = _new_compressor(self.method)
+        self.window.reset()
+        self.sink = p.window
+        self.do_write = p.do_write
+        p.window = self.window
+        p.do_write = write_compressed
+        self.active = True
+        return 0
+
+    cdef int stop(self, Packer* p) except -1:
+        if self.active:
+            self.active = False
+            p.window = self.sink
+            p.do_write = self.do_write
+            self.compressor = None
+        return 0
+
+    cdef int finish(self, Packer* p) except -1:
+        cdef uint32_t terminator = 0
+
+        self.compress(p, self.window.data(), self.window.size())
+        self.emit(p, self.compressor.flush())
+        self.stop(p)
+        p.write_int(terminator)
+        return 0
+
+    cdef int compress(self, Packer* p, char* data, size_t size) except -1:
+        if size:
+            self.emit(p, self.compressor.compress(
+                PyMemoryView_FromMemory(data, size, PyBUF_READ)))
+        return 0
+
+    cdef int emit(self, Packer* p, bytes frame) except -1:
+        """writes a frame to the original output"""
+        cdef:
+            size_t position = p.position
+            uint32_t size = PyBytes_GET_SIZE(frame)
+
+        if not size:
+            return 0
+
+        p.window = self.sink
+        p.do_write = self.do_write
+        try:
+            p.write_int(size)
+            p.write(Bytes_AS_STRING(frame), size)
+        finally:
+            p.window = self.window
+            p.do_write = write_compressed
+            # the position counts uncompressed data
+            p.position = position
+        return 0
+
+    cdef int write(self, Packer* p, char* data, size_t size) except -1:
+        """called by the packer if the window is full"""
+        self.compress(p, self.window.data(), self.window.size())
+        self.window.reset()
+        if size >= self.window.limit:
+            self.compress(p, data, size)
+        else:
+            self.window.write(data, size)
+        return 1
+
+
+cdef int write_compressed(object pickler, void* data, size_t size) except -1:
+    return (<Pickler>pickler).compressor.write(
+        (<Pickler>pickler).packer, <char*>data, size)
+
+
+@cython.auto_pickle(False)
+cdef class _Decompressor:
+    """Reads the compressed frames from the original input and serves
+    the decompressed data by the window."""
+    cdef:
+        object decompressor
+        bool zlib
+        bytes data  # the decompressed data of the window
+        bytes tail  # compressed data not yet decompressed by zlib
+        bool eof
+        size_t frame_size
+        StringReader window
+        StringReader *source
+        read_t do_read
+
+    def __init__(self, uint8_t method, size_t frame_size):
+        self.decompressor = _new_decompressor(method)
+        self.zlib = method == 1
+        self.tail = b""
+        self.frame_size = max(frame_size, 1)
+
+    cdef int start(self, Unpacker* p) except -1:
+        self.source = p.window
+        self.do_read = p.do_read
+        self.window.data = NULL
+        self.window.pos = self.window.size = 0
+        p.window = &self.window
+        p.do_read = read_decompressed
+        return 0
+
+    cdef int stop(self, Unpacker* p) except -1:
+        p.window = self.source
+        p.do_read = self.do_read
+        return 0
+
+    cdef int finish(self, Unpacker* p) except -1:
+        """consumes the rest of the compressed data"""
+        if self.window.available() or self.decompress(p):
+            raise UnpicklingError("unexpected data after the pickle")
+        return 0
+
+    cdef bytes read_frame(self, Unpacker* p):
+        cdef:
+            uint32_t size
+            bytes frame
+
+        p.window = self.source
+        p.do_read = self.do_read
+        try:
+            p.read32(&size)
+            if not size:
+                return None
+
+            frame = PyBytes_FromStringAndSize(NULL, size)
+            p.read(Bytes_AS_STRING(frame), size)
+            return frame
+        finally:
+            p.window = &self.window
+            p.do_read = read_decompressed
+
+    cdef bytes decompress(self, Unpacker* p):
+        """returns the next decompressed data, an empty bytes
+        object at the end"""
+        while not self.eof:
+            if self.zlib:
+                need_frame = not self.tail
+            else:
+                need_frame = self.decompressor.needs_input
+            if need_frame or self.decompressor.eof:
+                data = self.read_frame(p)
+                if data is None:
+                    self.eof = True
+                    break
+                if self.decompressor.eof:
+                    raise UnpicklingError("unexpected data after the pickle")
+            else:
+                data = self.tail
+
+            result = self.decompressor.decompress(data, self.frame_size)
+            if self.zlib:
+                self.tail = self.decompressor.unconsumed_tail
+            if result:
+                return result
+
+        if not self.decompressor.eof:
+            raise UnpicklingError("compressed data is truncated")
+        return b""
+
+    cdef int read(self, Unpacker* p, char* data, size_t size) except -1:
+        """called by the unpacker if the window cannot serve size bytes"""
+        cdef size_t rsize
+
+        while size:
+            rsize = min(self.window.available(), size)
+            memcpy(data, self.window.data + self.window.pos, rsize)
+            self.window.pos += rsize
+            data += rsize
+            size -= rsize
+            if size:
+                self.data = self.decompress(p)
+                if not self.data:
+                    raise EOFError()
+                self.window.data = Bytes_AS_STRING(self.data)
+                self.window.pos = 0
+                self.window.size = PyBytes_GET_SIZE(self.data)
+        return 1
+
+
+cdef int read_decompressed(object unpickler, void* data, size_t size) except -1:
+    return (<Unpickler>unpickler).decompressor.read(
+        (<Unpickler>unpickler).unpacker, <char*>data, size)
+
+
 @pickle_register.secure_unpickle
 class PickleError(Exception):
     pass
@@ -374,10 +1009,24 @@ class PicklingError(PickleError):
     pass
 
 
+@pickle_register.secure_unpickle
+class BufferTooSmallError(PicklingError):
+    """Raised by Pickler.dumps_into(), required is the size of the pickle."""
+    def __init__(self, required):
+        super().__init__(required)
+        self.required = required
+
+    def __str__(self):
+        return "the buffer is too small, the pickle needs {} bytes".format(
+            self.required)
+
+
 @pickle_register.secure_unpickle
 class UnpicklingError(PickleError):
     pass
 
+unpickling_error = <PyObject*>UnpicklingError
+
 
 @pickle_register.secure_unpickle
 class SecurityError(UnpicklingError):
@@ -432,7 +1081,12 @@ cdef void save_long(Packer* p, object o) noexcept:
 
 
 cdef inline int _save_global(Packer* p, object o) except -1:
-    (<Pickler>p.pickler).pack_import1(GLOBAL, o)
+    if (<Pickler>p.pickler).session_size:
+        # a session keeps the classes referenceable
+        if p.save_ref(o, 1): return 0
+        (<Pickler>p.pickler).pack_import1(GLOBAL_OBJECT, o)
+    else:
+        (<Pickler>p.pickler).pack_import1(GLOBAL, o)
 
 
 cdef void save_global(Packer* p, object o) noexcept:
@@ -568,8 +1222,132 @@ cdef inline int _fast_save_finish(Packer* p, o, state) except -1:
                         "Cannot pickle object with more then 5 reduce items")
 
 
+# Encode Plans
+# ------------------------------
+# Most classes are pickled by object.__reduce_ex__, their state is the
+# __dict__, the __slots__ or the result of __getstate__. For those the
+# state is computed directly, without the reduce tuple.
+
+cdef enum PLAN_KIND:
+    PLAN_DICT = 1
+    PLAN_SLOTS
+    PLAN_GETSTATE
+
+
+@cython.auto_pickle(False)
+cdef class _EncodePlan:
+    cdef:
+        PLAN_KIND kind
+        unsigned int version  # tp_version_tag of the class
+        list slotnames
+
+
+cdef dict _encode_plans = {}
+cdef object _object_reduce_ex = object.__reduce_ex__
+cdef object _object_reduce = object.__reduce__
+cdef object _object_getstate = getattr(object, "__getstate__", None)
+cdef object _newobj = copyreg.__newobj__
+
+
+cdef object _plan_state(_EncodePlan plan, o):
+    cdef dict slots
+
+    if plan.kind == PLAN_GETSTATE:
+        return o.__getstate__()
+
+    state = getattr(o, "__dict__", None)
+    if not state:
+        state = None
+
+    if plan.kind == PLAN_SLOTS:
+        slots = {}
+        for name in plan.slotnames:
+            try:
+                slots[name] = getattr(o, name)
+            except AttributeError:
+                pass
+        if slots:
+            state = (state, slots)
+    return state
+
+
+cdef _EncodePlan _make_plan(o, tuple reduced):
+    """returns a plan for the class of o, if reduced (the result of
+    o.__reduce_ex__) can be computed without __reduce_ex__"""
+    cdef:
+        _EncodePlan plan = _EncodePlan()
+        type cls = type(o)
+
+    if (PyTuple_GET_SIZE(reduced) != 5
+            or reduced[0] is not _newobj
+            or reduced[1] != (cls,)
+            or reduced[3] is not None
+            or reduced[4] is not None
+            or cls.__reduce_ex__ is not _object_reduce_ex
+            or cls.__reduce__ is not _object_reduce
+            or hasattr(cls, "__getnewargs_ex__")
+            or hasattr(cls, "__getnewargs__")
+            or issubclass(cls, (list, dict))):
+        return None
+
+    if getattr(cls, "__getstate__", _object_getstate) is not _object_getstate:
+        plan.kind = PLAN_GETSTATE
+    else:
+        plan.slotnames = copyreg._slotnames(cls)
+        plan.kind = PLAN_SLOTS if plan.slotnames else PLAN_DICT
+        state = _plan_state(plan, o)
+        if not (state is reduced[2] or (plan.kind == PLAN_SLOTS
+                                        and state == reduced[2])):
+            return None
+
+    plan.version = (<VersionedType*>cls).tp_version_tag
+    if not plan.version:
+        return None
+
+    _encode_plans[cls] = plan
+    return plan
+
+
+cdef inline int _save_planned(Packer* p, o) except -1:
+    cdef:
+        type cls = type(o)
+        # a strong reference, _plan_state may replace the plan
+        _EncodePlan plan = _encode_plans.get(cls)
+
+    if plan is None or plan.version != (<VersionedType*>cls).tp_version_tag:
+        # the class changed
+        return _save_object(p, o)
+
+    if p.save_ref(o, 1): return 0
+    state = _plan_state(plan, o)
+    if p.protocol < 4:
+        p.pack_ext(OBJECT_NEW, 1)
+        p.dump((cls,))
+        p.dump(state)
+        p.pack_ext(END_OBJECT_ITEMS, 1)
+        p.pack_ext(END_OBJECT_ITEMS, 1)
+    else:
+        p.pack_ext(FAST_NEW, 2 if state is None else 3)
+        p.dump((cls,))
+        if state is not None:
+            p.dump(state)
+    return 0
+
+
+cdef void save_planned(Packer* p, object o) noexcept:
+    try:
+        _save_planned(p, o)
+    except:
+        reraise()
+
+
 cdef int _save__newobj__(Packer* p, object o, state) except -1:
-    register_type(o, save_new_object)
+    if _make_plan(o, state) is not None:
+        register_type(o, save_planned)
+    else:
+        _encode_plans.pop(type(o), None)
+        register_type(o, save_new_object)
+
     if p.protocol < 4:
         return _save_new_object_finish(p, o, state)
     else:
@@ -581,6 +1359,11 @@ cdef inline int _save_object(Packer* p, object o) except -1:
         PyObject *reduce_func
         pack_t next_save_func = NULL
 
+    if numpy is None and type(o).__module__ == "numpy":
+        _import_numpy()
+        if type(o) is numpy.ndarray:
+            return _save_ndarray(p, o)
+
     if p.save_ref(o, 1) > 0:
         return 0
 
@@ -662,6 +1445,164 @@ save_string_ptr = save_str3
 register_type(bytes(), save_bytes)
 
 
+cdef int _save_buffer(Packer* p, object o) except -1:
+    cdef:
+        Pickler pickler = <Pickler>p.pickler
+        Py_buffer view
+        bool readonly
+
+    if p.protocol < 5:
+        # the old way: bytearray is reduced, buffer views cannot be saved
+        return _save_reduced(p, o)
+
+    try:
+        PyObject_GetBuffer(o, &view, PyBUF_SIMPLE)
+    except BufferError as e:
+        raise PicklingError("Cannot save {!r}: {}".format(o, e))
+
+    try:
+        readonly = view.readonly
+        # readonly buffers are saved like bytes and follow their ref rules
+        if ((not readonly or <size_t>view.len > p.min_string_size_for_ref)
+                and p.save_ref(o)):
+            return 0
+
+        # like python's pickle only PickleBuffer objects go out of band,
+        # bytearray and memoryview are loaded with their own type
+        if (type(o) is PickleBuffer and pickler.buffer_callback is not None
+                and <size_t>view.len >= pickler.oob_threshold
+                and not pickler.buffer_callback(o)):
+            p.pack_ext(OOB_BUFFER, 1 if readonly else 2)
+            return 0
+
+        if readonly:
+            p.pack_ext(BYTES, view.len)
+        else:
+            p.pack_ext(BYTEARRAY, view.len)
+        p.write(view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+
+    return 0
+
+
+cdef void save_buffer(Packer* p, object o) noexcept:
+    try:
+        _save_buffer(p, o)
+    except:
+        reraise()
+
+register_type(bytearray(), save_buffer)
+register_type(memoryview(b""), save_buffer)
+register_type(PickleBuffer(b""), save_buffer)
+
+
+# NumPy arrays
+# ------------------------------
+
+cdef object numpy = None
+cdef char[256] padding
+memset(padding, 0, sizeof(padding))
+
+
+cdef object _import_numpy():
+    """imports numpy on demand and registers the ndarray codec"""
+    global numpy
+    import numpy as _numpy
+    numpy = _numpy
+    pickle_registry.register_type(numpy.ndarray, save_ndarray)
+    return numpy
+
+
+cdef int _save_ndarray(Packer* p, object o) except -1:
+    cdef:
+        Py_buffer view
+        uint8_t pad
+        bool fortran
+
+    dtype = o.dtype
+    if p.protocol < 5 or dtype.hasobject or dtype.fields is not None:
+        return _save_reduced(p, o)
+
+    if p.save_ref(o): return 0
+
+    # only contiguous data is saved, the strides follow from the order
+    fortran = not o.flags.c_contiguous and o.flags.f_contiguous
+    data = o.T if fortran else o
+    if not data.flags.c_contiguous:
+        data = numpy.ascontiguousarray(data)
+
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    try:
+        p.pack_ext(NDARRAY, 2 if fortran else 1)
+        p.dump(dtype.str)
+        p.dump(o.shape)
+        p.dump(view.len)
+        pad = -(p.position + 1) & ((<Pickler>p.pickler).array_alignment - 1)
+        p.write(&pad, 1)
+        p.write(padding, pad)
+        p.write(view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+
+    return 0
+
+
+cdef void save_ndarray(Packer* p, object o) noexcept:
+    try:
+        _save_ndarray(p, o)
+    except:
+        reraise()
+
+
+# array typecode -> element type of TYPED_ARRAY
+cdef dict _array_elements = {}
+for _typecode in "bBhHiIlLqQfd":
+    _element = "bhiq"[(array.array(_typecode).itemsize).bit_length() - 1]
+    if _typecode in "fd":
+        _element = _typecode
+    elif _typecode.isupper():
+        _element = _element.upper()
+    _array_elements[_typecode] = ord(_element)
+
+
+cdef int _save_array(Packer* p, object o) except -1:
+    cdef:
+        Py_buffer view
+        uint8_t header[2]
+        PyObject* element = PyDict_GetItem(_array_elements, o.typecode)
+
+    if p.protocol < 5 or element is NULL:
+        return _save_reduced(p, o)
+
+    if p.save_ref(o): return 0
+
+    if sys.byteorder != "little":
+        o = array.array(o.typecode, o)
+        o.byteswap()
+
+    header[0] = ord(o.typecode)
+    header[1] = <object>element
+    PyObject_GetBuffer(o, &view, PyBUF_SIMPLE)
+    try:
+        p.pack_ext(TYPED_ARRAY, view.len)
+        p.write(header, 2)
+        p.write(view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+    return 0
+
+
+cdef void save_array(Packer* p, object o) noexcept:
+    try:
+        _save_array(p, o)
+    except:
+        reraise()
+
+
+register_type(array.array("b"), save_array)
+
+
 # The Pickler class and its utilities
 # -----------------------------------
 
@@ -692,11 +1633,22 @@ cdef class Pickler:
         Packer *packer
         uint8_t protocol
         pack_import_names_t pack_import_names
+        object buffer_callback
+        size_t oob_threshold
+        size_t array_alignment
+        OutputBuffer record_buffer
+        _MemoryOutput memory_output  # for dumps_into
+        size_t session_size  # 0 without session
+        bool session_reset
+        _Compressor compressor
         public dict dispatch_table
         public uint32_t last_refcount
 
     def __init__(
-        self, file=None, protocol=MAX_PROTOCOL_VERSION, with_refs=True):
+        self, file=None, protocol=MAX_PROTOCOL_VERSION, with_refs=True,
+        size_t buffer_size=DEFAULT_BUFFER_SIZE, buffer_callback=None,
+        size_t oob_threshold=DEFAULT_OOB_THRESHOLD, bool session=False,
+        size_t session_size=DEFAULT_SESSION_SIZE, compression=None):
         if protocol < 0: protocol = MAX_PROTOCOL_VERSION
         protocol = min(protocol, MAX_PROTOCOL_VERSION)
         self.protocol = protocol
@@ -707,24 +1659,64 @@ cdef class Pickler:
 
         self.packer = new Packer(self, protocol, with_refs)
         self.dispatch_table = dispatch_table
+        self.array_alignment = DEFAULT_ARRAY_ALIGNMENT
         if protocol < 4:
             self.packer.min_string_size_for_ref = 5;
         else:
             self.packer.min_string_size_for_ref = 3;
+        if protocol >= 5 and with_refs:
+            self.packer.use_shapes()
+
+        if compression is not None:
+            if compression not in COMPRESSION_METHODS:
+                raise ValueError("unknown compression {!r}".format(compression))
+            self.compressor = _Compressor(
+                COMPRESSION_METHODS[compression], buffer_size)
+
+        if session:
+            if not with_refs:
+                raise ValueError("a session needs with_refs")
+            self.packer.set_refs(True, True)
+            self.session_size = max(session_size, 1)
+            self.session_reset = True
+
+        if buffer_callback is not None:
+            if protocol < 5:
+                raise ValueError(
+                    "buffer_callback needs protocol 5 or higher")
+            self.buffer_callback = buffer_callback
+            self.oob_threshold = oob_threshold
 
         if file is None:
             self.file = OutputBuffer()
             self.packer.do_write = write_buffer
+            self.packer.window = (<OutputBuffer>self.file).writer
         elif hasattr(file, "c_pickle"):
             self.file = file.c_pickle()
             self.packer.do_write = write_external
         else:
-            self.file = _FileLike(file)
+            self.file = _FileLike(file, buffer_size)
             self.packer.do_write = write_file
+            self.packer.window = (<_FileLike>self.file).output
+            if (<_FileLike>self.file).seek is not None:
+                # align arrays to the file offset
+                self.packer.position = file.tell()
 
     def __dealloc__(self):
         del self.packer
 
+    @property
+    def array_alignment(self):
+        """The raw data of numpy arrays is aligned to this count of bytes
+        from the start of the output."""
+        return self.array_alignment
+
+    @array_alignment.setter
+    def array_alignment(self, size_t value):
+        if not 0 < value <= 256 or value & (value - 1):
+            raise ValueError("array_alignment must be a power of 2 <= 256")
+        self.array_alignment = value
+
     cdef int pack_import1(self, uint8_t code, o) except -1:
         self.pack_import2(code, o.__module__, o.__qualname__)
 
@@ -745,31 +1737,317 @@ cdef class Pickler:
                 "Pickler.__init__() was not called by "
                 "{}.__init__()".format((self.__class__.__qualname__,)))
 
-    def dump(self, obj, bool with_version=True):
-        self.check_init()
+    cdef int begin_message(self, bool with_version) except -1:
+        if self.compressor is not None:
+            self.packer.pack_ext(COMPRESSED, self.compressor.method)
+            self.compressor.start(self.packer)
+
+        if self.session_size:
+            if (self.session_reset
+                    or self.packer.ref_count() >= self.session_size):
+                self.packer.reset()
+                self.session_reset = False
+                self.packer.pack_ext(SESSION, 2)
+            else:
+                self.packer.pack_ext(SESSION, 1)
+
         if with_version:
             self.packer.pack_version(self.protocol)
+        return 0
+
+    cdef int end_message(self, bool failed) except -1:
+        if self.compressor is not None:
+            if failed:
+                self.compressor.stop(self.packer)
+            else:
+                try:
+                    self.compressor.finish(self.packer)
+                except:
+                    self.end_message(True)
+                    raise
+
+        if failed:
+            self.last_refcount = self.packer.reset()
+            # the unpickler will not see this message
+            self.session_reset = True
+        else:
+            self.last_refcount = self.packer.end_message()
+        return 0
+
+    def reset_session(self):
+        """Forgets the references of the session, the next message
+        tells the unpickler to reset its session too."""
+        self.packer.reset()
+        self.session_reset = True
+
+    def dump(self, obj, bool with_version=True):
+        """Pickles obj to the file. If pickling fails, the pending output
+        is discarded; the parts already written to the file (output
+        larger than buffer_size) stay there."""
+        self.check_init()
         try:
+            self.begin_message(with_version)
             self.packer.first_dump(obj)
-        finally:
-            self.last_refcount = self.packer.reset()
+        except:
+            if isinstance(self.file, _FileLike):
+                # don't write a half pickled object
+                (<_FileLike>self.file).output.reset()
+            self.end_message(True)
+            raise
+
+        self.end_message(False)
+        self.flush()
+        return self
+
+    def dump_many(self, objects):
+        """Appends every object of `objects` as length framed record.
+        The records can be read with Unpickler.iter_load."""
+        self.check_init()
+        for obj in objects:
+            self.dump_record(obj)
+
+        self.flush()
         return self
 
+    cdef int dump_record(self, obj) except -1:
+        cdef:
+            write_t do_write = self.packer.do_write
+            StringWriter *window = self.packer.window
+            size_t position = self.packer.position
+            size_t start
+            uint8_t header[6]
+            size_t size
+
+        if do_write is not write_file and do_write is not write_buffer:
+            return self.dump_record_copy(obj)
+
+        # the record is pickled into the output window after a header,
+        # the window grows until the length is known
+        start = window.size()
+        self.packer.do_write = write_window
+        try:
+            self.packer.write(header, sizeof(header))
+            self.begin_message(True)
+            self.packer.first_dump(obj)
+        except:
+            window.used = start
+            self.packer.position = position
+            self.end_message(True)
+            raise
+        else:
+            self.end_message(False)
+        finally:
+            self.packer.do_write = do_write
+
+        size = window.size() - start - sizeof(header)
+        if size > 0xFFFFFFFF:
+            window.used = start
+            self.packer.position = position
+            raise PicklingError("record is too big")
+
+        set_record_header(<uint8_t*>window.data() + start, size)
+        if window.size() > window.limit:
+            (<_FileLike>self.file).flush()
+        return 0
+
+    cdef int dump_record_copy(self, obj) except -1:
+        """dumps a record to an output without a growable window"""
+        cdef:
+            object file = self.file
+            write_t do_write = self.packer.do_write
+            StringWriter *window = self.packer.window
+            size_t position = self.packer.position
+            StringWriter *record
+            uint8_t header[6]
+            size_t size
+
+        if self.record_buffer is None:
+            self.record_buffer = OutputBuffer()
+
+        # the record is pickled into a buffer to get the length
+        self.record_buffer.reset()
+        record = self.record_buffer.writer
+        self.file = self.record_buffer
+        self.packer.do_write = write_buffer
+        self.packer.window = record
+        self.packer.position = position + sizeof(header)
+        try:
+            self.begin_message(True)
+            self.packer.first_dump(obj)
+        except:
+            self.end_message(True)
+            raise
+        else:
+            self.end_message(False)
+        finally:
+            self.file = file
+            self.packer.do_write = do_write
+            self.packer.window = window
+            self.packer.position = position
+
+        size = record.size()
+        if size > 0xFFFFFFFF:
+            raise PicklingError("record is too big")
+
+        set_record_header(header, size)
+        self.packer.write(header, sizeof(header))
+        self.packer.write(record.data(), size)
+        return 0
+
+    def flush(self):
+        """Writes the buffered output to the file."""
+        if isinstance(self.file, _FileLike):
+            (<_FileLike>self.file).flush()
+
     def dumps(self, obj, bool with_version=True):
         self.check_init()
+        return self.dump_string(obj, with_version)
+
+    cdef bytes dump_string(self, obj, bool with_version):
         (<OutputBuffer>self.file).reset()
-        if with_version:
-            self.packer.pack_version(self.protocol)
+        self.packer.position = 0
         try:
+            self.begin_message(with_version)
             self.packer.first_dump(obj)
-        finally:
-            self.last_refcount = self.packer.reset()
+        except:
+            self.end_message(True)
+            raise
 
+        self.end_message(False)
         return self.get_output_string()
 
+    def iter_dump(self, obj, size_t chunk_size=DEFAULT_BUFFER_SIZE,
+                  bool with_version=True):
+        """Yields the pickle of obj in chunks of at most chunk_size bytes.
+        The pickler works in a thread, which waits while two chunks are
+        not consumed. The pickler must not be used until the iteration
+        ends."""
+        cdef _ChunkSink sink = _ChunkSink(max(chunk_size, 1))
+
+        worker = self._start_dump(obj, sink, with_version)
+        try:
+            while True:
+                chunk = sink.chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            sink.cancelled = True
+            while worker.is_alive():
+                # unblock the worker
+                try:
+                    sink.chunks.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            worker.join()
+
+        if sink.error is not None:
+            raise sink.error
+
+    def _start_dump(self, obj, _ChunkSink sink, bool with_version):
+        """pickles obj in a worker thread, which puts the chunks and at
+        last None into sink.chunks"""
+        self.check_init()
+        worker = threading.Thread(
+            target=self._dump_chunks, args=(obj, sink, with_version),
+            name="larch.pickle.iter_dump", daemon=True)
+        worker.start()
+        return worker
+
+    def _dump_chunks(self, obj, _ChunkSink sink, bool with_version):
+        cdef:
+            object file = self.file
+            write_t do_write = self.packer.do_write
+            StringWriter *window = self.packer.window
+            size_t position = self.packer.position
+            _FileLike output = _FileLike(sink, sink.chunk_size)
+
+        self.file = output
+        self.packer.do_write = write_file
+        self.packer.window = output.output
+        self.packer.position = 0
+        try:
+            try:
+                self.begin_message(with_version)
+                self.packer.first_dump(obj)
+            except:
+                self.end_message(True)
+                raise
+            self.end_message(False)
+            output.flush()
+        except BaseException as e:
+            sink.error = e
+        finally:
+            self.file = file
+            self.packer.do_write = do_write
+            self.packer.window = window
+            self.packer.position = position
+            sink.chunks.put(None)
+
+    def dump_to(self, obj, writer, size_t chunk_size=DEFAULT_BUFFER_SIZE):
+        """Returns a coroutine, that writes the pickle of obj in chunks to
+        the asyncio.StreamWriter writer and awaits writer.drain() after
+        every chunk."""
+        from .aio import dump_to
+        return dump_to(self, obj, writer, chunk_size)
+
+    def dumps_into(self, obj, buffer, size_t offset=0, continuation=None,
+                   bool with_version=True):
+        """Pickles obj directly into the writable buffer from offset on and
+        returns the size of the pickle. If the buffer is full, the rest is
+        written to the start of continuation. BufferTooSmallError is raised,
+        if the pickle does not fit."""
+        cdef:
+            object file = self.file
+            write_t do_write = self.packer.do_write
+            StringWriter *window = self.packer.window
+            size_t position = self.packer.position
+            size_t size
+            _MemoryOutput output
+
+        self.check_init()
+        if self.memory_output is None:
+            self.memory_output = _MemoryOutput()
+        output = self.memory_output
+        output.set(buffer, offset, continuation)
+        self.file = output
+        self.packer.do_write = write_memory
+        self.packer.window = output.window
+        self.packer.position = 0
+        try:
+            try:
+                self.begin_message(with_version)
+                self.packer.first_dump(obj)
+            except:
+                self.end_message(True)
+                raise
+            self.end_message(False)
+            size = output.size()
+        finally:
+            self.file = file
+            self.packer.do_write = do_write
+            self.packer.window = window
+            self.packer.position = position
+            output.release()
+
+        if output.overflow:
+            # the unpickler will not see this message
+            self.packer.reset()
+            self.session_reset = True
+            raise BufferTooSmallError(size)
+        return size
+
     cpdef bytes get_output_string(self):
         return (<OutputBuffer>self.file).result()
 
+    def get_output_view(self):
+        """Returns a read only memoryview of the output without copying it.
+        The view stays valid, the next dumps() writes to a new buffer."""
+        self.check_init()
+        if not isinstance(self.file, OutputBuffer):
+            raise PicklingError("the pickler writes to a file")
+        return (<OutputBuffer>self.file).view()
+
 
 # Unpickler Functions
 # ----------------------------------
@@ -860,6 +2138,68 @@ cdef object load_object_new(Unpacker *p, uint8_t code, size_t size):
     return _load_object(p, obj)
 
 
+cdef class _LoadPlan:
+    cdef:
+        unsigned int version  # tp_version_tag of the class
+        bint generic  # the state needs _load_state
+        object setstate  # the __setstate__ function of the class or None
+        bint own_dict  # a dict state was the instance dict
+
+
+cdef dict _load_plans = {}
+cdef object _object_getattribute = object.__getattribute__
+
+
+cdef _LoadPlan _make_load_plan(type cls):
+    cdef _LoadPlan plan = _LoadPlan()
+
+    plan.setstate = getattr(cls, "__setstate__", None)
+    plan.generic = (
+        # __setstate__ could be an attribute of the instance
+        hasattr(cls, "__getattr__")
+        or cls.__getattribute__ is not _object_getattribute
+        or (plan.setstate is not None
+            and type(plan.setstate) is not types.FunctionType))
+
+    # the pickler saves the instance dict as state
+    plan.own_dict = (
+        not plan.generic and plan.setstate is None
+        and GET_NEW(cls) == GET_NEW(object)
+        and cls.__dictoffset__ != 0
+        and cls.__reduce_ex__ is _object_reduce_ex
+        and cls.__reduce__ is _object_reduce
+        and getattr(cls, "__getstate__", _object_getstate) is _object_getstate
+        and not copyreg._slotnames(cls))
+
+    plan.version = (<VersionedType*>cls).tp_version_tag
+    if plan.version:
+        _load_plans[cls] = plan
+    return plan
+
+
+cdef inline _LoadPlan _get_load_plan(type cls):
+    cdef _LoadPlan plan = _load_plans.get(cls)
+    if plan is None or plan.version != (<VersionedType*>cls).tp_version_tag:
+        return _make_load_plan(cls)
+    return plan
+
+
+cdef int _load_planned_state(obj, state) except -1:
+    cdef _LoadPlan plan = _get_load_plan(type(obj))
+
+    if plan.generic:
+        return _load_state(obj, state)
+
+    if plan.setstate is not None:
+        plan.setstate(obj, state)
+    elif plan.own_dict and PyDict_CheckExact(state):
+        # a copy, later references of the state must not be the instance dict
+        obj.__dict__ = PyDict_Copy(state)
+    elif not _load_slot_state(obj, state):
+        PyDict_Update(obj.__dict__, state)
+    return 0
+
+
 cdef object load_object_fast(Unpacker *p, uint8_t code, size_t size):
     cdef:
         uint32_t stamp = p.get_stamp()
@@ -868,7 +2208,10 @@ cdef object load_object_fast(Unpacker *p, uint8_t code, size_t size):
     cls_args = p.load_object()
     cls = cls_args[0]
     try:
-        obj = GET_NEW(cls)(<PyTypeObject*>cls, cls_args[1:], NULL)
+        if PyTuple_GET_SIZE(cls_args) == 1:
+            obj = GET_NEW(cls)(<PyTypeObject*>cls, (), NULL)
+        else:
+            obj = GET_NEW(cls)(<PyTypeObject*>cls, cls_args[1:], NULL)
     except Exception as e:
         raise UnpicklingError(e, cls, cls_args)
 
@@ -879,7 +2222,8 @@ cdef object load_object_fast(Unpacker *p, uint8_t code, size_t size):
             _load_state_sequence(p, obj)
             if size >= 5:
                 _load_state_dict(p, obj)
-        _load_state(obj, state)
+        if state is not None:
+            _load_planned_state(obj, state)
     return obj
 
 
@@ -919,6 +2263,8 @@ cdef object load_ref(Unpacker* p, uint8_t code, size_t size):
     p.read32(&ido)
     obj = p.get_stamped_ref(ido)
     if obj is NULL:
+        if (<Unpickler>p.unpickler).lazy is not None:
+            return (<Unpickler>p.unpickler).lazy.resolve(ido)
         raise UnpicklingError("Invalid reference")
 
     return <object>obj
@@ -942,6 +2288,183 @@ cdef object load_version(Unpacker* p, uint8_t code, size_t size):
     return p.load_object()
 
 
+cdef object load_oob_buffer(Unpacker* p, uint8_t code, size_t size):
+    cdef uint32_t stamp = p.get_stamp()
+    obj = (<Unpickler>p.unpickler).next_buffer()
+    if size == 1:
+        view = memoryview(obj)
+        if not view.readonly:
+            obj = view.toreadonly()
+
+    p.stamp(stamp, obj)
+    return obj
+
+
+cdef object load_ndarray(Unpacker* p, uint8_t code, size_t size):
+    cdef:
+        uint32_t stamp = p.get_stamp()
+        Unpickler unpickler = <Unpickler>p.unpickler
+        _BufferContainer container
+        const char* data = NULL
+        size_t nbytes, offset
+        uint8_t pad
+        char skip[256]
+        Py_buffer view
+
+    if numpy is None:
+        try:
+            _import_numpy()
+        except ImportError:
+            raise UnpicklingError("numpy is needed to load arrays")
+
+    dtype = p.load_object()
+    shape = p.load_object()
+    length = p.load_object()
+    p.read8(&pad)
+    p.read(skip, pad)
+
+    if (not isinstance(dtype, str) or type(shape) is not tuple
+            or type(length) is not int or length < 0
+            or not all(type(n) is int and n >= 0 for n in shape)):
+        raise UnpicklingError("invalid array")
+    try:
+        dtype = numpy.dtype(dtype)
+    except (TypeError, ValueError, SyntaxError):
+        raise UnpicklingError("invalid array") from None
+    count = math.prod(shape)
+    if (dtype.hasobject or dtype.fields is not None
+            or count * dtype.itemsize != length):
+        raise UnpicklingError("invalid array")
+    nbytes = length
+
+    order = "F" if size == 2 else "C"
+    container = unpickler.direct_buffer()
+    if unpickler.zero_copy and nbytes and container is not None:
+        offset = container.sreader.pos
+        data = p.consume(nbytes)
+        if data is not NULL and <size_t>data % dtype.alignment == 0:
+            obj = numpy.frombuffer(
+                <object>container.view.obj, dtype, count, offset)\
+                .reshape(shape, order=order)
+            p.stamp(stamp, obj)
+            return obj
+
+    try:
+        obj = numpy.empty(shape, dtype, order=order)
+    except ValueError:
+        raise UnpicklingError("invalid array") from None
+    PyObject_GetBuffer(obj.T if size == 2 else obj, &view, PyBUF_WRITABLE)
+    try:
+        if data is not NULL:
+            memcpy(view.buf, data, nbytes)
+        else:
+            p.read(<char*>view.buf, nbytes)
+    finally:
+        PyBuffer_Release(&view)
+
+    p.stamp(stamp, obj)
+    return obj
+
+
+cdef object load_record(Unpacker* p, uint8_t code, size_t size):
+    cdef:
+        Unpickler unpickler = <Unpickler>p.unpickler
+        bool counted = isinstance(unpickler.file, (_BufferContainer, _FileLike))
+        size_t start = unpickler.tell() if counted else 0
+
+    obj = p.load_object()
+    if counted and unpickler.tell() - start != size:
+        raise UnpicklingError("the record length does not match its pickle")
+    return obj
+
+
+cdef object load_chunked(Unpacker* p, uint8_t code, size_t size):
+    cdef:
+        Unpickler unpickler = <Unpickler>p.unpickler
+        size_t i, count = p.load_object()
+
+    if size not in (1, 2, 3):
+        raise UnpicklingError("invalid chunk kind")
+
+    if unpickler.executor is None:
+        parts = [unpickler.chunk_unpickler(unpickler.read_chunk()).load()
+                 for i in range(count)]
+    else:
+        chunks = [unpickler.chunk_unpickler(unpickler.read_chunk())
+                  for i in range(count)]
+        parts = unpickler.executor.map(Unpickler.load, chunks)
+
+    if size == 3:
+        result = {}
+        for part in parts:
+            result.update(part)
+        return result
+
+    result = list(itertools.chain.from_iterable(parts))
+    return tuple(result) if size == 2 else result
+
+
+cdef object load_compressed(Unpacker* p, uint8_t code, size_t size):
+    cdef:
+        Unpickler unpickler = <Unpickler>p.unpickler
+        _Decompressor decompressor = _Decompressor(size, unpickler.buffer_size)
+        _Decompressor outer = unpickler.decompressor
+
+    unpickler.decompressor = decompressor
+    decompressor.start(p)
+    try:
+        obj = p.load_object()
+        decompressor.finish(p)
+    finally:
+        decompressor.stop(p)
+        unpickler.decompressor = outer
+    return obj
+
+
+cdef object load_typed_array(Unpacker* p, uint8_t code, size_t size):
+    cdef:
+        uint8_t header[2]
+        size_t itemsize
+        const char* data
+        bytes buffer
+
+    p.read(<char*>header, 2)
+    itemsize = typed_itemsize(header[1])
+    if not itemsize or size % itemsize:
+        raise UnpicklingError("invalid typed array")
+
+    data = p.consume(size)
+    if data is NULL:
+        buffer = PyBytes_FromStringAndSize(NULL, size)
+        data = Bytes_AS_STRING(buffer)
+        p.read(<char*>data, size)
+
+    if header[0] == TYPED_LIST or header[0] == TYPED_TUPLE:
+        obj = typed_sequence(header[0], header[1], data, size // itemsize)
+    else:
+        typecode = chr(header[0])
+        if typecode not in _array_elements:
+            raise UnpicklingError("invalid typed array")
+
+        obj = array.array(typecode)
+        if _array_elements[typecode] == header[1]:
+            obj.frombytes(PyMemoryView_FromMemory(<char*>data, size, PyBUF_READ))
+            if sys.byteorder != "little":
+                obj.byteswap()
+        else:
+            # the item size differs between the platforms
+            obj.fromlist(typed_sequence(
+                TYPED_LIST, header[1], data, size // itemsize))
+
+    p.stamp(p.get_stamp(), obj)
+    return obj
+
+
+cdef object load_session(Unpacker* p, uint8_t code, size_t size):
+    (<Unpickler>p.unpickler).begin_message(size)
+    return p.load_object()
+
+
 cdef object load_wrong_code(Unpacker* p, uint8_t code, size_t size):
     raise UnpicklingError("Unknown load code")
 
@@ -998,9 +2521,19 @@ _register_unpickle(<unpack_t>load_initargs, [INIT_ARGS], 0x100)
 _register_unpickle(<unpack_t>load_end_item, [END_OBJECT_ITEMS], 0x100)
 _register_unpickle(load_bytes, [BYTES], 0x100)
 _register_unpickle(load_unicode, [UNISTR], 0x100)
+_register_unpickle(load_bytearray, [BYTEARRAY], 0x100)
+_register_unpickle(<unpack_t>load_oob_buffer, [OOB_BUFFER], 0x100)
+_register_unpickle(<unpack_t>load_ndarray, [NDARRAY], 0x100)
+_register_unpickle(<unpack_t>load_record, [RECORD], 0x100)
+_register_unpickle(<unpack_t>load_session, [SESSION], 0x100)
+_register_unpickle(<unpack_t>load_chunked, [CHUNKED], 0x100)
+_register_unpickle(<unpack_t>load_compressed, [COMPRESSED], 0x100)
+_register_unpickle(load_shape, [SHAPE], 0x100)
+_register_unpickle(<unpack_t>load_typed_array, [TYPED_ARRAY], 0x100)
 
 
 cdef class Unpickler
+cdef class _LazyDocument
 
 ctypedef object (*find_class_t)(Unpickler unpickler, module, name)
 
@@ -1058,17 +2591,46 @@ cdef class Unpickler:
         object file
         Unpacker *unpacker
         object _find_class
+        object buffers
         find_class_t call_find_class
         default_find_class_t default_find_class
         public uint32_t last_refcount
         public bool secure
-
-    def __init__(self, file=b"", bool secure=False):
+        public bool zero_copy
+        bool session
+        bool session_valid
+        bool session_message
+        object executor  # decodes chunks in parallel
+        _Decompressor decompressor
+        size_t buffer_size
+        _LazyDocument lazy  # resolves references for loads_lazy
+        # the classes of the current pickle: the first one and
+        # name -> (module, class) for the others
+        object first_module, first_name, first_class
+        dict class_table
+        dict class_cache  # (module, name) -> (class, module dict, epoch)
+        # the input of feed(): fed[fed_start:] is not loaded yet, the
+        # feeder walks over the next pickle
+        bytearray fed
+        size_t fed_start
+        Skipper feeder
+        bool feeding
+
+    def __init__(self, file=b"", bool secure=False,
+                 size_t buffer_size=DEFAULT_BUFFER_SIZE, buffers=None,
+                 bool zero_copy=False, bool session=False,
+                 bool class_cache=False):
         self.unpacker = new Unpacker(self)
+        self.class_table = {}
+        self.class_cache = {} if class_cache else None
         self.secure = secure
+        self.zero_copy = zero_copy
+        self.session = session
+        self.buffer_size = buffer_size
+        self.buffers = iter(buffers) if buffers is not None else None
 
         # this is complicated but faster than ordinary subclassing
-        if isinstance(self.find_class, types.BuiltinMethodType):
+        if type(self).find_class is Unpickler.find_class:
             self.call_find_class = call_default_find_class
         else:
             self._find_class = self.find_class
@@ -1076,20 +2638,33 @@ cdef class Unpickler:
 
         self.default_find_class = simple_find_class
 
-        if isinstance(file, bytes):
+        if isinstance(file, bytes) or (
+                PyObject_CheckBuffer(file) and not hasattr(file, "c_pickle")):
             self.file = _BufferContainer().set(file)
             self.unpacker.do_read = read_buffer
+            self.unpacker.window = &(<_BufferContainer>self.file).sreader
         elif hasattr(file, "c_pickle"):
             self.file = file.c_pickle()
             self.unpacker.do_read = read_external
         else:
-            self.file = _FileLike(file)
+            self.file = _FileLike(file, buffer_size)
             self.unpacker.do_read = read_file
+            self.unpacker.window = &(<_FileLike>self.file).window
 
 
     def __dealloc__(self):
         del self.unpacker
 
+    @classmethod
+    def from_mmap(cls, file, secure=False, zero_copy=False):
+        """Returns an unpickler reading from a read only memory map of `file`,
+        which may be a path or a file object opened in binary mode."""
+        if hasattr(file, "fileno"):
+            return cls(_map_file(file), secure=secure, zero_copy=zero_copy)
+
+        with open(file, "rb") as f:
+            return cls(_map_file(f), secure=secure, zero_copy=zero_copy)
+
     cdef int set_protocol(self, uint8_t protocol):
         if protocol < 3:
             self.default_find_class = mapped_find_class
@@ -1123,12 +2698,80 @@ cdef class Unpickler:
 
         module = self.unpacker.load_object()
         name = self.unpacker.load_object()
+        # module and name are mostly references to the same strings
+        if self.first_class is not None:
+            if name == self.first_name and module == self.first_module:
+                return self.first_class
+
+            key = PyDict_GetItem(self.class_table, name)
+            if key is not NULL and (<tuple>key)[0] == module:
+                return (<tuple>key)[1]
+
+        imported = self.resolve_class(module, name)
+        if self.first_class is None:
+            self.first_module = module
+            self.first_name = name
+            self.first_class = imported
+        else:
+            self.class_table[name] = (module, imported)
+        return imported
+
+    cdef void forget_classes(self):
+        self.first_module = self.first_name = self.first_class = None
+        if self.class_table:
+            self.class_table.clear()
+
+    cdef object resolve_class(self, module, name):
+        cdef:
+            PyObject* tmp
+            tuple key
+            bool cacheable = (self.class_cache is not None
+                              and self.call_find_class is call_default_find_class)
+
+        if cacheable:
+            key = (module, name)
+            # a cached class is valid while it is the attribute of the
+            # imported module (reload replaces the attributes)
+            tmp = PyDict_GetItem(self.class_cache, key)
+            if tmp is not NULL:
+                imported, namespace, epoch = <object>tmp
+                tmp = PyDict_GetItem(modules, module)
+                if (tmp is not NULL
+                        and getattr(<object>tmp, "__dict__", None) is namespace
+                        and (<dict>namespace).get(name) is imported):
+                    # the verification is valid until the secure sets change
+                    if self.secure and epoch != secure_epoch():
+                        self.verify_object(module, name, imported)
+                        self.class_cache[key] = (
+                            imported, namespace, secure_epoch())
+                    return imported
+
         imported = self.call_find_class(self, module, name)
         if self.secure:
             self.verify_object(module, name, imported)
 
+        if cacheable:
+            tmp = PyDict_GetItem(modules, module)
+            if tmp is not NULL:
+                namespace = getattr(<object>tmp, "__dict__", None)
+                if (type(namespace) is dict
+                        and (<dict>namespace).get(name) is imported):
+                    self.class_cache[key] = (
+                        imported, namespace,
+                        secure_epoch() if self.secure else None)
+
         return imported
 
+    cdef object next_buffer(self):
+        if self.buffers is None:
+            raise UnpicklingError(
+                "pickle stream refers to out-of-band data "
+                "but no *buffers* argument was given")
+        try:
+            return next(self.buffers)
+        except StopIteration:
+            raise UnpicklingError("not enough out-of-band buffers")
+
     cdef int check_init(self) except -1:
         if self.file is None:
             raise UnpicklingError(
@@ -1139,19 +2782,216 @@ cdef class Unpickler:
         return self.default_find_class(module, name)
 
     def load(self):
-        self.check_init()
         try:
-            return <object>self.unpacker.first_load()
+            return self.load_next()
         finally:
+            if isinstance(self.file, _FileLike):
+                (<_FileLike>self.file).sync()
+
+    cdef object load_next(self):
+        self.check_init()
+        self.session_message = False
+        try:
+            obj = <object>self.unpacker.first_load()
+        except:
+            self.last_refcount = self.unpacker.reset()
+            self.session_valid = False
+            self.forget_classes()
+            raise
+
+        if self.session_message:
+            self.last_refcount = self.unpacker.end_message()
+        else:
             self.last_refcount = self.unpacker.reset()
+            self.session_valid = False
+            if self.first_class is not None:
+                self.forget_classes()
+        return obj
+
+    cdef int begin_message(self, size_t flag) except -1:
+        if not self.session:
+            raise UnpicklingError(
+                "the pickle is part of a session, use Unpickler(session=True)")
+
+        if flag == 2:
+            self.unpacker.reset()
+            self.session_valid = True
+        elif not self.session_valid:
+            raise UnpicklingError("the session is lost, it must be reset")
 
-    def loads(self, bytes obj):
+        self.session_message = True
+        return 0
+
+    cdef _BufferContainer direct_buffer(self):
+        """returns the buffer container if the unpacker reads from it"""
+        if (isinstance(self.file, _BufferContainer) and self.unpacker.window
+                == &(<_BufferContainer>self.file).sreader):
+            return <_BufferContainer>self.file
+        return None
+
+    cdef object read_chunk(self):
+        cdef:
+            _BufferContainer container
+            size_t offset, size = self.unpacker.load_object()
+            bytes chunk
+
+        container = self.direct_buffer()
+        if container is not None:
+            offset = container.sreader.pos
+            if self.unpacker.consume(size) is not NULL:
+                return memoryview(<object>container.view.obj)[offset:offset+size]
+
+        chunk = PyBytes_FromStringAndSize(NULL, size)
+        self.unpacker.read(Bytes_AS_STRING(chunk), size)
+        return chunk
+
+    cdef Unpickler chunk_unpickler(self, chunk):
+        """returns an unpickler for a chunk, that has its own references
+        but finds classes like self"""
+        cdef Unpickler unpickler = Unpickler(
+            chunk, secure=self.secure, zero_copy=self.zero_copy)
+        unpickler._find_class = self._find_class
+        unpickler.call_find_class = self.call_find_class
+        unpickler.default_find_class = self.default_find_class
+        unpickler.class_cache = self.class_cache
+        return unpickler
+
+    def reset_session(self):
+        """Forgets the references of the session. The next message must
+        reset the session too."""
+        self.unpacker.reset()
+        self.session_valid = False
+        self.forget_classes()
+
+    def clear_class_cache(self):
+        """Forgets the resolved classes, needed if find_class would
+        return other classes now."""
+        self.forget_classes()
+        if self.class_cache is not None:
+            self.class_cache.clear()
+
+    cdef int at_end(self) except -1:
+        if isinstance(self.file, _FileLike):
+            return (<_FileLike>self.file).at_end()
+        return not (<_BufferContainer>self.file).sreader.available()
+
+    cdef size_t tell(self):
+        if isinstance(self.file, _FileLike):
+            return (<_FileLike>self.file).tell()
+        return (<_BufferContainer>self.file).sreader.pos
+
+    @classmethod
+    def iter_load(cls, source, offset=None, secure=False,
+                  with_offsets=False):
+        """Yields the records (or concatenated pickles) of `source` one by one,
+        starting at byte `offset` (default: the start of a buffer or the
+        current position of a file). source may be a buffer, a file object or
+        a path, which is mapped into memory. With `with_offsets` pairs of
+        (end offset, object) are yielded, the end offset is where a later
+        iter_load can resume. The end offsets of an unseekable file count
+        from the position where reading started."""
+        cdef Unpickler unpickler
+
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                source = _map_file(f)
+
+        unpickler = cls(source, secure=secure)
+        if isinstance(unpickler.file, _BufferContainer):
+            if offset is None:
+                offset = 0
+            if offset > (<_BufferContainer>unpickler.file).sreader.size:
+                raise ValueError("offset is beyond the end of source")
+            (<_BufferContainer>unpickler.file).sreader.pos = offset
+        elif isinstance(unpickler.file, _FileLike):
+            if offset is not None:
+                source.seek(offset)
+            elif (<_FileLike>unpickler.file).seek is not None:
+                offset = source.tell()
+            else:
+                offset = 0
+            (<_FileLike>unpickler.file).offset = offset
+        else:
+            raise TypeError("cannot iterate over {!r}".format(source))
+
+        return _iter_records(unpickler, with_offsets)
+
+    def loads(self, obj, buffers=None):
         self.check_init()
-        (<_BufferContainer>self.file).set(obj)
+        return self.load_string(obj, buffers)
+
+    cdef object load_string(self, obj, buffers):
+        cdef _BufferContainer container = <_BufferContainer>self.file
+        container.set(obj)
+        if buffers is not None:
+            self.buffers = iter(buffers)
         try:
-            return <object>self.unpacker.first_load()
+            return self.load_next()
         finally:
-            self.last_refcount = self.unpacker.reset()
+            container.release()
+            if buffers is not None:
+                self.buffers = None
+
+    def feed(self, data):
+        """Appends a chunk of a stream of pickles, objects() yields the
+        pickles completed by it."""
+        self.check_init()
+        if not isinstance(self.file, _BufferContainer):
+            raise TypeError("feed() needs an Unpickler without file")
+        if self.fed is None:
+            self.fed = bytearray()
+        self.fed += data
+
+    @property
+    def pending(self):
+        """The count of fed bytes, that are not loaded yet."""
+        return len(self.fed) - self.fed_start if self.fed is not None else 0
+
+    def objects(self):
+        """Yields the objects of all complete pickles fed so far. The walk
+        over an incomplete pickle continues after the next feed()."""
+        cdef size_t end
+        cdef bool zero_copy
+
+        if self.fed is None:
+            return
+
+        while self.next_fed():
+            end = self.feeder.pos
+            data = memoryview(self.fed)[self.fed_start:end]
+            self.fed_start = end
+            # the objects must not refer to the input
+            zero_copy = self.zero_copy
+            self.zero_copy = False
+            try:
+                obj = self.load_string(data, None)
+            finally:
+                self.zero_copy = zero_copy
+                data.release()
+            yield obj
+
+        if self.fed_start:
+            del self.fed[:self.fed_start]
+            if self.feeding:
+                self.feeder.pos -= self.fed_start
+            self.fed_start = 0
+
+    cdef bool next_fed(self) except *:
+        """returns True if the pickle at fed_start is complete, its end is
+        at feeder.pos"""
+        if not self.feeding:
+            if self.fed_start >= <size_t>len(self.fed):
+                return False
+            self.feeder.begin()
+            self.feeder.pos = self.fed_start
+            self.feeding = True
+
+        self.feeder.data = PyByteArray_AS_STRING(self.fed)
+        self.feeder.size = len(self.fed)
+        if self.feeder.resume():
+            self.feeding = False
+            return True
+        return False
 
     cpdef verify_object(self, module, name, obj):
         if (module not in secure_modules and obj not in secure_objects
@@ -1177,20 +3017,520 @@ cdef class Unpickler:
             raise SecurityError("object not save for loading", obj, module)
 
 
-cpdef dumps(obj, protocol=-1, with_refs=True):
-    return Pickler(protocol=protocol, with_refs=with_refs)\
-        .dump(obj).get_output_string()
+@cython.final
+cdef class _ChunkSink:
+    """The file of Pickler.iter_dump(), it passes the output of the worker
+    thread to a bounded queue of chunks (or any object with a blocking
+    put())."""
+    cdef:
+        size_t chunk_size
+        readonly object chunks
+        readonly object error
+        public bool cancelled
+
+    def __init__(self, size_t chunk_size, chunks=None):
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(2) if chunks is None else chunks
+
+    def seekable(self):
+        return False
 
+    def write(self, data):
+        cdef size_t i
 
-cpdef dump(obj, file, protocol=-1):
-    Pickler(file, protocol=protocol).dump(obj)
+        if len(data) <= self.chunk_size:
+            if self.cancelled:
+                raise PicklingError("iter_dump was stopped")
+            self.chunks.put(data)
+            return len(data)
 
+        view = memoryview(data)
+        for i in range(0, len(view), self.chunk_size):
+            if self.cancelled:
+                raise PicklingError("iter_dump was stopped")
+            self.chunks.put(bytes(view[i:i + self.chunk_size]))
+        return len(view)
 
-cpdef load(file, secure=False):
-    cdef Unpickler unpickler = Unpickler(file, secure=secure)
+
+def _iter_records(Unpickler unpickler, bool with_offsets):
+    try:
+        while not unpickler.at_end():
+            obj = unpickler.load_next()
+            if with_offsets:
+                yield unpickler.tell(), obj
+            else:
+                yield obj
+    finally:
+        if isinstance(unpickler.file, _FileLike):
+            (<_FileLike>unpickler.file).sync()
+
+
+# Every thread keeps the picklers and unpicklers of the module functions
+# for the next call. An instance is taken out of the pool while it works,
+# a nested call (e.g. from a __reduce__ method) creates a new one.
+@cython.final
+cdef class _ThreadPool:
+    cdef:
+        list picklers  # [protocol * 2 + with_refs] -> Pickler or None
+        Unpickler unpickler
+        Unpickler secure_unpickler
+
+    def __init__(self):
+        self.picklers = [None] * ((MAX_PROTOCOL_VERSION + 1) * 2)
+
+
+cdef str _POOL_KEY = "larch.pickle.pool"
+
+# instances that worked on larger pickles are not kept
+cdef size_t POOL_MAX_SIZE = 0x100000
+cdef uint32_t POOL_MAX_REFS = 0x10000
+
+
+cdef _ThreadPool _thread_pool():
+    cdef PyObject* tmp
+    cdef dict state = <dict>PyThreadState_GetDict()
+
+    tmp = PyDict_GetItem(state, _POOL_KEY)
+    if tmp is not NULL:
+        return <_ThreadPool>tmp
+
+    pool = state[_POOL_KEY] = _ThreadPool()
+    return pool
+
+
+cpdef dumps(obj, protocol=-1, with_refs=True, buffer_callback=None,
+            compression=None):
+    cdef:
+        _ThreadPool pool
+        Pickler pickler
+        bytes result
+        int key
+
+    if buffer_callback is not None or compression is not None:
+        return Pickler(protocol=protocol, with_refs=with_refs,
+                       buffer_callback=buffer_callback,
+                       compression=compression)\
+            .dump(obj).get_output_string()
+
+    key = protocol
+    if key < 0 or key > MAX_PROTOCOL_VERSION:
+        key = MAX_PROTOCOL_VERSION
+    key = key * 2 + (1 if with_refs else 0)
+    pool = _thread_pool()
+    pickler = pool.picklers[key]
+    if pickler is None:
+        pickler = Pickler(protocol=protocol, with_refs=with_refs)
+    else:
+        pool.picklers[key] = None
+
+    result = pickler.dump_string(obj, True)
+    if (PyBytes_GET_SIZE(result) <= POOL_MAX_SIZE
+            and pickler.last_refcount <= POOL_MAX_REFS):
+        # the same object gives the same pickle in the next call
+        pickler.packer.clear_shapes()
+        pool.picklers[key] = pickler
+    return result
+
+
+cpdef dump(obj, file, protocol=-1, buffer_callback=None, compression=None):
+    Pickler(file, protocol=protocol, buffer_callback=buffer_callback,
+            compression=compression).dump(obj)
+
+
+cpdef load(file, secure=False, buffers=None, zero_copy=False):
+    cdef Unpickler unpickler = Unpickler(
+        file, secure=secure, buffers=buffers, zero_copy=zero_copy)
     return unpickler.load()
 
 
-cpdef loads(bytes obj, secure=False):
+cpdef loads(obj, secure=False, buffers=None, zero_copy=False):
+    cdef:
+        _ThreadPool pool
+        Unpickler unpickler
+
+    if not isinstance(obj, (bytes, bytearray, memoryview)):
+        unpickler = Unpickler(
+            obj, secure=secure, buffers=buffers, zero_copy=zero_copy)
+        return unpickler.load()
+
+    pool = _thread_pool()
+    if secure:
+        unpickler = pool.secure_unpickler
+        pool.secure_unpickler = None
+    else:
+        unpickler = pool.unpickler
+        pool.unpickler = None
+    if unpickler is None:
+        unpickler = Unpickler(secure=secure)
+
+    unpickler.zero_copy = zero_copy
+    result = unpickler.load_string(obj, buffers)
+    if unpickler.last_refcount <= POOL_MAX_REFS:
+        if secure:
+            pool.secure_unpickler = unpickler
+        else:
+            pool.unpickler = unpickler
+    return result
+
+
+cpdef load_path(path, secure=False, zero_copy=False):
+    return Unpickler.from_mmap(path, secure=secure, zero_copy=zero_copy).load()
+
+
+def _iter_chunks(obj, size_t chunk_size):
+    cdef size_t i
+    if isinstance(obj, dict):
+        items = iter(obj.items())
+        chunk = dict(itertools.islice(items, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = dict(itertools.islice(items, chunk_size))
+    else:
+        for i in range(0, len(obj), chunk_size):
+            yield obj[i:i+chunk_size]
+
+
+def _dump_chunk(chunk, protocol):
+    return Pickler(protocol=protocol).dumps(chunk)
+
+
+cdef object _source = None  # (container, keys, protocol) in a worker process
+
+
+def _set_source(obj, keys, protocol):
+    global _source
+    _source = (obj, keys, protocol)
+
+
+def _dump_slice(size_t start, size_t stop):
+    """pickles a slice of the container inherited by a worker process"""
+    obj, keys, protocol = _source
+    if keys is not None:
+        obj = {k: obj[k] for k in keys[start:stop]}
+    else:
+        obj = obj[start:stop]
+    return Pickler(protocol=protocol).dumps(obj)
+
+
+cdef object _fork_pool(obj, protocol, size_t processes):
+    """Returns a pool of forked processes, that inherit obj without
+    pickling it, or None if fork is not available."""
+    import multiprocessing
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+
+    from concurrent.futures import ProcessPoolExecutor
+    keys = list(obj) if type(obj) is dict else None
+    return ProcessPoolExecutor(
+        processes, mp_context=multiprocessing.get_context("fork"),
+        initializer=_set_source, initargs=(obj, keys, protocol))
+
+
+def dumps_parallel(obj, protocol=-1, size_t chunk_size=DEFAULT_CHUNK_SIZE,
+                   executor=None, processes=None):
+    """Like dumps, but a big list, tuple or dict is split into chunks of
+    chunk_size items. Every chunk has its own references, objects shared
+    between chunks are duplicated. Without executor the chunks are pickled
+    by `processes` (default os.cpu_count()) forked processes, which inherit
+    obj and return only the pickles of their chunks. With executor the
+    chunks are pickled by executor.map."""
+    cdef:
+        Pickler pickler = Pickler(protocol=protocol)
+        uint8_t kind
+        size_t count
+        bytes data
+
+    if type(obj) is list:
+        kind = 1
+    elif type(obj) is tuple:
+        kind = 2
+    elif type(obj) is dict:
+        kind = 3
+    else:
+        kind = 0
+
+    chunk_size = max(chunk_size, 1)
+    if not kind or len(obj) <= chunk_size:
+        return pickler.dumps(obj)
+
+    count = (len(obj) + chunk_size - 1) // chunk_size
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, count)
+
+    pool = None
+    if executor is None and processes > 1:
+        pool = _fork_pool(obj, protocol, processes)
+
+    if pool is not None:
+        starts = range(0, len(obj), chunk_size)
+        parts = pool.map(
+            _dump_slice, starts, [i + chunk_size for i in starts])
+    elif executor is not None:
+        parts = executor.map(
+            _dump_chunk, _iter_chunks(obj, chunk_size),
+            itertools.repeat(protocol))
+    else:
+        parts = map(_dump_chunk, _iter_chunks(obj, chunk_size),
+                    itertools.repeat(protocol))
+
+    try:
+        output = Pickler(protocol=protocol)
+        output.packer.pack_version(output.protocol)
+        output.packer.pack_ext(CHUNKED, kind)
+        output.packer.pack_int(count)
+        for data in parts:
+            output.packer.pack_int(PyBytes_GET_SIZE(data))
+            output.packer.write(Bytes_AS_STRING(data), PyBytes_GET_SIZE(data))
+        return output.get_output_string()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def loads_parallel(obj, secure=False, executor=None):
+    """Like loads, the chunks of a big container saved with dumps_parallel
+    are loaded by executor.map, without executor one after the other.
+    Processes do not help here, the loaded objects would have to be pickled
+    again, a thread pool only runs in parallel without the GIL."""
     cdef Unpickler unpickler = Unpickler(obj, secure=secure)
+    unpickler.executor = executor
     return unpickler.load()
+
+
+# Lazy Loading
+# ------------------------------
+
+@cython.auto_pickle(False)
+cdef class _LazyDocument:
+    """Decodes the values of a pickle on demand. Containers (dicts, lists and
+    tuples) are walked without decoding their values, only the keys of dicts
+    are loaded. A value is loaded with the reference ids the skipper counted
+    for its offset."""
+    cdef:
+        Unpickler unpickler
+        _BufferContainer container
+        Skipper skipper
+        cpp_map[uint32_t, size_t] anchors  # ref id -> offset of a value
+        dict cache  # offset -> loaded value or lazy container
+        dict containers  # ref id -> lazy container
+        set loading  # offsets of values being loaded
+
+    def __init__(self, data, secure):
+        self.unpickler = Unpickler(data, secure=secure)
+        self.container = self.unpickler.direct_buffer()
+        if self.container is None:
+            raise TypeError("loads_lazy needs a buffer, not {!r}".format(
+                type(data).__name__))
+        self.unpickler.lazy = self
+        self.cache = {}
+        self.containers = {}
+        self.loading = set()
+
+    cdef object root(self):
+        cdef:
+            StringReader* sreader = &self.container.sreader
+            size_t n, offset
+            int kind
+
+        if (sreader.size >= 3 and <uint8_t>sreader.data[0] == 0xd4
+                and sreader.data[1] == VERSION):
+            self.unpickler.set_protocol(<uint8_t>sreader.data[2])
+            sreader.pos = 3
+
+        offset = sreader.pos
+        kind = self.header(&n)
+        if not kind:
+            # not a container, there is nothing to be lazy about
+            sreader.pos = 0
+            return self.unpickler.load_next()
+
+        return self.walk(kind, n, offset)
+
+    cdef int header(self, size_t* n) except -1:
+        self.skipper.data = self.container.sreader.data
+        self.skipper.pos = self.container.sreader.pos
+        self.skipper.size = self.container.sreader.size
+        kind = self.skipper.container(n[0])
+        self.container.sreader.pos = self.skipper.pos
+        return kind
+
+    cdef int skip(self, list offsets, list stamps) except -1:
+        cdef:
+            Unpacker* unpacker = self.unpickler.unpacker
+            uint32_t stamp = unpacker.get_counter()
+            size_t offset = self.container.sreader.pos
+
+        offsets.append(offset)
+        stamps.append(stamp)
+        self.skipper.pos = offset
+        self.skipper.counter = stamp
+        self.skipper.min_string_size_for_ref = unpacker.min_string_size_for_ref
+        self.skipper.skip_value()
+        self.container.sreader.pos = self.skipper.pos
+        unpacker.set_counter(self.skipper.counter)
+        if self.skipper.counter > stamp:
+            # only values containing reference ids can be referenced
+            self.anchors[stamp] = offset
+
+    cdef object walk(self, int kind, size_t n, size_t offset):
+        """creates a lazy container for the items following the header"""
+        cdef:
+            Unpacker* unpacker = self.unpickler.unpacker
+            uint32_t stamp = unpacker.get_stamp()
+            size_t i
+            list offsets = []
+            list stamps = []
+            dict index
+
+        if kind == 1:
+            index = {}
+            for i in range(n):
+                index[unpacker.first_load()] = i
+                self.skip(offsets, stamps)
+            result = LazyMap(self, index, offsets, stamps)
+        elif kind == 4:
+            keys = unpacker.first_load()
+            if not PyTuple_Check(keys) or PyTuple_GET_SIZE(keys) != n:
+                raise UnpicklingError("invalid dict shape")
+            index = {}
+            for i in range(n):
+                index[keys[i]] = i
+                self.skip(offsets, stamps)
+            result = LazyMap(self, index, offsets, stamps)
+        else:
+            for i in range(n):
+                self.skip(offsets, stamps)
+            result = LazySeq(self, kind == 2, offsets, stamps)
+
+        self.anchors[stamp] = offset
+        self.containers[stamp] = self.cache[offset] = result
+        return result
+
+    cdef object value(self, size_t offset, uint32_t stamp):
+        cdef:
+            Unpacker* unpacker = self.unpickler.unpacker
+            StringReader* sreader = &self.container.sreader
+            PyObject* tmp = PyDict_GetItem(self.cache, offset)
+            size_t pos = sreader.pos, n
+            uint32_t counter = unpacker.get_counter()
+            int kind
+
+        if tmp is not NULL:
+            return <object>tmp
+
+        if offset in self.loading:
+            raise UnpicklingError("Invalid reference")
+
+        self.loading.add(offset)
+        try:
+            sreader.pos = offset
+            unpacker.set_counter(stamp)
+            kind = self.header(&n)
+            if kind:
+                return self.walk(kind, n, offset)
+
+            result = self.cache[offset] = unpacker.first_load()
+            return result
+        finally:
+            self.loading.discard(offset)
+            sreader.pos = pos
+            unpacker.set_counter(counter)
+
+    cdef object resolve(self, uint32_t ref):
+        """returns the object of a reference to a value, that is not loaded
+        yet. The value containing the reference target is loaded."""
+        cdef:
+            cpp_map[uint32_t, size_t].iterator it
+            PyObject* tmp
+
+        while True:
+            tmp = self.unpickler.unpacker.get_stamped_ref(ref)
+            if tmp is NULL:
+                tmp = PyDict_GetItem(self.containers, ref)
+            if tmp is not NULL:
+                return <object>tmp
+
+            it = self.anchors.upper_bound(ref)
+            if it == self.anchors.begin():
+                break
+
+            dec(it)
+            offset = deref(it).second
+            if PyDict_GetItem(self.cache, offset) is not NULL \
+                    or offset in self.loading:
+                break
+
+            self.value(deref(it).second, deref(it).first)
+
+        raise UnpicklingError("Invalid reference")
+
+
+class LazyMap(Mapping):
+    """A read only dict view of a pickled dict, returned by loads_lazy.
+    The values are loaded on first access."""
+    __slots__ = ("_document", "_index", "_offsets", "_stamps")
+
+    def __init__(self, document, index, offsets, stamps):
+        self._document = document
+        self._index = index
+        self._offsets = offsets
+        self._stamps = stamps
+
+    def __getitem__(self, key):
+        cdef size_t i = self._index[key]
+        return (<_LazyDocument>self._document).value(
+            self._offsets[i], self._stamps[i])
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return "<LazyMap of {} items>".format(len(self._index))
+
+
+class LazySeq(Sequence):
+    """A read only sequence view of a pickled list or tuple, returned by
+    loads_lazy. The items are loaded on first access."""
+    __slots__ = ("_document", "_is_tuple", "_offsets", "_stamps")
+
+    def __init__(self, document, is_tuple, offsets, stamps):
+        self._document = document
+        self._is_tuple = is_tuple
+        self._offsets = offsets
+        self._stamps = stamps
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            items = [self[j] for j in range(*i.indices(len(self._offsets)))]
+            return tuple(items) if self._is_tuple else items
+
+        return (<_LazyDocument>self._document).value(
+            self._offsets[i], self._stamps[i])
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, LazySeq)):
+            return len(self) == len(other) and all(
+                a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<LazySeq of {} items>".format(len(self._offsets))
+
+
+def loads_lazy(obj, secure=False):
+    """Like loads, but a pickled dict, list or tuple is returned as read only
+    LazyMap or LazySeq, that loads its values on access. Nested containers
+    are lazy too. obj must be a buffer, which is kept alive by the views."""
+    return _LazyDocument(obj, secure).root()
@@ -10,9 +10,19 @@ secure_modules = {"time", "uuid", "string", "re",
                   "http.cookiejar", "ipaddress",
                   "larch.reactive.proxy", "larch.reactive.rcollections"}
 
+# secure unpicklers cache their decisions until epoch changes,
+# changes of secure_objects and secure_modules must call changed()
+epoch = 0
+
+
+def changed():
+    global epoch
+    epoch += 1
+
 
 def secure_unpickle(obj):
     secure_objects.add(obj)
+    changed()
     return obj
 
 
@@ -29,6 +39,7 @@ def make_secure(module, unsecure):
     secure = (getattr(module, n) for n in dir(module)
               if not (n.startswith("__") or n in unsecure))
     secure_objects.update(o for o in secure if hashable(o))
+    changed()
 
 
 def add_builtins():
@@ -55,6 +66,7 @@ def add__operator():
 def add_os():
     import os
     secure_objects.update([os.stat_result, os.statvfs_result])
+    changed()
 
 
 def add_extension_by_hash(module, name):
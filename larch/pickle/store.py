@@ -0,0 +1,466 @@
+"""A persistent key -> object store, like shelve
+
+The values are appended as records to a data file, a hash table in a
+separate index file maps the keys to the record offsets. Both files are
+mapped into memory, a lookup hashes the key, probes the index and loads
+the value directly from the mapped data file.
+
+data file:  DATA_HEADER (magic, generation) followed by records
+record:     RECORD (flags, key size, value size), key, pickled value
+            a record with the DELETED flag marks a deleted key
+index file: INDEX_HEADER followed by capacity SLOTs (hash, offset)
+            hash 0 is an empty slot, offset 0 a deleted one
+
+Only one writer may open a store, it is locked by a lock file. Any number
+of readers can open it concurrently. The writer appends a record before
+it publishes the offset in the index, resizing and compacting write new
+files that replace the old ones and mark the old index as stale, so
+readers reopen the store. Compacting replaces the index before the data
+file, if it is interrupted in between, the writer opening the store next
+finishes it with the new data file path + ".tmp".
+"""
+import io
+import os
+import time
+import mmap
+import struct
+import hashlib
+from collections.abc import MutableMapping
+from .pickle import Pickler, Unpickler, UnpicklingError
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+DATA_MAGIC = b"LPSTORE1"
+INDEX_MAGIC = b"LPSTIDX1"
+DATA_HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<BIQ")
+INDEX_HEADER = struct.Struct("<8sQQQQQQQ")
+SLOT = struct.Struct("<QQ")
+
+BYTES_KEY = 1
+DELETED = 2
+
+MIN_CAPACITY = 1024
+MAX_LOAD = 0.7
+
+# field offsets in INDEX_HEADER
+_GENERATION = 8
+_STALE = 16
+_CAPACITY = 24
+_COUNT = 32
+_USED = 40
+_DATA_SIZE = 48
+_DEAD = 56
+
+
+def _encode_key(key):
+    if isinstance(key, str):
+        return 0, key.encode("utf-8", "surrogatepass")
+    if isinstance(key, bytes):
+        return BYTES_KEY, key
+    raise TypeError("keys must be str or bytes, not {!r}".format(
+        type(key).__name__))
+
+
+def _decode_key(flags, data):
+    if flags & BYTES_KEY:
+        return bytes(data)
+    return str(data, "utf-8", "surrogatepass")
+
+
+def _hash(flags, data):
+    h = hashlib.blake2b(data, digest_size=8, person=b"%d" % flags)
+    return int.from_bytes(h.digest(), "little") or 1
+
+
+class Store(MutableMapping):
+    """A key -> object store in the files path and path + ".idx". Keys are
+    str or bytes, values any picklable object. Use open() to create one."""
+
+    def __init__(self, path, writable=False, protocol=-1, secure=False,
+                 new=False):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.writable = writable
+        self.unpickler = Unpickler(secure=secure)
+        self.pickler = Pickler(protocol=protocol) if writable else None
+        self.lock = self.data_file = self.data = self.index = None
+        if writable:
+            self._lock()
+            if new or not os.path.exists(self.path):
+                self._create()
+        self._open()
+
+    # opening and closing
+    # -------------------
+
+    def _lock(self):
+        self.lock = io.open(self.path + ".lock", "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:  # pragma: no cover
+                self.lock.seek(0)
+                msvcrt.locking(self.lock.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self.lock.close()
+            self.lock = None
+            raise BlockingIOError(
+                "the store {!r} is opened by another writer".format(
+                    self.path))
+
+    def _create(self, generation=1):
+        with io.open(self.path, "wb") as f:
+            f.write(DATA_HEADER.pack(DATA_MAGIC, generation))
+        self._write_index([], generation, DATA_HEADER.size, 0)
+
+    def _write_index(self, slots, generation, data_size, dead,
+                     capacity=MIN_CAPACITY):
+        """writes a new index for slots (a list of (hash, offset)) and
+        replaces the old one"""
+        while len(slots) > capacity * MAX_LOAD:
+            capacity *= 2
+
+        table = bytearray(INDEX_HEADER.size + capacity * SLOT.size)
+        mask = capacity - 1
+        for h, offset in slots:
+            i = h & mask
+            while SLOT.unpack_from(table, INDEX_HEADER.size + i * SLOT.size)[0]:
+                i = (i + 1) & mask
+            SLOT.pack_into(table, INDEX_HEADER.size + i * SLOT.size, h, offset)
+
+        INDEX_HEADER.pack_into(
+            table, 0, INDEX_MAGIC, generation, 0, capacity, len(slots),
+            len(slots), data_size, dead)
+        tmp = self.index_path + ".tmp"
+        with io.open(tmp, "wb") as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
+
+    def _open(self):
+        for _ in range(100):
+            with io.open(self.index_path,
+                         "r+b" if self.writable else "rb") as f:
+                index = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_WRITE
+                    if self.writable else mmap.ACCESS_READ)
+            data_file = io.open(self.path, "r+b" if self.writable else "rb")
+            magic, generation = DATA_HEADER.unpack(
+                data_file.read(DATA_HEADER.size))
+            if (magic != DATA_MAGIC
+                    or index[:len(INDEX_MAGIC)] != INDEX_MAGIC):
+                data_file.close()
+                raise UnpicklingError("not a store")
+
+            if self._get(index, _GENERATION) == generation:
+                break
+
+            # a compaction replaced the files while they were opened
+            data_file.close()
+            if not (self.writable and self._finish_compact(
+                    self._get(index, _GENERATION))):
+                time.sleep(0.01)
+        else:
+            raise UnpicklingError("the index does not belong to the data")
+
+        self._close_files()
+        self.index = index
+        self.data_file = data_file
+        self.data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.capacity = self._get(index, _CAPACITY)
+        if self.writable:
+            self._recover()
+
+    def _finish_compact(self, generation):
+        """replaces the data file by the one of an interrupted compaction
+        with the generation of the index"""
+        tmp = self.path + ".tmp"
+        try:
+            with io.open(tmp, "rb") as f:
+                header = f.read(DATA_HEADER.size)
+        except FileNotFoundError:
+            return False
+
+        if (len(header) != DATA_HEADER.size
+                or DATA_HEADER.unpack(header) != (DATA_MAGIC, generation)):
+            return False
+        os.replace(tmp, self.path)
+        return True
+
+    def _close_files(self):
+        # values loaded without copy may still use the maps,
+        # they are closed by the garbage collector
+        if self.data_file is not None:
+            self.data_file.close()
+        self.data_file = self.data = self.index = None
+
+    def close(self):
+        if self.writable and self.index is not None:
+            self.index.flush()
+        self._close_files()
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def sync(self):
+        """Flushes the index and the data to disk."""
+        if self.writable:
+            self.data_file.flush()
+            os.fsync(self.data_file.fileno())
+            self.index.flush()
+
+    # index access
+    # ------------
+
+    @staticmethod
+    def _get(index, field):
+        return int.from_bytes(index[field:field + 8], "little")
+
+    def _set(self, field, value):
+        self.index[field:field + 8] = value.to_bytes(8, "little")
+
+    def _check(self):
+        if self.index is None:
+            raise ValueError("the store is closed")
+        if self._get(self.index, _STALE):
+            self._open()
+
+    def _record(self, offset):
+        """returns flags, key and value range of the record at offset"""
+        if offset + RECORD.size > len(self.data):
+            self._remap(offset + RECORD.size)
+
+        flags, key_size, value_size = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        end = start + key_size + value_size
+        if end > len(self.data):
+            self._remap(end)
+        return flags, start, start + key_size, end
+
+    def _remap(self, size):
+        # the writer appended records since the mapping was created
+        self.data = mmap.mmap(
+            self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if size > len(self.data):
+            raise UnpicklingError("the store is damaged")
+
+    def _find(self, flags, key):
+        """returns the slot index, the record offset, the hash of key and
+        the range of the value, or the slot index to insert key and 0"""
+        h = _hash(flags, key)
+        mask = self.capacity - 1
+        i = h & mask
+        free = -1
+        index = self.index
+        while True:
+            slot_hash, offset = SLOT.unpack_from(
+                index, INDEX_HEADER.size + i * SLOT.size)
+            if not slot_hash:
+                return (i if free < 0 else free), 0, h, None
+
+            if not offset:
+                if free < 0:
+                    free = i
+            elif slot_hash == h:
+                rflags, start, key_end, end = self._record(offset)
+                if (rflags & BYTES_KEY == flags
+                        and self.data[start:key_end] == key):
+                    return i, offset, h, (key_end, end)
+            i = (i + 1) & mask
+
+    # mapping interface
+    # -----------------
+
+    def __getitem__(self, key):
+        self._check()
+        flags, kdata = _encode_key(key)
+        value = self._find(flags, kdata)[3]
+        if value is None:
+            raise KeyError(key)
+
+        return self.unpickler.loads(memoryview(self.data)[value[0]:value[1]])
+
+    def __contains__(self, key):
+        self._check()
+        flags, kdata = _encode_key(key)
+        return self._find(flags, kdata)[1] != 0
+
+    def __len__(self):
+        self._check()
+        return self._get(self.index, _COUNT)
+
+    def __iter__(self):
+        self._check()
+        index = self.index
+        for i in range(self.capacity):
+            slot_hash, offset = SLOT.unpack_from(
+                index, INDEX_HEADER.size + i * SLOT.size)
+            if slot_hash and offset:
+                flags, start, key_end, _ = self._record(offset)
+                yield _decode_key(flags, self.data[start:key_end])
+
+    def __setitem__(self, key, value):
+        self._check_writable()
+        flags, kdata = _encode_key(key)
+        i, old, h, _ = self._find(flags, kdata)
+        offset, end = self._append(flags, kdata, self.pickler.dumps(value))
+        self._publish(i, old, h, offset, end)
+
+    def __delitem__(self, key):
+        self._check_writable()
+        flags, kdata = _encode_key(key)
+        i, old, h, _ = self._find(flags, kdata)
+        if not old:
+            raise KeyError(key)
+
+        _, end = self._append(flags | DELETED, kdata, b"")
+        self._publish(i, old, h, 0, end)
+
+    # writing
+    # -------
+
+    def _check_writable(self):
+        if not self.writable:
+            raise PermissionError("the store is opened read only")
+        if self.index is None:
+            raise ValueError("the store is closed")
+
+    def _add(self, field, value):
+        self._set(field, self._get(self.index, field) + value)
+
+    def _append(self, flags, key, value):
+        """writes a record behind the published data"""
+        offset = self._get(self.index, _DATA_SIZE)
+        self.data_file.seek(offset)
+        self.data_file.write(RECORD.pack(flags, len(key), len(value)))
+        self.data_file.write(key)
+        self.data_file.write(value)
+        self.data_file.flush()
+        return offset, self.data_file.tell()
+
+    def _publish(self, i, old, h, offset, end):
+        """makes the record at offset visible in slot i, with offset 0
+        the deletion record ending at end is published"""
+        pos = INDEX_HEADER.size + i * SLOT.size
+        slot_hash = SLOT.unpack_from(self.index, pos)[0]
+        if old:
+            _, start, _, old_end = self._record(old)
+            self._add(_DEAD, old_end - start + RECORD.size)
+        if not offset:
+            self._add(_DEAD, end - self._get(self.index, _DATA_SIZE))
+
+        if offset:
+            # the offset first: readers ignore slots without hash
+            self.index[pos + 8:pos + 16] = offset.to_bytes(8, "little")
+            self.index[pos:pos + 8] = h.to_bytes(8, "little")
+            if not slot_hash:
+                self._add(_USED, 1)
+            if not old:
+                self._add(_COUNT, 1)
+        elif old:
+            self.index[pos + 8:pos + 16] = bytes(8)
+            self._add(_COUNT, -1)
+
+        self._set(_DATA_SIZE, end)
+        if self._get(self.index, _USED) > self.capacity * MAX_LOAD:
+            self._rebuild(self._get(self.index, _GENERATION), end)
+
+    def _live_slots(self):
+        index = self.index
+        for i in range(self.capacity):
+            slot = SLOT.unpack_from(index, INDEX_HEADER.size + i * SLOT.size)
+            if slot[0] and slot[1]:
+                yield slot
+
+    def _rebuild(self, generation, data_size, slots=None, data=None):
+        """replaces the index by a new one without deleted slots, and the
+        data file by data, if it is given"""
+        if slots is None:
+            slots = list(self._live_slots())
+        capacity = self.capacity
+        if len(slots) * 2 > capacity * MAX_LOAD:
+            capacity *= 2
+
+        self._write_index(
+            slots, generation, data_size,
+            0 if data else self._get(self.index, _DEAD), capacity)
+        if data:
+            os.replace(data, self.path)
+        self._set(_STALE, 1)
+        self._open()
+
+    def _recover(self):
+        """adds the records a writer appended but not published before
+        it crashed"""
+        while True:
+            # _publish may rebuild the index, which recovers the
+            # rest of the records.
+            data_size = self._get(self.index, _DATA_SIZE)
+            if data_size + RECORD.size > len(self.data):
+                break
+
+            flags, key_size, value_size = RECORD.unpack_from(
+                self.data, data_size)
+            key_end = data_size + RECORD.size + key_size
+            if key_end + value_size > len(self.data):
+                break
+
+            key = self.data[data_size + RECORD.size:key_end]
+            i, old, h, _ = self._find(flags & BYTES_KEY, key)
+            self._publish(i, old, h, 0 if flags & DELETED else data_size,
+                          key_end + value_size)
+
+        self.data_file.truncate(self._get(self.index, _DATA_SIZE))
+
+    def compact(self):
+        """Rewrites the data file without overwritten and deleted records."""
+        self._check_writable()
+        generation = self._get(self.index, _GENERATION) + 1
+        tmp = self.path + ".tmp"
+        slots = []
+        with io.open(tmp, "wb") as f:
+            f.write(DATA_HEADER.pack(DATA_MAGIC, generation))
+            for h, offset in self._live_slots():
+                _, _, _, end = self._record(offset)
+                slots.append((h, f.tell()))
+                f.write(self.data[offset:end])
+            data_size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+
+        # the new index first, an open finishes an interrupted compaction
+        self._rebuild(generation, data_size, slots, tmp)
+
+    @property
+    def dead_size(self):
+        """the size of the overwritten and deleted records"""
+        self._check()
+        return self._get(self.index, _DEAD)
+
+
+def open(path, flag="c", protocol=-1, secure=False):
+    """Opens the store at path. flag is "r" for read only access, "w"
+    for read and write access, "c" creates the store if it does not
+    exist and "n" always creates a new empty store."""
+    if flag == "r":
+        return Store(path, secure=secure)
+
+    if flag not in ("w", "c", "n"):
+        raise ValueError("flag must be one of 'r', 'w', 'c' or 'n'")
+
+    if flag == "w" and not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    return Store(path, True, protocol, secure, flag == "n")
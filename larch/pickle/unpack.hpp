@@ -23,6 +23,10 @@ struct StringReader {
     memcpy(buffer, data+pos, read_size);
     pos += read_size;
   }
+
+  inline size_t available() {
+    return size - pos;
+  }
 };
 
 
@@ -45,8 +49,10 @@ inline uint32_t index(uint32_t key) {
 
 struct UnrefMap : public vector<PointerPage> {
   uint32_t ref_counter;
+  uint32_t message_start;  // the first ref of a message in a session
+  uint32_t top;  // the highest ref_counter before a set_counter
 
-  UnrefMap() : ref_counter(1) {
+  UnrefMap() : ref_counter(1), message_start(1), top(1) {
     resize(1);
     data()[0].refs[0] = NULL;
   }
@@ -69,6 +75,13 @@ struct UnrefMap : public vector<PointerPage> {
     return ref_counter++;
   }
 
+  void set_counter(uint32_t counter) {
+    // moves the counter for lazy loading, the pages up to counter must exist
+    if (ref_counter > top) top = ref_counter;
+    if (page(counter) >= size()) resize(page(counter)+1);
+    ref_counter = counter;
+  }
+
   inline void stamp(uint32_t refid, PyObject* o) {
     Py_INCREF(o);
     (*this)[page(refid)].refs[index(refid)] = o;
@@ -79,7 +92,9 @@ struct UnrefMap : public vector<PointerPage> {
   }
 
   uint32_t reset() {
-    uint32_t i, j, end, val = ref_counter-1;
+    uint32_t i, j, end, val;
+    if (top > ref_counter) ref_counter = top;
+    val = ref_counter-1;
     PyObject **p;
     for(i = 0; i < ref_counter; i += 1024) {
       p = &data()[page(i)].refs[0];
@@ -90,7 +105,20 @@ struct UnrefMap : public vector<PointerPage> {
         *p = NULL;
       }
     }
-    ref_counter = 1;
+    ref_counter = message_start = top = 1;
+    return val;
+  }
+
+  uint32_t end_message() {
+    /* short or interned strings and classes stay referenceable for the
+       next messages, like in RefHandler::end_message */
+    uint32_t i, val = ref_counter - message_start;
+    for(i = message_start; i < ref_counter; i++) {
+      PyObject*& o = (*this)[page(i)].refs[index(i)];
+      if (o && !is_session_string(o) && !PyType_Check(o))
+        Py_CLEAR(o);
+    }
+    message_start = ref_counter;
     return val;
   }
 };
@@ -104,12 +132,14 @@ struct Unpacker {
   typedef vector<char> buffer_t;
   PyObject *unpickler;
   read_t do_read;
+  StringReader *window;  // buffered input, do_read is called if exhausted
   UnrefMap refs;
   buffer_t read_buffer;
   size_t min_string_size_for_ref;
 
   Unpacker(PyObject *unpickler):
-      unpickler(unpickler), min_string_size_for_ref(MIN_STRING_SIZE_FOR_REF) {
+      unpickler(unpickler), window(NULL),
+      min_string_size_for_ref(MIN_STRING_SIZE_FOR_REF) {
     reset();
   }
 
@@ -117,6 +147,18 @@ struct Unpacker {
     return refs.reset();
   }
 
+  uint32_t end_message() {
+    return refs.end_message();
+  }
+
+  inline uint32_t get_counter() {
+    return refs.ref_counter;
+  }
+
+  inline void set_counter(uint32_t counter) {
+    refs.set_counter(counter);
+  }
+
   inline PyObject* get_stamped_ref(uint32_t ref) {
     return refs.get(ref);
   }
@@ -140,19 +182,31 @@ struct Unpacker {
   }
 
   inline void read(void* data, size_t size) {
-    if (do_read(unpickler, data, size) == -1)
+    if (window && window->available() >= size) {
+      memcpy(data, window->data+window->pos, size);
+      window->pos += size;
+    }
+    else if (do_read(unpickler, data, size) == -1)
       throw PythonError();
   }
 
+  inline const char* consume(size_t size) {
+    // returns a pointer into the input window or NULL if the window is too small
+    if (window && window->available() >= size) {
+      const char* result = window->data+window->pos;
+      window->pos += size;
+      return result;
+    }
+    return NULL;
+  }
+
   template<typename T> inline void read(T& value) {
-    if (do_read(unpickler, &value, sizeof(value)) == -1)
-      throw PythonError();
+    read(&value, sizeof(value));
     decode(value);
   }
 
   inline void read8(uint8_t* value) {
-    if (do_read(unpickler, value, sizeof(uint8_t)) == -1)
-      throw PythonError();
+    read(value, sizeof(uint8_t));
   }
   inline void read16(uint16_t* value) {
     read(*value);
@@ -483,11 +537,18 @@ inline PyObject* _load_bytes(Unpacker* p, size_t size, int interned) {
 
 inline PyObject* _load_unicode(Unpacker* p, size_t size, int interned) {
   PyObject* result = NULL;
+  const char* data;
 
-  p->read_buffer.reserve(size);
-  try {
+  // decode directly from the input buffer if possible
+  data = p->consume(size);
+  if (!data) {
+    p->read_buffer.reserve(size);
     p->read(p->read_buffer.data(), size);
-    result = PyUnicode_DecodeUTF8(p->read_buffer.data(), size, "surrogatepass");
+    data = p->read_buffer.data();
+  }
+
+  try {
+    result = PyUnicode_DecodeUTF8(data, size, "surrogatepass");
     if (!result)
       throw PythonError();
 
@@ -496,7 +557,7 @@ inline PyObject* _load_unicode(Unpacker* p, size_t size, int interned) {
       PyUnicode_InternInPlace(&result);
 #endif
 
-    if (PyUnicode_GET_LENGTH(result) > p->min_string_size_for_ref)
+    if ((size_t)PyUnicode_GET_LENGTH(result) > p->min_string_size_for_ref)
       p->stamp(result);
   }
   catch(...) {
@@ -566,6 +627,485 @@ inline PyObject* load_bytes(Unpacker* p, uint8_t code, size_t size) {
   return bin;
 }
 
+inline PyObject* load_bytearray(Unpacker* p, uint8_t code, size_t size) {
+  PyObject* bin = PyByteArray_FromStringAndSize(NULL, size);
+  if (!bin)
+    throw PythonError();
+
+  try {
+    p->read(PyByteArray_AS_STRING(bin), size);
+    p->stamp(bin);
+  } catch(...) {
+    Py_XDECREF(bin);
+    throw;
+  }
+  return bin;
+}
+
+
+static PyObject* unpickling_error = NULL;  // set by pickle.pyx
+
+
+inline PyObject* typed_item(double v) { return PyFloat_FromDouble(v); }
+inline PyObject* typed_item(int64_t v) { return PyLong_FromLongLong(v); }
+inline PyObject* typed_item(uint64_t v) { return PyLong_FromUnsignedLongLong(v); }
+
+template<typename T, typename V>
+PyObject* _typed_sequence(uint8_t kind, const char* data, size_t count) {
+  // V is the type of the python value: double, int64_t or uint64_t
+  size_t i;
+  T value;
+  PyObject *r, *o;
+
+  r = kind == TYPED_TUPLE ? PyTuple_New(count) : PyList_New(count);
+  if (!r)
+    throw PythonError();
+
+  for(i = 0; i < count; i++, data += sizeof(T)) {
+    memcpy(&value, data, sizeof(T));
+    little_endian_inplace(value);
+    o = typed_item((V)value);
+    if (!o) {
+      Py_DECREF(r);
+      throw PythonError();
+    }
+    if (kind == TYPED_TUPLE)
+      PyTuple_SET_ITEM(r, i, o);
+    else
+      PyList_SET_ITEM(r, i, o);
+  }
+  return r;
+}
+
+inline PyObject* typed_sequence(uint8_t kind, uint8_t element,
+                                const char* data, size_t count) {
+  // returns a list or tuple (kind) of the typed array data
+  switch(element) {
+    case 'b': return _typed_sequence<int8_t, int64_t>(kind, data, count);
+    case 'B': return _typed_sequence<uint8_t, int64_t>(kind, data, count);
+    case 'h': return _typed_sequence<int16_t, int64_t>(kind, data, count);
+    case 'H': return _typed_sequence<uint16_t, int64_t>(kind, data, count);
+    case 'i': return _typed_sequence<int32_t, int64_t>(kind, data, count);
+    case 'I': return _typed_sequence<uint32_t, int64_t>(kind, data, count);
+    case 'q': return _typed_sequence<int64_t, int64_t>(kind, data, count);
+    case 'Q': return _typed_sequence<uint64_t, uint64_t>(kind, data, count);
+    case 'f': return _typed_sequence<float, double>(kind, data, count);
+    case 'd': return _typed_sequence<double, double>(kind, data, count);
+  }
+  PyErr_SetString(unpickling_error, "invalid typed array");
+  throw PythonError();
+}
+
+
+inline PyObject* load_shape(Unpacker* p, uint8_t code, size_t size) {
+  // a dict: the key tuple followed by the values
+  size_t i;
+  PyObject *r = new_presized_dict(size), *keys = NULL, *value = NULL;
+  if (!r)
+    throw PythonError();
+
+  try {
+    p->stamp(r);
+    keys = p->load();
+    if (!PyTuple_CheckExact(keys) || (size_t)PyTuple_GET_SIZE(keys) != size) {
+      PyErr_SetString(unpickling_error, "invalid dict shape");
+      throw PythonError();
+    }
+
+    for (i = 0; i < size; i++) {
+      value = p->load();
+      if (PyDict_SetItem(r, PyTuple_GET_ITEM(keys, i), value) < 0)
+        throw PythonError();
+
+      Py_DECREF(value);
+      value = NULL;
+    }
+  }
+  catch(...) {
+    Py_XDECREF(keys);
+    Py_XDECREF(value);
+    Py_XDECREF(r);
+    throw;
+  }
+
+  Py_DECREF(keys);
+  return r;
+}
+
+
+struct Skipper {
+  /* Walks over encoded values without creating python objects. It counts
+     the references a load would stamp, so a value found by the walker can
+     be loaded later with the correct reference ids. */
+  enum FrameKind {COUNT, UNTIL_END, NDARRAY_DATA};
+
+  struct Frame {
+    uint8_t kind;
+    uint64_t remaining;
+    Frame(uint8_t kind, uint64_t remaining) : kind(kind), remaining(remaining) {}
+  };
+
+  const char* data;
+  size_t pos, size;
+  uint32_t counter;  // the next reference id, like UnrefMap::ref_counter
+  size_t min_string_size_for_ref;
+  uint64_t last_int;  // the value of the last integer token
+  vector<Frame> stack;
+
+  Skipper() : data(NULL), pos(0), size(0), counter(1),
+              min_string_size_for_ref(MIN_STRING_SIZE_FOR_REF),
+              last_int(0) {}
+
+  void error(const char* msg) {
+    PyErr_SetString(unpickling_error ? unpickling_error : PyExc_ValueError, msg);
+    throw PythonError();
+  }
+
+  inline const char* advance(size_t n) {
+    if (n > size - pos) {
+      PyErr_SetNone(PyExc_EOFError);
+      throw PythonError();
+    }
+    const char* result = data + pos;
+    pos += n;
+    return result;
+  }
+
+  template<typename T> inline T read() {
+    T value;
+    memcpy(&value, advance(sizeof(T)), sizeof(T));
+    decode(value);
+    return value;
+  }
+
+  inline void push(uint8_t kind, uint64_t remaining=0) {
+    stack.push_back(Frame(kind, remaining));
+  }
+
+  inline void skip_string(size_t n) {
+    // strings are referenced if they have more code points than the limit
+    const unsigned char *s = (const unsigned char*)advance(n), *end = s + n;
+    size_t points = 0;
+    if (n <= min_string_size_for_ref) return;
+    for(; s < end && points <= min_string_size_for_ref; s++)
+      if ((*s & 0xC0) != 0x80) points++;
+    if (points > min_string_size_for_ref) counter++;
+  }
+
+  inline void skip_import(size_t n, uint64_t values) {
+    // an import is a 32 bit extension code or module and name
+    if (n == 0)
+      advance(4);
+    else
+      values += 2;
+    if (values) push(COUNT, values);
+  }
+
+  uint64_t read_uint() {
+    uint8_t code = read<uint8_t>();
+    if (code < 0x80) return code;
+    switch(code) {
+      case 0xcc: return read<uint8_t>();
+      case 0xcd: return read<uint16_t>();
+      case 0xce: return read<uint32_t>();
+      case 0xcf: return read<uint64_t>();
+    }
+    error("size expected");
+    return 0;
+  }
+
+  void skip_ext(size_t n) {
+    uint8_t type = read<uint8_t>();
+    switch(type) {
+      case VERSION:
+        min_string_size_for_ref = read<uint8_t>() < 4 ? 5 : 3;
+        push(COUNT, 1);
+        break;
+
+      case LONG:
+        advance(n);
+        counter++;
+        break;
+
+      case LIST:
+        counter++;
+        if (n) push(COUNT, n);
+        break;
+
+      case OBJECT:
+        counter++;
+        push(UNTIL_END);
+        push(UNTIL_END);
+        push(COUNT, 3);
+        break;
+
+      case OBJECT_NEW:
+      case OBJECT_NEW_CUSTOM:
+        counter++;
+        push(UNTIL_END);
+        push(UNTIL_END);
+        push(COUNT, 2);
+        break;
+
+      case FAST_NEW:
+        counter++;
+        if (n >= 5) push(UNTIL_END);
+        if (n >= 4) push(UNTIL_END);
+        push(COUNT, n >= 3 ? 2 : 1);
+        break;
+
+      case GLOBAL:
+        skip_import(n, 0);
+        break;
+
+      case SINGLETON:
+      case GLOBAL_OBJECT:
+        counter++;
+        skip_import(n, 0);
+        break;
+
+      case OLD_STYLE:
+      case INIT_ARGS:
+        counter++;
+        skip_import(n, 1);
+        break;
+
+      case END_OBJECT_ITEMS:
+        break;
+
+      case BYTES:
+        advance(n);
+        if (n > min_string_size_for_ref) counter++;
+        break;
+
+      case UNISTR:
+        skip_string(n);
+        break;
+
+      case BYTEARRAY:
+        advance(n);
+        counter++;
+        break;
+
+      case OOB_BUFFER:
+        counter++;
+        break;
+
+      case NDARRAY:
+        counter++;
+        push(NDARRAY_DATA);
+        push(COUNT, 3);  // dtype, shape and data size
+        break;
+
+      case RECORD:
+      case SESSION:
+        push(COUNT, 1);
+        break;
+
+      case SHAPE:
+        counter++;
+        push(COUNT, (uint64_t)n + 1);  // key tuple and values
+        break;
+
+      case TYPED_ARRAY:
+        counter++;
+        advance(n + 2);  // kind, element and data
+        break;
+
+      case CHUNKED: {
+        uint64_t chunks = read_uint();
+        for(; chunks; chunks--)
+          advance(read_uint());
+        break;
+      }
+
+      case COMPRESSED: {
+        // frames with a 32 bit length up to an empty one
+        uint32_t frame;
+        while ((frame = read<uint32_t>()))
+          advance(frame);
+        break;
+      }
+
+      default:
+        error("cannot skip this extension type");
+    }
+  }
+
+  void token() {
+    // walks over the next token, values within the token are pushed
+    // on the stack
+    uint8_t code = read<uint8_t>();
+
+    if (!stack.empty()) {
+      Frame& top = stack.back();
+      if (top.kind == UNTIL_END) {
+        if (is_end_item(code)) {
+          pos++;
+          stack.pop_back();
+          return;
+        }
+      }
+      else if (top.kind == COUNT && top.remaining) {
+        top.remaining--;
+      }
+    }
+
+    if (code < 0x80) { last_int = code; return; }
+    if (code >= 0xe0) return;  // negative fixint
+    if (code < 0x90) { counter++; if (code & 0xf) push(COUNT, (code & 0xf) << 1); return; }
+    if (code < 0xa0) { counter++; if (code & 0xf) push(COUNT, code & 0xf); return; }
+    if (code < 0xc0) { skip_string(code - 0xa0); return; }
+
+    switch(code) {
+      case 0xc0: case 0xc2: case 0xc3: return;
+      case 0xc1: advance(4); return;
+      case 0xc4: skip_string(read<uint8_t>()); return;
+      case 0xc5: skip_string(read<uint16_t>()); return;
+      case 0xc6: skip_string(read<uint32_t>()); return;
+      case 0xc7: skip_ext(read<uint8_t>()); return;
+      case 0xc8: skip_ext(read<uint16_t>()); return;
+      case 0xc9: skip_ext(read<uint32_t>()); return;
+      case 0xcb: advance(8); return;
+      case 0xcc: last_int = read<uint8_t>(); return;
+      case 0xcd: last_int = read<uint16_t>(); return;
+      case 0xce: last_int = read<uint32_t>(); return;
+      case 0xcf: last_int = read<uint64_t>(); return;
+      case 0xd0: last_int = read<int8_t>(); return;
+      case 0xd1: last_int = read<int16_t>(); return;
+      case 0xd2: last_int = read<int32_t>(); return;
+      case 0xd3: last_int = read<int64_t>(); return;
+      case 0xd4: case 0xd5: case 0xd6: case 0xd7: case 0xd8:
+        skip_ext(1 << (code - 0xd4)); return;
+      case 0xd9: skip_string(read<uint8_t>()); return;
+      case 0xda: skip_string(read<uint16_t>()); return;
+      case 0xdb: skip_string(read<uint32_t>()); return;
+      case 0xdc: { uint16_t n = read<uint16_t>(); counter++; if (n) push(COUNT, n); return; }
+      case 0xdd: { uint32_t n = read<uint32_t>(); counter++; if (n) push(COUNT, n); return; }
+      case 0xde: { uint16_t n = read<uint16_t>(); counter++; if (n) push(COUNT, (uint64_t)n << 1); return; }
+      case 0xdf: { uint32_t n = read<uint32_t>(); counter++; if (n) push(COUNT, (uint64_t)n << 1); return; }
+    }
+    error("cannot skip an invalid code");
+  }
+
+  inline bool is_end_item(uint8_t code) {
+    return code == 0xd4 && pos < size
+      && (uint8_t)data[pos] == END_OBJECT_ITEMS;
+  }
+
+  void pop_frames(size_t depth) {
+    while (stack.size() > depth) {
+      Frame& top = stack.back();
+      if (top.kind == COUNT && !top.remaining) {
+        stack.pop_back();
+      }
+      else if (top.kind == NDARRAY_DATA) {
+        // the padding count, the padding and the data
+        size_t available = size - pos, padding;
+        if (!available
+            || (padding = (uint8_t)data[pos]) >= available
+            || last_int > available - padding - 1) {
+          PyErr_SetNone(PyExc_EOFError);
+          throw PythonError();
+        }
+        stack.pop_back();
+        advance(padding + 1 + last_int);
+      }
+      else
+        break;
+    }
+  }
+
+  void skip_value() {
+    // advances pos behind the next value
+    size_t depth = stack.size();
+    push(COUNT, 1);
+    do {
+      token();
+      pop_frames(depth);
+    } while (stack.size() > depth);
+  }
+
+  void begin() {
+    // starts a walk over the next value with resume()
+    stack.clear();
+    push(COUNT, 1);
+  }
+
+  bool resume() {
+    /* walks over the tokens up to size, returns true if the value begun
+       with begin() is complete. An incomplete token at the end is left to
+       the next call, data and size may grow in between. */
+    while (true) {
+      try {
+        pop_frames(0);
+      }
+      catch(PythonError&) {
+        // the frames popped before are done
+        if (!PyErr_ExceptionMatches(PyExc_EOFError)) throw;
+        PyErr_Clear();
+        return false;
+      }
+      if (stack.empty())
+        return true;
+
+      size_t old_pos = pos, depth = stack.size();
+      Frame top = stack.back();
+      uint32_t old_counter = counter;
+      size_t old_min_size = min_string_size_for_ref;
+      uint64_t old_last_int = last_int;
+      try {
+        token();
+      }
+      catch(PythonError&) {
+        if (!PyErr_ExceptionMatches(PyExc_EOFError)) throw;
+        PyErr_Clear();
+        // a token only changes the top frame and pushes new ones
+        while (stack.size() > depth) stack.pop_back();
+        stack.back() = top;
+        pos = old_pos;
+        counter = old_counter;
+        min_string_size_for_ref = old_min_size;
+        last_int = old_last_int;
+        return false;
+      }
+    }
+  }
+
+  int container(size_t& n) {
+    /* reads the header of a container at pos: returns 1 for a dict,
+       2 for a tuple, 3 for a list and 4 for a dict with a shape (the key
+       tuple follows) and n is the item count.
+       Returns 0 for any other value and leaves pos unchanged. */
+    size_t old = pos;
+    uint8_t code = read<uint8_t>();
+    if ((code & 0xf0) == 0x80) { n = code & 0xf; return 1; }
+    if ((code & 0xf0) == 0x90) { n = code & 0xf; return 2; }
+    switch(code) {
+      case 0xde: n = read<uint16_t>(); return 1;
+      case 0xdf: n = read<uint32_t>(); return 1;
+      case 0xdc: n = read<uint16_t>(); return 2;
+      case 0xdd: n = read<uint32_t>(); return 2;
+      case 0xd4: case 0xd5: case 0xd6: case 0xd7: case 0xd8:
+        n = 1 << (code - 0xd4); break;
+      case 0xc7: n = read<uint8_t>(); break;
+      case 0xc8: n = read<uint16_t>(); break;
+      case 0xc9: n = read<uint32_t>(); break;
+      default: pos = old; return 0;
+    }
+    if (pos < size && (uint8_t)data[pos] == LIST) {
+      pos++;
+      return 3;
+    }
+    if (pos < size && (uint8_t)data[pos] == SHAPE) {
+      pos++;
+      return 4;
+    }
+    pos = old;
+    return 0;
+  }
+};
+
 /*
  #include <unistd.h>
  #include <signal.h>
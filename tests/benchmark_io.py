@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Compares loading and dumping through file objects with the in memory
+# functions
+#
+import io
+import os
+import sys
+import tempfile
+from timeit import timeit
+import larch.pickle as spickle
+
+LOOPS = 10
+
+
+def make_documents():
+    return [{"id": i, "name": "item{}".format(i), "value": i * 0.5,
+             "tags": ["a", "b", str(i % 7)]} for i in range(100000)]
+
+
+def measure_load(documents, loops=LOOPS):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with open(path, "wb") as f:
+            spickle.dump(documents, f)
+
+        def load_file():
+            with open(path, "rb") as f:
+                spickle.load(f)
+
+        def load_read():
+            with open(path, "rb") as f:
+                spickle.loads(f.read())
+
+        def load_path():
+            spickle.load_path(path)
+
+        data = spickle.dumps(documents)
+
+        def load_bytesio():
+            spickle.load(io.BytesIO(data))
+
+        return [
+            ("load(f)", timeit(load_file, number=loops)),
+            ("loads(f.read())", timeit(load_read, number=loops)),
+            ("load_path(path)", timeit(load_path, number=loops)),
+            ("load(BytesIO)", timeit(load_bytesio, number=loops)),
+        ]
+    finally:
+        os.remove(path)
+
+
+def measure_dump(documents, loops=LOOPS):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        def dump_file():
+            with open(path, "wb") as f:
+                spickle.dump(documents, f)
+
+        def dump_write():
+            with open(path, "wb") as f:
+                f.write(spickle.dumps(documents))
+
+        def dump_bytesio():
+            spickle.dump(documents, io.BytesIO())
+
+        return [
+            ("dump(f)", timeit(dump_file, number=loops)),
+            ("f.write(dumps())", timeit(dump_write, number=loops)),
+            ("dump(BytesIO)", timeit(dump_bytesio, number=loops)),
+        ]
+    finally:
+        os.remove(path)
+
+
+def show(title, table, loops=LOOPS):
+    print("{} ({} loops)".format(title, loops))
+    for name, seconds in table:
+        print("  {:<20} {:.5f}".format(name, seconds))
+    print()
+
+
+def main():
+    documents = make_documents()
+    show("load", measure_load(documents))
+    show("dump", measure_dump(documents))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# Latency of the module functions for small messages, compared with a
+# new Pickler/Unpickler for every message and the standard pickle module
+#
+import sys
+import pickle
+from timeit import repeat
+import larch.pickle as spickle
+
+LOOPS = 100000
+
+MESSAGES = [
+    ("int", 42),
+    ("short str", "hello"),
+    ("tuple", ("call", 17, "method", (1, 2.5))),
+    ("request", {"id": 1234, "method": "get_item",
+                 "params": {"key": "a", "limit": 10}}),
+    ("list of dicts", [{"x": i, "y": -i} for i in range(5)]),
+]
+
+
+def measure(obj, loops=LOOPS):
+    data = spickle.dumps(obj)
+    std_data = pickle.dumps(obj, -1)
+    functions = [
+        ("dumps", lambda: spickle.dumps(obj)),
+        ("Pickler().dumps", lambda: spickle.Pickler().dumps(obj)),
+        ("pickle.dumps", lambda: pickle.dumps(obj, -1)),
+        ("loads", lambda: spickle.loads(data)),
+        ("Unpickler().loads", lambda: spickle.Unpickler().loads(data)),
+        ("pickle.loads", lambda: pickle.loads(std_data)),
+    ]
+    return [(name, min(repeat(f, number=loops, repeat=5)) / loops * 1e9)
+            for name, f in functions]
+
+
+def main():
+    for title, obj in MESSAGES:
+        print("{} ({} bytes)".format(title, len(spickle.dumps(obj))))
+        for name, ns in measure(obj):
+            print("  {:<20} {:8.0f} ns".format(name, ns))
+        print()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
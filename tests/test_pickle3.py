@@ -1,7 +1,11 @@
 import io
 import unittest
+import unittest.mock
 import pickle as opickle
 import larch.pickle as pickle
+from larch.pickle import store
+from larch.pickle.channel import Channel
+from larch.pickle.aio import StreamUnpickler, dump_to
 import sys
 import os
 import copyreg
@@ -9,7 +13,19 @@ import platform
 import builtins
 import operator
 import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import array
+import mmap
+import tracemalloc
+import asyncio
 from enum import StrEnum
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from http.cookies import SimpleCookie
 from test.support import TestFailed, _2G, _4G, bigmemtest, set_memlimit
 try:
@@ -23,7 +39,7 @@ from pickle import bytes_types
 # Tests that try a number of pickle protocols should have a
 #     for proto in protocols:
 # kind of outer loop.
-protocols = [3, 4]
+protocols = [3, 4, 5]
 
 character_size = 4 if sys.maxunicode > 0xFFFF else 2
 
@@ -1242,5 +1258,1420 @@ class TestLarchBugs(unittest.TestCase):
 
 
 
+class BufferLoadTests(unittest.TestCase):
+    data = {"key": ["abcdefg", "abcdefg", 1.5, b"bytes"], "x": (1, 2)}
+
+    def test_buffer_types(self):
+        s = pickle.dumps(self.data)
+        buffers = [
+            memoryview(s), bytearray(s), array.array("B", s),
+            memoryview(b"xx" + s + b"yy")[2:-2]]
+        unpickler = pickle.Unpickler()
+        for b in buffers:
+            self.assertEqual(pickle.loads(b), self.data)
+            self.assertEqual(unpickler.loads(b), self.data)
+
+    def test_buffer_released(self):
+        s = bytearray(pickle.dumps(self.data))
+        unpickler = pickle.Unpickler()
+        self.assertEqual(unpickler.loads(s), self.data)
+        s.extend(b"resizable again")
+
+        s = bytearray(pickle.dumps(self.data))
+        self.assertRaises(EOFError, unpickler.loads, s[:-3])
+        s.extend(b"resizable again")
+
+    def test_load_path(self):
+        try:
+            with open(TESTFN, "wb") as f:
+                pickle.dump(self.data, f)
+                pickle.dump([1, 2], f)
+
+            self.assertEqual(pickle.load_path(TESTFN), self.data)
+            unpickler = pickle.Unpickler.from_mmap(TESTFN)
+            self.assertEqual(unpickler.load(), self.data)
+            self.assertEqual(unpickler.load(), [1, 2])
+            self.assertRaises(EOFError, unpickler.load)
+
+            with open(TESTFN, "rb") as f:
+                unpickler = pickle.Unpickler.from_mmap(f)
+            self.assertEqual(unpickler.load(), self.data)
+
+            with open(TESTFN, "wb") as f:
+                pass
+            self.assertRaises(EOFError, pickle.load_path, TESTFN)
+        finally:
+            os.remove(TESTFN)
+
+    def test_mmap(self):
+        s = pickle.dumps(self.data)
+        m = mmap.mmap(-1, len(s))
+        m.write(s)
+        self.assertEqual(pickle.loads(m), self.data)
+        m.close()
+
+
+class ReadOnlyFile:
+    def __init__(self, data):
+        self.read = io.BytesIO(data).read
+
+
+class BufferedReaderTests(unittest.TestCase):
+    data = [(x, str(x)) for x in range(200)] + [b"abcde" * 100, len]
+
+    def test_buffer_sizes(self):
+        pickled = pickle.dumps(self.data)
+        for buffer_size in (1, 7, 64, len(pickled), 0x10000):
+            f = io.BytesIO(pickled * 3)
+            unpickler = pickle.Unpickler(f, buffer_size=buffer_size)
+            for i in range(3):
+                self.assertEqual(unpickler.load(), self.data)
+                self.assertEqual(f.tell(), (i + 1) * len(pickled))
+            self.assertRaises(EOFError, unpickler.load)
+
+    def test_read_only_file(self):
+        pickled = pickle.dumps(self.data)
+        unpickler = pickle.Unpickler(ReadOnlyFile(pickled * 2), buffer_size=16)
+        self.assertEqual(unpickler.load(), self.data)
+        self.assertEqual(unpickler.load(), self.data)
+        self.assertRaises(EOFError, unpickler.load)
+
+    def test_truncated(self):
+        pickled = pickle.dumps(self.data)
+        f = io.BytesIO(pickled[:-1])
+        self.assertRaises(EOFError, pickle.load, f)
+
+
+class RecordingFile(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.sizes = []
+
+    def write(self, data):
+        self.sizes.append(len(data))
+        return super().write(data)
+
+
+class BufferedWriterTests(unittest.TestCase):
+    data = [(x, str(x)) for x in range(2000)]
+
+    def test_coalesced_writes(self):
+        f = RecordingFile()
+        pickle.Pickler(f, buffer_size=4096).dump(self.data)
+        self.assertEqual(pickle.loads(f.getvalue()), self.data)
+        self.assertEqual(f.getvalue(), pickle.dumps(self.data))
+        self.assertTrue(all(s <= 4096 for s in f.sizes))
+        self.assertLess(len(f.sizes), len(f.getvalue()) // 1000)
+
+    def test_write_through(self):
+        payload = b"x" * 100000
+        f = RecordingFile()
+        pickle.Pickler(f, buffer_size=1024).dump([1, payload, 2])
+        self.assertIn(len(payload), f.sizes)
+        self.assertEqual(pickle.loads(f.getvalue()), [1, payload, 2])
+
+    def test_flush(self):
+        f = RecordingFile()
+        pickler = pickle.Pickler(f)
+        pickler.dump(1)
+        pickler.dump(2)
+        pickler.flush()
+        self.assertEqual(f.sizes, [4, 4])
+
+    def test_error_discards_output(self):
+        f = RecordingFile()
+        pickler = pickle.Pickler(f)
+        self.assertRaises(pickle.PicklingError, pickler.dump, [1, iter([])])
+        pickler.dump(3)
+        self.assertEqual(pickle.loads(f.getvalue()), 3)
+
+    def test_kept_chunks(self):
+        chunks = []
+
+        class Collector:
+            write = chunks.append
+
+        pickle.Pickler(Collector(), buffer_size=1024).dump(self.data)
+        self.assertTrue(all(type(c) is bytes for c in chunks))
+        self.assertEqual(pickle.loads(b"".join(chunks)), self.data)
+
+    def test_short_write(self):
+        class ShortFile:
+            def write(self, data):
+                return len(data) // 2
+
+        self.assertRaises(OSError, pickle.dump, self.data, ShortFile())
+
+
+class OutOfBandBufferTests(unittest.TestCase):
+    payload = b"x" * 10000
+
+    def test_native_buffers(self):
+        writable = bytearray(b"abc")
+        data = [writable, writable, memoryview(b"abcdef"),
+                memoryview(bytearray(b"xyz")), opickle.PickleBuffer(b"123456")]
+        result = pickle.loads(pickle.dumps(data))
+        self.assertEqual(result, [b"abc", b"abc", b"abcdef", b"xyz", b"123456"])
+        self.assertEqual(
+            [type(x) for x in result],
+            [bytearray, bytearray, bytes, bytearray, bytes])
+        self.assertIs(result[0], result[1])
+
+    def test_old_protocol(self):
+        data = bytearray(b"abc")
+        self.assertEqual(pickle.loads(pickle.dumps(data, 4)), data)
+        self.assertRaises(TypeError, pickle.dumps, memoryview(b"abc"), 4)
+
+    def test_out_of_band(self):
+        writable = bytearray(self.payload)
+        original = [writable, writable, self.payload,
+                    memoryview(self.payload), b"small"]
+        buffers = []
+        result = pickle.dumps(original, buffer_callback=buffers.append)
+        self.assertEqual(buffers, [])
+        loaded = pickle.loads(result, buffers=buffers)
+        self.assertEqual(loaded, original)
+        self.assertEqual(
+            [type(x) for x in loaded],
+            [bytearray, bytearray, bytes, bytes, bytes])
+        self.assertIs(loaded[0], loaded[1])
+        # like python's pickle
+        opickle.dumps(original[:3], 5, buffer_callback=buffers.append)
+        self.assertEqual(buffers, [])
+
+        data = [opickle.PickleBuffer(writable),
+                opickle.PickleBuffer(self.payload), b"small"]
+        result = pickle.dumps(data, buffer_callback=buffers.append)
+        self.assertLess(len(result), 100)
+        self.assertEqual(len(buffers), 2)
+        self.assertTrue(all(isinstance(b, opickle.PickleBuffer) for b in buffers))
+
+        loaded = pickle.loads(result, buffers=buffers)
+        self.assertIs(loaded[0], buffers[0])
+        self.assertIs(loaded[1], buffers[1])
+        self.assertEqual(loaded[2], b"small")
+
+    def test_in_band_callback(self):
+        data = [bytearray(self.payload), self.payload]
+        result = pickle.dumps(
+            [opickle.PickleBuffer(x) for x in data],
+            buffer_callback=lambda b: True)
+        loaded = pickle.loads(result)
+        self.assertEqual(loaded, data)
+        self.assertEqual([type(x) for x in loaded], [bytearray, bytes])
+
+    def test_threshold(self):
+        buffers = []
+        pickler = pickle.Pickler(
+            buffer_callback=buffers.append, oob_threshold=100)
+        result = pickler.dumps([opickle.PickleBuffer(b"x" * 99),
+                                opickle.PickleBuffer(b"y" * 100)])
+        self.assertEqual(len(buffers), 1)
+        loaded = pickle.Unpickler().loads(result, buffers=buffers)
+        self.assertEqual(loaded[0], b"x" * 99)
+        self.assertEqual(bytes(loaded[1]), b"y" * 100)
+
+    def test_missing_buffers(self):
+        buffers = []
+        result = pickle.dumps(
+            [opickle.PickleBuffer(self.payload),
+             opickle.PickleBuffer(self.payload[1:])],
+            buffer_callback=buffers.append)
+        self.assertRaises(pickle.UnpicklingError, pickle.loads, result)
+        self.assertRaises(
+            pickle.UnpicklingError, pickle.loads, result, buffers=buffers[:1])
+
+    def test_file(self):
+        f = io.BytesIO()
+        buffers = []
+        pickle.dump(opickle.PickleBuffer(self.payload), f,
+                    buffer_callback=buffers.append)
+        f.seek(0)
+        self.assertEqual(
+            bytes(pickle.load(f, buffers=buffers)), self.payload)
+
+    def test_protocol_check(self):
+        self.assertRaises(
+            ValueError, pickle.Pickler, protocol=4, buffer_callback=list)
+
+
+@unittest.skipUnless(numpy, "needs numpy")
+class NumPyTests(unittest.TestCase):
+    def check(self, array, **kwargs):
+        result = pickle.loads(pickle.dumps(array), **kwargs)
+        self.assertIs(type(result), type(array))
+        self.assertEqual(result.dtype, array.dtype)
+        self.assertEqual(result.shape, array.shape)
+        self.assertTrue(numpy.array_equal(result, array))
+        return result
+
+    def test_arrays(self):
+        a = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+        self.assertTrue(self.check(a).flags.c_contiguous)
+        self.assertTrue(self.check(a.T).flags.f_contiguous)
+        self.check(a[:, ::2])
+        self.check(numpy.array(5))
+        self.check(numpy.zeros((0, 3)))
+        self.check(numpy.array(["ab", "c"]))
+        self.check(numpy.arange(3, dtype=">i8"))
+        self.check(numpy.array(["2020-01-01"], dtype="M8[D]"))
+
+    def test_fallback(self):
+        self.check(numpy.zeros(3, dtype=[("a", "i4"), ("b", "f8")]))
+        self.check(numpy.arange(3).view(numpy.recarray))
+        result = pickle.loads(pickle.dumps(numpy.array([1, None])))
+        self.assertEqual(list(result), [1, None])
+        self.assertEqual(pickle.dumps(numpy.arange(3), 4),
+                         pickle.dumps(numpy.arange(3), 4))
+
+    def test_invalid(self):
+        data = pickle.dumps(numpy.arange(4, dtype="i1").reshape(2, 2))
+        for old, new in [(b"\xa3|i1", b"\xa3|x1"),  # unknown dtype
+                         (b"\xa3|i1", b"\xa4i4,("),  # broken dtype
+                         (b"\xa3|i1", b"\xa5i2,i2"),  # structured dtype
+                         (b"\x92\x02\x02", b"\x92\xfe\xfe"),  # negative shape
+                         (b"\x92\x02\x02", b"\x92\x02\xa1x")]:
+            self.assertRaises(pickle.UnpicklingError,
+                              pickle.loads, data.replace(old, new, 1))
+
+    def test_zero_copy(self):
+        a = numpy.arange(100, dtype=numpy.int64)
+        data = pickle.dumps([a, a])
+        result = pickle.loads(data, zero_copy=True)
+        self.assertIs(result[0], result[1])
+        self.assertFalse(result[0].flags.owndata)
+        self.assertFalse(result[0].flags.writeable)
+        self.assertTrue(
+            pickle.loads(bytearray(data), zero_copy=True)[0].flags.writeable)
+        result = pickle.Unpickler(data, zero_copy=True).load()
+        self.assertFalse(result[0].flags.owndata)
+
+        result = pickle.loads(data)
+        self.assertIs(result[0], result[1])
+        self.assertTrue(result[0].flags.owndata)
+        self.assertTrue(result[0].flags.writeable)
+        result = pickle.Unpickler(data).load()
+        self.assertTrue(result[0].flags.owndata)
+        result = pickle.load(io.BytesIO(data))
+        self.assertTrue(result[0].flags.owndata)
+        self.assertTrue(numpy.array_equal(result[1], a))
+
+    def test_alignment(self):
+        a = numpy.arange(10, dtype=numpy.float64)
+        for alignment in (1, 16, 256):
+            pickler = pickle.Pickler()
+            pickler.array_alignment = alignment
+            data = pickler.dumps(["x" * 7, a])
+            self.assertEqual(data.find(a.tobytes()) % alignment, 0)
+            self.assertTrue(numpy.array_equal(pickle.loads(data)[1], a))
+
+        self.assertRaises(ValueError, setattr, pickler, "array_alignment", 3)
+
+    def test_mmap(self):
+        a = numpy.arange(1000, dtype=numpy.float32)
+        with open(TESTFN, "wb") as f:
+            f.write(b"x")
+            pickle.dump({"a": a}, f)
+        try:
+            with open(TESTFN, "rb") as f:
+                f.read(1)
+                result = pickle.load(f)["a"]
+            self.assertTrue(numpy.array_equal(result, a))
+            with open(TESTFN, "rb") as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            result = pickle.loads(view[1:], zero_copy=True)["a"]
+            self.assertEqual(result.ctypes.data % 64, 0)
+            self.assertTrue(numpy.array_equal(result, a))
+        finally:
+            os.remove(TESTFN)
+
+
+class RecordStreamTests(unittest.TestCase):
+    records = [{"id": i, "name": "x" * i} for i in range(300)]
+
+    def dump(self):
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f)
+        pickler.dump_many(self.records[:100])
+        pickler.dump_many(iter(self.records[100:]))
+        return f.getvalue()
+
+    def test_buffer(self):
+        data = self.dump()
+        self.assertEqual(list(pickle.Unpickler.iter_load(data)), self.records)
+        self.assertEqual(pickle.loads(data), self.records[0])
+        self.assertEqual(
+            pickle.Pickler().dump_many(self.records).get_output_string(), data)
+
+    def test_file(self):
+        f = io.BytesIO(self.dump())
+        self.assertEqual(list(pickle.Unpickler.iter_load(f)), self.records)
+        self.assertEqual(f.tell(), len(f.getvalue()))
+
+        f.seek(0)
+        records = pickle.Unpickler.iter_load(f)
+        self.assertEqual(next(records), self.records[0])
+        records.close()
+        self.assertEqual(pickle.load(f), self.records[1])
+
+    def test_offsets(self):
+        data = self.dump()
+        offsets = [o for o, _ in pickle.Unpickler.iter_load(
+            data, with_offsets=True)]
+        self.assertEqual(offsets[-1], len(data))
+        self.assertEqual(
+            list(pickle.Unpickler.iter_load(data, offsets[49])),
+            self.records[50:])
+        self.assertEqual(
+            list(pickle.Unpickler.iter_load(io.BytesIO(data), offsets[249])),
+            self.records[250:])
+        records = pickle.Unpickler.iter_load(
+            io.BytesIO(data), offsets[0], with_offsets=True)
+        self.assertEqual(next(records), (offsets[1], self.records[1]))
+        self.assertRaises(
+            ValueError, pickle.Unpickler.iter_load, data, len(data) + 1)
+
+    def test_offsets_from_position(self):
+        f = io.BytesIO(b"header" + self.dump())
+        f.seek(6)
+        offsets = [o for o, _ in pickle.Unpickler.iter_load(
+            f, with_offsets=True)]
+        self.assertEqual(offsets[-1], len(f.getvalue()))
+        self.assertEqual(
+            list(pickle.Unpickler.iter_load(f, offsets[249])),
+            self.records[250:])
+
+    def test_record_length(self):
+        data = bytearray(pickle.Pickler().dump_many([[1, 2]]).get_output_string())
+        data[4] += 1
+        data += b"\xc0"
+        self.assertRaises(pickle.UnpicklingError, pickle.loads, data)
+
+    def test_large_records(self):
+        records = [b"x" * 100000, list(range(20000)), "y"]
+        f = RecordingFile()
+        pickle.Pickler(f, buffer_size=4096).dump_many(records)
+        self.assertEqual(list(pickle.Unpickler.iter_load(f.getvalue())), records)
+        self.assertEqual(
+            pickle.Pickler().dump_many(records).get_output_string(),
+            f.getvalue())
+
+    def test_failing_record(self):
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f)
+        self.assertRaises(
+            pickle.PicklingError, pickler.dump_many, [1, [2, iter([])]])
+        pickler.dump_many([3])
+        self.assertEqual(list(pickle.Unpickler.iter_load(f.getvalue())), [1, 3])
+
+    def test_path(self):
+        with open(TESTFN, "wb") as f:
+            f.write(self.dump())
+        try:
+            self.assertEqual(
+                list(pickle.Unpickler.iter_load(TESTFN)), self.records)
+        finally:
+            os.remove(TESTFN)
+
+    def test_truncated(self):
+        records = pickle.Unpickler.iter_load(self.dump()[:-1])
+        self.assertRaises(EOFError, list, records)
+
+    def test_empty(self):
+        self.assertEqual(list(pickle.Unpickler.iter_load(b"")), [])
+        self.assertEqual(list(pickle.Unpickler.iter_load(io.BytesIO())), [])
+
+
+SessionPoint = collections.namedtuple("SessionPoint", "x y")
+
+
+class SessionTests(unittest.TestCase):
+    messages = [
+        {"request_id": i, "method": "get_user",
+         "params": {"user_name": "user%d" % i, "point": SessionPoint(i, i)}}
+        for i in range(20)]
+
+    def test_session(self):
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        sizes = []
+        for message in self.messages * 2:
+            data = pickler.dumps(message)
+            sizes.append(len(data))
+            self.assertEqual(unpickler.loads(data), message)
+
+        plain = pickle.Pickler()
+        self.assertLess(sum(sizes[1:]), sum(
+            len(plain.dumps(m)) for m in (self.messages * 2)[1:]) * 0.8)
+
+    def test_reset(self):
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        unpickler.loads(pickler.dumps(self.messages[0]))
+
+        pickler.reset_session()
+        self.assertEqual(unpickler.loads(pickler.dumps(self.messages[1])),
+                         self.messages[1])
+
+        unpickler.reset_session()
+        self.assertRaises(pickle.UnpicklingError, unpickler.loads,
+                          pickler.dumps(self.messages[2]))
+        pickler.reset_session()
+        self.assertEqual(unpickler.loads(pickler.dumps(self.messages[3])),
+                         self.messages[3])
+
+    def test_error_resets(self):
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        unpickler.loads(pickler.dumps(self.messages[0]))
+        self.assertRaises(pickle.PicklingError, pickler.dumps,
+                          [self.messages[1], iter([])])
+        self.assertEqual(unpickler.loads(pickler.dumps(self.messages[1])),
+                         self.messages[1])
+
+    def test_session_size(self):
+        pickler = pickle.Pickler(session=True, session_size=30)
+        unpickler = pickle.Unpickler(session=True)
+        for message in self.messages * 3:
+            self.assertEqual(unpickler.loads(pickler.dumps(message)), message)
+
+    def test_long_strings_are_released(self):
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        tracemalloc.start()
+        try:
+            for i in range(50):
+                text = str(i) * 100000
+                message = {"text": text, "again": text, "method": "put"}
+                self.assertEqual(
+                    unpickler.loads(pickler.dumps(message)), message)
+                del message, text
+                if i == 0:
+                    start = tracemalloc.get_traced_memory()[0]
+            held = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+        self.assertLess(held, 1000000)
+
+    def test_file(self):
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, session=True)
+        for message in self.messages:
+            pickler.dump(message)
+
+        f.seek(0)
+        unpickler = pickle.Unpickler(f, session=True)
+        self.assertEqual([unpickler.load() for m in self.messages],
+                         self.messages)
+
+    def test_no_session(self):
+        data = pickle.Pickler(session=True).dumps(self.messages[0])
+        self.assertRaises(pickle.UnpicklingError, pickle.loads, data)
+        self.assertRaises(ValueError, pickle.Pickler, session=True,
+                          with_refs=False)
+
+
+class PickledPid:
+    """is loaded as the pid of the process that pickled it"""
+    def __reduce__(self):
+        return int, (os.getpid(),)
+
+
+class ParallelTests(unittest.TestCase):
+    items = [{"id": i, "name": str(i)} for i in range(1000)]
+
+    def check(self, obj, **kwargs):
+        data = pickle.dumps_parallel(obj, chunk_size=64, **kwargs)
+        self.assertEqual(pickle.loads(data), obj)
+        self.assertEqual(type(pickle.loads(data)), type(obj))
+        self.assertEqual(pickle.load(io.BytesIO(data)), obj)
+        return data
+
+    def test_containers(self):
+        self.check(self.items)
+        self.check(tuple(self.items))
+        self.check({str(i): i for i in range(1000)})
+        self.assertEqual(self.check(self.items[:10]),
+                         pickle.dumps(self.items[:10]))
+        self.assertEqual(self.check(1), pickle.dumps(1))
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(),
+                         "needs fork")
+    def test_processes(self):
+        self.check(self.items, processes=3)
+        self.check(tuple(self.items), processes=3)
+        self.check({str(i): i for i in range(1000)}, processes=3)
+
+        obj = [PickledPid() for i in range(100)]
+        pids = pickle.loads(
+            pickle.dumps_parallel(obj, chunk_size=10, processes=2))
+        self.assertEqual(len(pids), 100)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(
+            pickle.loads(pickle.dumps_parallel(obj, chunk_size=10, processes=1)),
+            [os.getpid()] * 100)
+
+    def test_executor(self):
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            data = self.check(self.items, executor=executor)
+            self.assertEqual(
+                pickle.loads_parallel(data, executor=executor), self.items)
+        self.assertEqual(pickle.loads_parallel(data), self.items)
+
+    def test_find_class(self):
+        found = []
+
+        class Unpickler(pickle.Unpickler):
+            def find_class(self, module, name):
+                found.append(name)
+                return super().find_class(module, name)
+
+        obj = [collections.OrderedDict(a=i) for i in range(100)]
+        data = pickle.dumps_parallel(obj, chunk_size=10)
+        self.assertEqual(Unpickler(data).load(), obj)
+        self.assertEqual(set(found), {"OrderedDict"})
+        self.assertRaises(pickle.SecurityError, pickle.loads_parallel,
+                          pickle.dumps_parallel([SessionPoint] * 10, chunk_size=2),
+                          secure=True)
+
+
+class CompressionTests(unittest.TestCase):
+    data = [{"id": i, "name": "name%d" % i, "text": "x" * 50}
+            for i in range(5000)]
+
+    def test_methods(self):
+        plain = pickle.dumps(self.data)
+        for method in ("zlib", "bz2", "lzma"):
+            data = pickle.dumps(self.data, compression=method)
+            self.assertLess(len(data), len(plain) // 4)
+            self.assertEqual(pickle.loads(data), self.data)
+
+    def test_frames(self):
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, compression="zlib", buffer_size=1024)
+        pickler.dump(self.data)
+        pickler.dump(1)
+        f.seek(0)
+        unpickler = pickle.Unpickler(f, buffer_size=1024)
+        self.assertEqual(unpickler.load(), self.data)
+        self.assertEqual(unpickler.load(), 1)
+        self.assertEqual(f.tell(), len(f.getvalue()))
+
+    def test_session(self):
+        pickler = pickle.Pickler(compression="zlib", session=True)
+        unpickler = pickle.Unpickler(session=True)
+        for obj in self.data[:10]:
+            self.assertEqual(unpickler.loads(pickler.dumps(obj)), obj)
+
+    def test_truncated(self):
+        data = pickle.dumps(self.data, compression="zlib")
+        for size in (3, len(data) // 2, len(data) - 1):
+            self.assertRaises(EOFError, pickle.loads, data[:size])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, pickle.Pickler, compression="zip")
+
+
+class LazyTests(unittest.TestCase):
+    def make_data(self):
+        shared = ["a shared string", (1, 2, 3)]
+        data = {
+            "list": [1, 2, {"text": "hello world", "shared": shared}],
+            "shared": shared,
+            "long": 2**100,
+            "bytes": b"some bytes",
+            "point": SessionPoint(1, "a shared string"),
+            "deque": collections.deque([1, "a shared string"]),
+            "obj": collections.OrderedDict(items=shared),
+            "set": {1, 2, 3},
+            "empty": (),
+            "none": None}
+        data["self"] = data
+        return data
+
+    def test_access(self):
+        data = self.make_data()
+        for proto in protocols:
+            s = pickle.dumps(data, proto)
+            for keys in (list(data), list(reversed(data))):
+                lazy = pickle.loads_lazy(s)
+                self.assertIsInstance(lazy, pickle.LazyMap)
+                self.assertEqual(len(lazy), len(data))
+                self.assertEqual(set(lazy), set(data))
+                for k in keys:
+                    value = lazy[k]
+                    if k == "self":
+                        self.assertIs(value, lazy)
+                    elif k == "list":
+                        self.assertIsInstance(value, pickle.LazySeq)
+                        self.assertEqual(value[:2], [1, 2])
+                        self.assertEqual(dict(value[2])["text"], "hello world")
+                    elif k in ("shared", "empty"):
+                        self.assertEqual(value, data[k])
+                    elif k == "obj":
+                        self.assertIs(value["items"], lazy["shared"])
+                    else:
+                        self.assertEqual(value, data[k])
+
+    def test_shared(self):
+        lazy = pickle.loads_lazy(pickle.dumps(self.make_data()))
+        self.assertIs(lazy["point"].y, lazy["deque"][1])
+        self.assertIs(lazy["list"][2]["shared"], lazy["shared"])
+        self.assertIs(lazy["shared"][1], lazy["shared"][1])
+
+    def test_not_container(self):
+        for obj in (1, "text", SessionPoint(1, 2)):
+            self.assertEqual(pickle.loads_lazy(pickle.dumps(obj)), obj)
+
+        self.assertEqual(pickle.loads_lazy(pickle.dumps_parallel(
+            list(range(10)), chunk_size=3)), list(range(10)))
+
+    def test_errors(self):
+        s = pickle.dumps(self.make_data())
+        self.assertRaises(EOFError, pickle.loads_lazy, s[:len(s) // 2])
+        self.assertRaises(TypeError, pickle.loads_lazy, io.BytesIO(s))
+        lazy = pickle.loads_lazy(s)
+        self.assertRaises(KeyError, operator.getitem, lazy, "unknown")
+        self.assertRaises(TypeError, operator.setitem, lazy, "list", 1)
+
+
+class IndexedTests(unittest.TestCase):
+    samples = [{"id": i, "name": "sample%d" % i} for i in range(100)]
+
+    def tearDown(self):
+        if os.path.exists(TESTFN):
+            os.remove(TESTFN)
+
+    def test_access(self):
+        with pickle.IndexedWriter(TESTFN) as writer:
+            writer.extend(self.samples)
+            self.assertEqual(len(writer), 100)
+
+        with pickle.IndexedReader(TESTFN) as reader:
+            self.assertEqual(len(reader), 100)
+            self.assertEqual(reader[5], self.samples[5])
+            self.assertEqual(reader[-1], self.samples[-1])
+            self.assertEqual(reader[10:20], self.samples[10:20])
+            self.assertEqual(reader[::7], self.samples[::7])
+            self.assertEqual(reader[20:10], [])
+            self.assertEqual(list(reader), self.samples)
+            self.assertRaises(IndexError, operator.getitem, reader, 100)
+
+    def test_append(self):
+        with pickle.IndexedWriter(TESTFN) as writer:
+            writer.extend(self.samples[:50])
+        with pickle.IndexedWriter(TESTFN, append=True) as writer:
+            writer.extend(self.samples[50:])
+
+        with open(TESTFN, "rb") as f, pickle.IndexedReader(f) as reader:
+            self.assertEqual(list(reader), self.samples)
+            self.assertEqual(reader[45:55], self.samples[45:55])
+            self.assertEqual(reader[50], self.samples[50])
+
+    def test_interrupted_append(self):
+        with pickle.IndexedWriter(TESTFN) as writer:
+            writer.extend(self.samples[:50])
+        writer = pickle.IndexedWriter(TESTFN, append=True)
+        writer.extend(self.samples[50:])
+        writer.file.flush()
+
+        # the appended elements are not committed without close()
+        with pickle.IndexedReader(TESTFN) as reader:
+            self.assertEqual(list(reader), self.samples[:50])
+        writer.file.close()
+
+        with pickle.IndexedWriter(TESTFN, append=True) as writer:
+            writer.extend(self.samples[50:60])
+        with pickle.IndexedReader(TESTFN) as reader:
+            self.assertEqual(list(reader), self.samples[:60])
+
+    def test_damaged(self):
+        with pickle.IndexedWriter(TESTFN) as writer:
+            writer.extend(self.samples)
+
+        with open(TESTFN, "r+b") as f:
+            f.truncate(os.path.getsize(TESTFN) - 1)
+        self.assertRaises(pickle.UnpicklingError, pickle.IndexedReader, TESTFN)
+        self.assertRaises(
+            pickle.UnpicklingError, pickle.IndexedWriter, TESTFN, True)
+
+        with open(TESTFN, "wb") as f:
+            pickle.dump(self.samples, f)
+        self.assertRaises(pickle.UnpicklingError, pickle.IndexedReader, TESTFN)
+
+
+class StoreTests(unittest.TestCase):
+    def tearDown(self):
+        for suffix in ("", ".idx", ".lock"):
+            if os.path.exists(TESTFN + suffix):
+                os.remove(TESTFN + suffix)
+
+    def test_mapping(self):
+        with store.open(TESTFN) as s:
+            expected = {}
+            for i in range(2000):
+                s["key%d" % i] = expected["key%d" % i] = {"value": i}
+            for i in range(0, 2000, 3):
+                del s["key%d" % i]
+                del expected["key%d" % i]
+            s[b"bytes"] = expected[b"bytes"] = [1, 2]
+            s["key1"] = expected["key1"] = "changed"
+
+            self.assertEqual(len(s), len(expected))
+            self.assertEqual(dict(s), expected)
+            self.assertNotIn("key0", s)
+            self.assertRaises(KeyError, operator.getitem, s, "key0")
+            self.assertRaises(KeyError, operator.delitem, s, "key0")
+            self.assertRaises(TypeError, operator.setitem, s, 1, 1)
+
+        with store.open(TESTFN, "r") as s:
+            self.assertEqual(dict(s), expected)
+
+    def test_readers(self):
+        writer = store.open(TESTFN, "n")
+        writer["a"] = 1
+        reader = store.open(TESTFN, "r")
+        self.assertRaises(BlockingIOError, store.open, TESTFN)
+        self.assertRaises(PermissionError, operator.setitem, reader, "a", 2)
+
+        for i in range(1000):
+            writer["a"] = writer["key%d" % i] = i
+        self.assertEqual(reader["a"], 999)
+        self.assertEqual(len(reader), 1001)
+
+        self.assertGreater(writer.dead_size, 0)
+        size = os.path.getsize(TESTFN)
+        writer.compact()
+        self.assertEqual(writer.dead_size, 0)
+        self.assertLess(os.path.getsize(TESTFN), size)
+        writer["b"] = 2
+        self.assertEqual(reader["b"], 2)
+        self.assertEqual(reader["key10"], 10)
+        writer.close()
+        reader.close()
+
+    def test_recover(self):
+        with store.open(TESTFN) as s:
+            s["a"] = 1
+            # a record that was written, but not published
+            s._append(0, b"b", s.pickler.dumps(2))
+
+        with store.open(TESTFN) as s:
+            self.assertEqual(dict(s), {"a": 1, "b": 2})
+
+    def test_interrupted_compact(self):
+        expected = {"key%d" % i: -i for i in range(100)}
+        s = store.open(TESTFN, "n")
+        for key, value in expected.items():
+            s[key] = 0
+            s[key] = value
+
+        replace = os.replace
+
+        def crash(src, dst):
+            if dst == TESTFN:
+                raise OSError("crash")
+            replace(src, dst)
+
+        with unittest.mock.patch("os.replace", crash):
+            self.assertRaises(OSError, s.compact)
+        s.close()
+
+        with store.open(TESTFN) as s:
+            self.assertEqual(dict(s), expected)
+            self.assertEqual(s.dead_size, 0)
+        self.assertFalse(os.path.exists(TESTFN + ".tmp"))
+
+
+class PlanSlots:
+    __slots__ = ("a", "b", "__dict__")
+
+
+class PlanGetState:
+    def __init__(self, value):
+        self.value = value
+
+    def __getstate__(self):
+        return {"value": self.value * 2}
+
+    def __setstate__(self, state):
+        self.value = state["value"] // 2
+
+
+class EncodePlanTests(unittest.TestCase):
+    def make_class(self):
+        class PlanPlain:
+            pass
+        PlanPlain.__qualname__ = PlanPlain.__name__
+        globals()["PlanPlain"] = PlanPlain
+        self.addCleanup(globals().pop, "PlanPlain")
+        return PlanPlain
+
+    def test_same_output(self):
+        slots = PlanSlots()
+        slots.a = slots.x = 1
+        cls = self.make_class()
+        plain = cls()
+        plain.x = [1, 2]
+        for obj in (plain, cls(), slots, PlanSlots(), PlanGetState(3)):
+            for proto in protocols:
+                # the first dump creates the plan, the second uses it
+                first = pickle.dumps([obj, obj], proto)
+                self.assertEqual(pickle.dumps([obj, obj], proto), first)
+
+        obj = pickle.loads(pickle.dumps(slots))
+        self.assertEqual((obj.a, obj.x), (1, 1))
+        self.assertEqual(pickle.loads(pickle.dumps(PlanGetState(3))).value, 3)
+
+    def test_shared_state(self):
+        cls = self.make_class()
+        obj = cls()
+        obj.x = 1
+        for data in ([obj, obj.__dict__], [obj.__dict__, obj]):
+            result = pickle.loads(pickle.dumps(data))
+            index = data.index(obj)
+            self.assertIsNot(result[1 - index], result[index].__dict__)
+            result[1 - index]["x"] = 2
+            self.assertEqual(result[index].x, 1)
+
+    def test_class_changed(self):
+        cls = self.make_class()
+        obj = cls()
+        obj.x = 1
+        pickle.dumps(obj)
+        cls.__getstate__ = lambda self: {"x": 2}
+        self.assertEqual(pickle.loads(pickle.dumps(obj)).x, 2)
+        cls.__reduce__ = lambda self: "PlanPlain"
+        self.assertIs(pickle.loads(pickle.dumps(obj)), cls)
+
+
+class RecordingUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        self.calls.append((module, name))
+        return super().find_class(module, name)
+
+
+class ClassCacheTests(unittest.TestCase):
+    def make_class(self):
+        class CachedItem:
+            pass
+        CachedItem.__qualname__ = CachedItem.__name__
+        globals()["CachedItem"] = CachedItem
+        self.addCleanup(globals().pop, "CachedItem", None)
+        return CachedItem
+
+    def test_once_per_pickle(self):
+        cls = self.make_class()
+        data = pickle.dumps([cls() for i in range(100)])
+        unpickler = RecordingUnpickler(data)
+        unpickler.calls = []
+        result = unpickler.load()
+        self.assertEqual(len(unpickler.calls), len(set(unpickler.calls)))
+        self.assertTrue(all(type(o) is cls for o in result))
+
+    def test_cross_load_cache(self):
+        cls = self.make_class()
+        unpickler = pickle.Unpickler(class_cache=True)
+        self.assertIs(type(unpickler.loads(pickle.dumps(cls()))), cls)
+        self.assertIs(type(unpickler.loads(pickle.dumps(cls()))), cls)
+
+        # a reload replaces the class in the module
+        other = self.make_class()
+        data = pickle.dumps(other())
+        self.assertIs(type(unpickler.loads(data)), other)
+        unpickler.clear_class_cache()
+        self.assertIs(type(unpickler.loads(data)), other)
+
+    def test_secure_epoch(self):
+        cls = self.make_class()
+        secure_unpickle(cls)
+        self.addCleanup(pickle.register.secure_objects.discard, cls)
+        unpickler = pickle.Unpickler(class_cache=True, secure=True)
+        data = pickle.dumps(cls())
+        self.assertIs(type(unpickler.loads(data)), cls)
+        self.assertIs(type(unpickler.loads(data)), cls)
+
+        pickle.register.secure_objects.discard(cls)
+        pickle.register.changed()
+        self.assertRaises(pickle.SecurityError, unpickler.loads, data)
+        secure_unpickle(cls)
+        self.assertIs(type(unpickler.loads(data)), cls)
+
+
+class ShapeTests(unittest.TestCase):
+    def records(self):
+        return [{"id": i, "name": "n%d" % i, "group": i % 3}
+                for i in range(100)]
+
+    def test_records(self):
+        records = self.records()
+        records.append({1: "a", 2: "b"})
+        records.append({"name": "x", "id": 1, "group": 2})
+        data = pickle.dumps(records)
+        self.assertLess(len(data), len(pickle.dumps(records, 4)))
+        result = pickle.loads(data)
+        self.assertEqual(result, records)
+        self.assertEqual([list(r) for r in result],
+                         [list(r) for r in records])
+
+    def test_references(self):
+        a = {"x": 1, "y": 2}
+        b = {"x": 3, "y": None}
+        b["y"] = b
+        result = pickle.loads(pickle.dumps([a, b, b, a]))
+        self.assertIs(result[1]["y"], result[1])
+        self.assertIs(result[2], result[1])
+        self.assertIs(result[3], result[0])
+
+    def test_objects(self):
+        objs = [initarg(i, str(i)) for i in range(10)]
+        self.assertEqual(pickle.loads(pickle.dumps(objs)), objs)
+
+    def test_lazy_and_session(self):
+        records = self.records()
+        lazy = pickle.loads_lazy(pickle.dumps(records))
+        self.assertEqual(lazy[50], records[50])
+        self.assertEqual(list(lazy), records)
+
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        for i in range(3):
+            self.assertEqual(unpickler.loads(pickler.dumps(records)), records)
+
+class LoadPlanTests(unittest.TestCase):
+    def make_class(self):
+        class PlanLoaded:
+            pass
+        PlanLoaded.__qualname__ = PlanLoaded.__name__
+        globals()["PlanLoaded"] = PlanLoaded
+        self.addCleanup(globals().pop, "PlanLoaded", None)
+        return PlanLoaded
+
+    def test_dict_state(self):
+        cls = self.make_class()
+        objs = [cls() for i in range(3)]
+        for i, o in enumerate(objs):
+            o.x = i
+        result = pickle.loads(pickle.dumps(objs + [objs[0].__dict__]))
+        self.assertEqual([o.x for o in result[:3]], [0, 1, 2])
+        result[1].y = 1
+        self.assertEqual(result[0].__dict__, {"x": 0})
+        self.assertEqual(result[3], {"x": 0})
+
+    def test_class_changed(self):
+        cls = self.make_class()
+        obj = cls()
+        obj.x = 1
+        data = pickle.dumps(obj)
+        self.assertEqual(pickle.loads(data).x, 1)
+
+        def setstate(self, state):
+            self.x = state["x"] + 1
+        cls.__setstate__ = setstate
+        self.assertEqual(pickle.loads(data).x, 2)
+
+        del cls.__setstate__
+        cls.__getattr__ = lambda self, name: (
+            (lambda state: setattr(self, "x", 3)) if name == "__setstate__"
+            else object.__getattribute__(self, name))
+        self.assertEqual(pickle.loads(data).x, 3)
+
+class TypedArrayTests(unittest.TestCase):
+    def test_sequences(self):
+        cases = [list(range(10)), list(range(-5, 300)), tuple(range(70000)),
+                 [-70000] * 9, [2**40] * 9, [-2**63] * 9, [0.5 * i for i in range(9)],
+                 [0.1 * i for i in range(9)], (1e300,) * 9,
+                 [True] * 9, [1, 2.0] * 5, [2**63] * 9]
+        for proto in protocols:
+            for case in cases:
+                result = self.loads(pickle.dumps(case, proto))
+                self.assertEqual(result, case)
+                self.assertIs(type(result), type(case))
+                self.assertEqual([type(i) for i in result],
+                                 [type(i) for i in case])
+
+        nan = pickle.loads(pickle.dumps([float("nan")] * 9))
+        self.assertTrue(all(i != i for i in nan))
+        self.assertLess(len(pickle.dumps([0.5] * 100)), 410)
+
+    def loads(self, data):
+        result = pickle.loads(data)
+        self.assertEqual(pickle.Unpickler(io.BytesIO(data)).load(), result)
+        return result
+
+    def test_array(self):
+        for proto in protocols:
+            for typecode in "bBhHiIlLqQfd":
+                a = array.array(typecode, range(10))
+                result = self.loads(pickle.dumps([a, a], proto))
+                self.assertEqual(result[0], a)
+                self.assertEqual(result[0].typecode, typecode)
+                self.assertIs(result[0], result[1])
+
+
+class ThreadTests(unittest.TestCase):
+    def test_independent_threads(self):
+        def work(i):
+            cls = type("ThreadItem%d" % i, (C,), {})
+            cls.__module__ = __name__
+            globals()[cls.__name__] = cls
+            try:
+                for j in range(50):
+                    obj = cls()
+                    obj.values = [j, {"i": i, "j": j}, [1.5] * 10]
+                    data = [obj, obj, (i, j)]
+                    result = pickle.loads(pickle.dumps(data))
+                    if result[0] != obj or result[0] is not result[1]:
+                        return False
+            finally:
+                del globals()[cls.__name__]
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            self.assertTrue(all(executor.map(work, range(32))))
+
+class _NestedDump:
+    def __init__(self, value, fail=False):
+        self.value = value
+        self.fail = fail
+
+    def __reduce__(self):
+        if self.fail:
+            1 / 0
+        # a nested call of the module function during the outer dump
+        return (pickle.loads, (pickle.dumps(self.value),))
+
+
+class PoolTests(unittest.TestCase):
+    def test_reentrant(self):
+        data = [{"a": 1, "b": 2}, _NestedDump({"a": 1, "b": [1, 2]}), "x"]
+        self.assertEqual(pickle.loads(pickle.dumps(data)),
+                         [{"a": 1, "b": 2}, {"a": 1, "b": [1, 2]}, "x"])
+
+    def test_after_errors(self):
+        self.assertRaises(ZeroDivisionError, pickle.dumps,
+                          [1, _NestedDump(1, fail=True)])
+        self.assertRaises(EOFError, pickle.loads, pickle.dumps([1, 2])[:-1])
+        data = {"list": [1, 2, 3], "same": ["s"] * 3}
+        self.assertEqual(pickle.loads(pickle.dumps(data)), data)
+        self.assertEqual(
+            pickle.loads(bytearray(pickle.dumps(data)), secure=True), data)
+
+    def test_options(self):
+        data = [{"a": 1, "b": 2}, {"a": 3, "b": 4}]
+        for protocol in (-1, 2, 3, 4, 5, 99):
+            for with_refs in (True, False):
+                s = pickle.dumps(data, protocol, with_refs)
+                # the version header
+                self.assertEqual(s[:3], pickle.Pickler(
+                    protocol=protocol, with_refs=with_refs).dumps(data)[:3])
+                self.assertEqual(pickle.loads(s), data)
+
+    def test_deterministic(self):
+        for data in ({"a": 1, "b": 2}, [{"x": i, "y": i} for i in range(3)]):
+            first = pickle.dumps(data)
+            self.assertEqual(pickle.dumps(data), first)
+            self.assertEqual(pickle.Pickler().dumps(data), first)
+
+    def test_lazy_shape(self):
+        pickler = pickle.Pickler()
+        pickler.dumps({"a": 1, "b": 2})
+        lazy = pickle.loads_lazy(pickler.dumps({"a": [1], "b": 2}))
+        self.assertIsInstance(lazy, pickle.LazyMap)
+        self.assertEqual(dict(lazy), {"a": [1], "b": 2})
+
+class OutputTests(unittest.TestCase):
+    def test_large_output(self):
+        data = [bytes([i % 256]) * 1000 for i in range(1000)]
+        pickler = pickle.Pickler()
+        s = pickler.dumps(data)
+        self.assertEqual(pickle.loads(s), data)
+        self.assertIs(pickler.get_output_string(), s)
+        # the handed over output is not written again
+        pickler.dump(data[:10])
+        self.assertEqual(pickle.loads(s), data)
+        self.assertEqual(pickler.dumps(data), s)
+
+        # a handed over bytes object is immutable, also without references
+        for i in range(3):
+            s = pickle.dumps(bytes([i]) * 100000)
+            self.assertEqual(hash(s), hash(bytes(s)))
+            del s
+
+    def test_view(self):
+        pickler = pickle.Pickler()
+        for data in ([1, "a", 2.5], ["x" * 100000, 1]):
+            s = pickler.dumps(data)
+            view = pickler.get_output_view()
+            self.assertTrue(view.readonly)
+            self.assertEqual(view, s)
+            pickler.dumps({"other": data})
+            self.assertEqual(view, s)
+            self.assertEqual(pickle.loads(view), data)
+
+        self.assertEqual(len(pickle.Pickler().get_output_view()), 0)
+        pickler = pickle.Pickler(io.BytesIO())
+        self.assertRaises(pickle.PicklingError, pickler.get_output_view)
+
+    def test_dumps_into(self):
+        data = {"a": [1, 2, 3], "b": "x" * 100, "c": {"a": 1, "b": 2}}
+        # without refs the dict shapes of former pickles are not used
+        expected = pickle.Pickler(with_refs=False).dumps(data)
+        pickler = pickle.Pickler(with_refs=False)
+        buffer = bytearray(1000)
+        size = pickler.dumps_into(data, buffer, 10)
+        self.assertEqual(size, len(expected))
+        self.assertEqual(buffer[10:10 + size], expected)
+        self.assertEqual(buffer[:10], bytes(10))
+        self.assertEqual(pickle.loads(memoryview(buffer)[10:10 + size]), data)
+
+        small = bytearray(20)
+        with self.assertRaises(pickle.BufferTooSmallError) as cm:
+            pickler.dumps_into(data, small)
+        self.assertEqual(cm.exception.required, len(expected))
+        self.assertIsInstance(cm.exception, pickle.PicklingError)
+
+        continuation = bytearray(200)
+        size = pickler.dumps_into(data, small, 5, continuation)
+        self.assertEqual(bytes(small[5:] + continuation[:size - 15]), expected)
+        self.assertRaises(pickle.BufferTooSmallError, pickler.dumps_into,
+                          data, small, 5, bytearray(10))
+        self.assertRaises(ValueError, pickler.dumps_into, data, small, 21)
+        self.assertRaises(BufferError, pickler.dumps_into, data, b"x" * 100)
+        # the pickler works as before
+        self.assertEqual(pickler.dumps(data), expected)
+
+    def test_dumps_into_compressed(self):
+        data = ["x" * 1000] + list(range(200))
+        expected = pickle.Pickler(compression="zlib").dumps(data)
+        pickler = pickle.Pickler(compression="zlib")
+        buffer = bytearray(1000)
+        size = pickler.dumps_into(data, buffer)
+        self.assertEqual(size, len(expected))
+        self.assertEqual(buffer[:size], expected)
+        self.assertEqual(pickle.loads(buffer[:size]), data)
+
+        small = bytearray(len(expected) - 10)
+        with self.assertRaises(pickle.BufferTooSmallError) as cm:
+            pickler.dumps_into(data, small)
+        self.assertEqual(cm.exception.required, len(expected))
+        size = pickler.dumps_into(data, small, 0, bytearray(20))
+        self.assertEqual(size, len(expected))
+
+    def test_dumps_into_session(self):
+        pickler = pickle.Pickler(session=True)
+        unpickler = pickle.Unpickler(session=True)
+        buffer = bytearray(100)
+        for data in (["abc", "def"], ["abc", "x" * 200], ["abc", "def"]):
+            try:
+                size = pickler.dumps_into(data, buffer)
+            except pickle.BufferTooSmallError:
+                continue
+            self.assertEqual(unpickler.loads(buffer[:size]), data)
+
+
+def _channel_producer(channel, count):
+    for i in range(count):
+        channel.put({"i": i, "data": "x" * (i % 300)})
+    channel.close()
+
+
+class ChannelTests(unittest.TestCase):
+    def setUp(self):
+        self.channel = Channel(1024)
+
+    def tearDown(self):
+        self.channel.unlink()
+
+    def test_put_get(self):
+        channel = self.channel
+        self.assertTrue(channel.empty())
+        self.assertRaises(queue.Empty, channel.get_nowait)
+        self.assertRaises(queue.Empty, channel.get, timeout=0.01)
+        # the messages wrap around the end of the ring
+        for i in range(200):
+            message = [i, "y" * (i * 7 % 200), {"a": i, "b": [i] * 3}]
+            channel.put(message)
+            channel.put(i)
+            self.assertEqual(channel.get(), message)
+            self.assertEqual(channel.get_nowait(), i)
+        self.assertTrue(channel.empty())
+
+    def test_full(self):
+        channel = self.channel
+        count = 0
+        with self.assertRaises(queue.Full):
+            while True:
+                channel.put_nowait(b"z" * 100)
+                count += 1
+        self.assertRaises(queue.Full, channel.put, b"z" * 100, timeout=0.01)
+        self.assertRaises(ValueError, channel.put, b"z" * 2000)
+        for i in range(count):
+            self.assertEqual(channel.get(), b"z" * 100)
+        self.assertTrue(channel.empty())
+
+    def test_processes(self):
+        context = multiprocessing.get_context()
+        channel = Channel(4096, multi_producer=True, context=context)
+        try:
+            producers = [
+                context.Process(target=_channel_producer, args=(channel, 500))
+                for i in range(2)]
+            for p in producers:
+                p.start()
+            messages = [channel.get(timeout=30) for i in range(1000)]
+            for p in producers:
+                p.join()
+        finally:
+            channel.unlink()
+        self.assertEqual(sorted(m["i"] for m in messages),
+                         sorted(list(range(500)) * 2))
+        self.assertTrue(all(m["data"] == "x" * (m["i"] % 300)
+                            for m in messages))
+
+
+class FeedTests(unittest.TestCase):
+    samples = [
+        1, "abc", {"a": [1, 2, 3], "b": ("x" * 300, 2.5)}, list(range(100)),
+        array.array("d", [1.5] * 20), [{"a": i, "b": -i} for i in range(10)],
+        b"y" * 1000, None, {1, 2, 3}, C()]
+
+    def make_stream(self):
+        stream = b"".join(pickle.dumps(o) for o in self.samples)
+        stream += pickle.dumps(list(range(5000)), compression="zlib")
+        pickler = pickle.Pickler(session=True)
+        stream += pickler.dumps(["s1", "s2"]) + pickler.dumps(["s1", "s3"])
+        expected = self.samples + [list(range(5000)), ["s1", "s2"],
+                                   ["s1", "s3"]]
+        return stream, expected
+
+    def test_chunks(self):
+        stream, expected = self.make_stream()
+        for step in (1, 3, 100, len(stream)):
+            unpickler = pickle.Unpickler(session=True)
+            result = []
+            for i in range(0, len(stream), step):
+                unpickler.feed(stream[i:i + step])
+                result.extend(unpickler.objects())
+            self.assertEqual(result, expected)
+            self.assertEqual(unpickler.pending, 0)
+
+    def test_incomplete(self):
+        s = pickle.dumps({"a": "x" * 100})
+        unpickler = pickle.Unpickler()
+        unpickler.feed(s + s[:10])
+        self.assertEqual(list(unpickler.objects()), [{"a": "x" * 100}])
+        self.assertEqual(unpickler.pending, 10)
+        self.assertEqual(list(unpickler.objects()), [])
+        unpickler.feed(s[10:])
+        self.assertEqual(list(unpickler.objects()), [{"a": "x" * 100}])
+        self.assertRaises(
+            TypeError, pickle.Unpickler(io.BytesIO()).feed, b"")
+
+    @unittest.skipUnless(numpy, "needs numpy")
+    def test_ndarray(self):
+        # the data size of larger arrays is a signed msgpack int
+        arrays = [numpy.arange(100.0), numpy.ones((3, 4), dtype="int8")]
+        stream = b"".join(pickle.dumps({"a": a}) for a in arrays)
+        unpickler = pickle.Unpickler()
+        result = []
+        for i in range(0, len(stream), 5):
+            unpickler.feed(stream[i:i + 5])
+            result.extend(unpickler.objects())
+        self.assertEqual(len(result), 2)
+        for r, a in zip(result, arrays):
+            self.assertTrue(numpy.array_equal(r["a"], a))
+
+    def test_stream_unpickler(self):
+        stream, expected = self.make_stream()
+
+        async def load(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            unpickler = StreamUnpickler(reader, chunk_size=7, session=True)
+            return [obj async for obj in unpickler]
+
+        self.assertEqual(asyncio.run(load(stream)), expected)
+        with self.assertRaises(EOFError):
+            asyncio.run(load(stream[:-1]))
+
+
+class _Failing:
+    def __reduce__(self):
+        raise ZeroDivisionError
+
+
+class _ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+        self.drains = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    async def drain(self):
+        self.drains += 1
+
+
+class IterDumpTests(unittest.TestCase):
+    data = [{"id": i, "name": "item%d" % i, "values": [i] * 5}
+            for i in range(2000)] + [b"b" * 5000]
+
+    def test_chunks(self):
+        pickler = pickle.Pickler()
+        expected = pickle.Pickler().dumps(self.data)
+        chunks = list(pickler.iter_dump(self.data, 1000))
+        self.assertGreater(len(chunks), 10)
+        self.assertTrue(all(0 < len(c) <= 1000 for c in chunks))
+        self.assertEqual(b"".join(chunks), expected)
+        self.assertEqual(pickle.loads(b"".join(chunks)), self.data)
+
+    def test_stop(self):
+        pickler = pickle.Pickler()
+        chunks = pickler.iter_dump(self.data, 100)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(pickler.dumps([1, "a"]),
+                         pickle.Pickler().dumps([1, "a"]))
+
+        chunks = pickler.iter_dump([1, _Failing()])
+        self.assertRaises(ZeroDivisionError, list, chunks)
+        self.assertEqual(pickle.loads(pickler.dumps(self.data)), self.data)
+
+    def test_dump_to(self):
+        writer = _ChunkWriter()
+        asyncio.run(pickle.Pickler().dump_to(self.data, writer, 4096))
+        self.assertEqual(pickle.loads(b"".join(writer.chunks)), self.data)
+        self.assertEqual(writer.drains, len(writer.chunks))
+
+        writer = _ChunkWriter()
+        asyncio.run(dump_to(None, [1, 2], writer))
+        self.assertEqual(pickle.loads(b"".join(writer.chunks)), [1, 2])
+
+    def test_dump_to_cancelled(self):
+        pickler = pickle.Pickler()
+        writer = _ChunkWriter()
+
+        async def cancel():
+            task = asyncio.ensure_future(
+                pickler.dump_to(self.data, writer, 1000))
+            while not writer.chunks:
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+        self.assertLess(len(b"".join(writer.chunks)),
+                        len(pickler.dumps(self.data)))
+        # the worker stopped and gave the pickler back
+        self.assertEqual(pickler.dumps([1, 2]), pickle.dumps([1, 2]))
+        for thread in threading.enumerate():
+            if thread.name == "larch.pickle.iter_dump":
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+
+
 if __name__ == "__main__":
     unittest.main()